@@ -0,0 +1,132 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+import model_router
+import pipeline_budget
+import relevance_gate
+
+# 処理パイプラインの手前で、受け付ける記事の量を制御するモジュール。
+# 記事ごとのコスト（本文の長さの見込みと使うモデル）と、処理中・待機中の記事数、最近の処理時間から負荷を求め、
+# 負荷が上限を超えている間は優先度の低い記事を後回し（Pub/Subにnackして再配信させる）にするか、捨てる。
+
+# 同時に抱えてよい記事の数（処理中と待機中の合計）
+ADMISSION_MAX_PENDING = int(os.getenv('ADMISSION_MAX_PENDING', '8'))
+# 処理中の記事で使ってよいトークン数（OpenAIの1分あたりのトークン上限の目安）
+ADMISSION_TOKENS_PER_MINUTE = int(os.getenv('ADMISSION_TOKENS_PER_MINUTE', '90000'))
+# 1記事の処理時間の目標（秒）。最近の処理時間がこれを超えたら負荷が高いとみなす
+ADMISSION_TARGET_LATENCY = float(os.getenv('ADMISSION_TARGET_LATENCY', '300'))
+# 負荷が上限を超えていても、この優先度以上の記事は負荷がADMISSION_HARD_LIMITになるまで受け付ける
+ADMISSION_KEEP_PRIORITY = float(os.getenv('ADMISSION_KEEP_PRIORITY', '0.7'))
+ADMISSION_HARD_LIMIT = float(os.getenv('ADMISSION_HARD_LIMIT', '1.5'))
+# 負荷が上限を超えているとき、この優先度に満たない記事は後回しにせず捨てる
+ADMISSION_DROP_PRIORITY = float(os.getenv('ADMISSION_DROP_PRIORITY', '0.3'))
+# 後回しにした記事を送り直してもらうまでの時間（秒）。InoreaderのWebhookに返すRetry-After
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '300'))
+# 記録元ごとの優先度（JSON）
+DEFAULT_SOURCE_PRIORITY = {"inoreader": 0.6, "hn": 0.4, "rss": 0.3}
+SOURCE_PRIORITY = {**DEFAULT_SOURCE_PRIORITY, **json.loads(os.getenv('ADMISSION_SOURCE_PRIORITY', '{}'))}
+
+# 本文の長さがわからないときの見込み（文字）と、1トークンあたりの文字数の目安
+DEFAULT_TEXT_CHARS = 12000
+CHARS_PER_TOKEN = 3
+# 要約の出力トークン数の目安
+SUMMARY_OUTPUT_TOKENS = 1000
+# 処理時間と本文の長さの移動平均の重み
+EWMA_ALPHA = 0.2
+
+
+@dataclass
+class Ticket:
+    key: str
+    source: str
+    tokens: int
+    started_at: float
+
+
+# 記事の優先度（記録元の優先度にHNのポイントを加え、求人やShow HNなどは下げる）
+def priority(source, title, metadata=None):
+    metadata = metadata or {}
+    value = SOURCE_PRIORITY.get(source, 0.3)
+    score = metadata.get('score')
+    if isinstance(score, (int, float)):
+        value += min(0.4, 0.08 * math.log1p(max(score, 0)))
+    if relevance_gate.LOW_VALUE_TITLE.search(title or ''):
+        value -= 0.3
+    return value
+
+
+class AdmissionController:
+    def __init__(self, max_pending=ADMISSION_MAX_PENDING, tokens_per_minute=ADMISSION_TOKENS_PER_MINUTE, target_latency=ADMISSION_TARGET_LATENCY):
+        self.max_pending = max_pending
+        self.tokens_per_minute = tokens_per_minute
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.latency = None
+        # 記録元ごとの本文の長さ（文字）の移動平均
+        self.text_chars = {}
+
+    # 記事のトークン数とコスト（ドル）を見積もる（優先度の高い記事は上位のモデルで要約される）
+    def estimate(self, source, value):
+        with self.lock:
+            chars = self.text_chars.get(source, DEFAULT_TEXT_CHARS)
+        tokens = int(chars / CHARS_PER_TOKEN)
+        models = model_router.STAGE_MODELS["summary"]
+        model = models[-1] if value >= model_router.PREMIUM_VALUE else models[0]
+        return tokens, pipeline_budget.estimate_cost(model, tokens, SUMMARY_OUTPUT_TOKENS)
+
+    # 現在の負荷（1.0で上限）。待機中の記事数は呼び出し元のキューの長さ
+    def load(self, queued=0):
+        with self.lock:
+            pending = len(self.in_flight) + queued
+            tokens = sum(ticket.tokens for ticket in self.in_flight.values())
+            latency = self.latency if self.in_flight else None
+        # レート制限の残りが少ないときは使えるトークンも減らす
+        headroom = max(min(model_router.headroom(model) for model in model_router.STAGE_MODELS["summary"]), 0.05)
+        loads = [pending / self.max_pending, tokens / (self.tokens_per_minute * headroom)]
+        # 処理中の記事がない場合は以前の処理時間で判断しない
+        if latency is not None:
+            loads.append(latency / self.target_latency)
+        return max(loads)
+
+    # 受け付けるかを判定する（'admit'、'defer'、'drop'のいずれかと、受け付けた場合はチケットを返す）
+    def admit(self, source, title, url, metadata=None, queued=0):
+        value = priority(source, title, metadata)
+        tokens, cost = self.estimate(source, value)
+        load = self.load(queued)
+
+        if load < 1.0 or (value >= ADMISSION_KEEP_PRIORITY and load < ADMISSION_HARD_LIMIT):
+            ticket = Ticket(key=url, source=source, tokens=tokens, started_at=time.monotonic())
+            with self.lock:
+                self.in_flight[id(ticket)] = ticket
+            return 'admit', ticket
+
+        decision = 'defer' if value >= ADMISSION_DROP_PRIORITY else 'drop'
+        logging.warning(
+            f"負荷が高いため{'後回しにします' if decision == 'defer' else '捨てます'}: {url}"
+            f"（負荷{load:.2f}、優先度{value:.2f}、見込み{tokens}トークン、${cost:.3f}）"
+        )
+        return decision, None
+
+    # 処理が終わった記事を外し、処理時間を記録する
+    def finish(self, ticket):
+        if ticket is None:
+            return
+        elapsed = time.monotonic() - ticket.started_at
+        with self.lock:
+            self.in_flight.pop(id(ticket), None)
+            self.latency = elapsed if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * elapsed
+
+    # パースした本文の長さを記録する（次の記事の見積もりに使う）
+    def observe_text(self, source, chars):
+        with self.lock:
+            previous = self.text_chars.get(source)
+            self.text_chars[source] = chars if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * chars
+
+
+CONTROLLER = AdmissionController()
+
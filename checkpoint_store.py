@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import time
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+import processed_index
+
+# 記事ごとに各段階の出力（パース済みの本文、要約、スコア、リード文、意見）を保存しておくストア。
+# 書き込みに失敗して再配信や再試行が起きても、最後に終わった段階の続きから再開できる。
+
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', '/tmp/autonews_checkpoints')
+# 設定されている場合はGCSのバケットに保存する（インスタンスをまたいで再開できる）
+CHECKPOINT_BUCKET = os.getenv('CHECKPOINT_BUCKET')
+CHECKPOINT_PREFIX = os.getenv('CHECKPOINT_PREFIX', 'checkpoints/')
+# 書き込みまで終わらなかった記事（諦めたデッドレターなど）のチェックポイントを残す日数
+CHECKPOINT_TTL_DAYS = float(os.getenv('CHECKPOINT_TTL_DAYS', '7'))
+
+
+# ローカルのファイルに保存するバックエンド
+class LocalCheckpointBackend:
+    def __init__(self, directory=CHECKPOINT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def load(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, data):
+        # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+        temporary_path = self._path(key) + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temporary_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    # 更新から日数が経ったチェックポイントを削除し、削除した件数を返す
+    def prune(self, max_age_days, now=None):
+        cutoff = (now or time.time()) - max_age_days * 86400
+        deleted = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+
+# GCSのバケットに保存するバックエンド
+class GCSCheckpointBackend:
+    def __init__(self, bucket_name=CHECKPOINT_BUCKET, prefix=CHECKPOINT_PREFIX):
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def _blob(self, key):
+        return self.bucket.blob(f'{self.prefix}{key}.json')
+
+    def load(self, key):
+        blob = self._blob(key)
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_text())
+
+    def save(self, key, data):
+        self._blob(key).upload_from_string(json.dumps(data, ensure_ascii=False), content_type='application/json')
+
+    def delete(self, key):
+        blob = self._blob(key)
+        if blob.exists():
+            blob.delete()
+
+    # 更新から日数が経ったチェックポイントを削除する（バケットのライフサイクルルールを設定している場合は不要）
+    def prune(self, max_age_days, now=None):
+        cutoff = (now or time.time()) - max_age_days * 86400
+        deleted = 0
+        for blob in self.client.list_blobs(self.bucket, prefix=self.prefix):
+            if blob.updated and blob.updated.timestamp() < cutoff:
+                try:
+                    blob.delete()
+                    deleted += 1
+                except NotFound:
+                    pass
+        return deleted
+
+
+# 環境変数に応じてバックエンドを選ぶ
+def init_backend():
+    if CHECKPOINT_BUCKET:
+        return GCSCheckpointBackend()
+    return LocalCheckpointBackend()
+
+
+BACKEND = init_backend()
+
+
+# 1記事分のチェックポイント
+class ArticleCheckpoint:
+    def __init__(self, url, backend=None):
+        self.url = url
+        self.backend = backend or BACKEND
+        self.key = processed_index.item_key(url)
+        try:
+            self.data = self.backend.load(self.key) or {}
+        except Exception as e:
+            logging.warning(f"チェックポイントの読み込みに失敗しました: {url}: {e}")
+            self.data = {}
+        if self.data:
+            logging.info(f"チェックポイントから再開します: {url}（完了済み: {', '.join(self.data)}）")
+
+    def get(self, stage):
+        return self.data.get(stage)
+
+    # 段階の出力を保存する（保存に失敗しても処理は続ける）
+    def save(self, stage, value):
+        self.data[stage] = value
+        try:
+            self.backend.save(self.key, self.data)
+        except Exception as e:
+            logging.warning(f"チェックポイントの保存に失敗しました: {self.url} {stage}: {e}")
+
+    # ストリーミングの出力（openai_streaming.StreamResult）のテキストを返し、期限で打ち切られていない場合だけ保存する
+    # （途中までの出力を保存すると、再試行しても切れたままの要約を使い続けてしまう）
+    def save_result(self, stage, result):
+        if result.truncated:
+            logging.info(f"途中までの出力のためチェックポイントに保存しません: {self.url} {stage}（{result.finish_reason}）")
+        elif result.text:
+            self.save(stage, result.text)
+        return result.text
+
+    # 保存済みならその出力を返し、なければ実行して成功した出力を保存する（StreamResultはsave_resultで保存する）
+    def run(self, stage, function):
+        if stage in self.data:
+            return self.data[stage]
+        value = function()
+        if hasattr(value, 'truncated'):
+            return self.save_result(stage, value)
+        if value:
+            self.save(stage, value)
+        return value
+
+    # 書き込みまで終わった記事のチェックポイントを消す
+    def clear(self):
+        self.data = {}
+        try:
+            self.backend.delete(self.key)
+        except Exception as e:
+            logging.warning(f"チェックポイントの削除に失敗しました: {self.url}: {e}")
+
+
+# 期限を過ぎたチェックポイントを削除する（dead_letter_sweeper.pyから定期的に呼ぶ）
+def prune(max_age_days=CHECKPOINT_TTL_DAYS):
+    try:
+        deleted = BACKEND.prune(max_age_days)
+    except Exception as e:
+        logging.warning(f"古いチェックポイントの削除に失敗しました: {e}")
+        return 0
+    logging.info(f"{max_age_days}日より古いチェックポイントを削除しました: {deleted}件")
+    return deleted
@@ -1,16 +1,14 @@
 import functions_framework
+import contextvars
 import threading
 import flask
-from markupsafe import escape
-import requests
 import json
 import os
-from backoff import expo, on_exception
-from bs4 import BeautifulSoup
 import traceback
 import langchain
 from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
+from langchain.callbacks import get_openai_callback
 from langchain.chains.summarize import load_summarize_chain
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.docstore.document import Document
@@ -20,6 +18,24 @@ import base64  # base64の重複インポートを削除
 import logging  # loggingの重複インポートを削除
 from openai import OpenAI
 import gspread
+import admission
+import checkpoint_store
+import dead_letter
+import fetch_scheduler
+import ingestion
+import processed_index
+import headline_batch
+import record_store
+import relevance_gate
+import resilience
+import spend_ledger
+import stage_graph
+import story_clusters
+import prompt_builder
+import openai_streaming
+import parse_worker
+import pipeline_budget
+import model_router
 
 def summarize_content(content):
     try:
@@ -31,8 +47,12 @@ def summarize_content(content):
         )
         texts = text_splitter.create_documents([content])
 
-        # 要約チェーンを実行
-        result = refine_chain({"input_documents": texts}, return_only_outputs=True)
+        # 要約チェーンを実行（チェーン内の呼び出しの使用量をまとめて記録する）
+        spend_ledger.throttle("refine")
+        with get_openai_callback() as callback:
+            # OpenAIの障害中はチェーンを呼ばずにすぐ失敗させる（再試行はチェーンの中で行う）
+            result = resilience.call('openai', refine_chain, {"input_documents": texts}, return_only_outputs=True, max_attempts=1)
+        spend_ledger.record_tokens(llm.model_name, "refine", callback.prompt_tokens, callback.completion_tokens)
 
         # 要約されたテキストを結合して返す
         return result["output_text"]
@@ -45,7 +65,6 @@ def summarize_content(content):
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')  
 GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')   
 OPENAI_api_key = os.getenv('OPENAI_API_KEY')
-EXCLUDED_DOMAINS = ['github.com', 'youtube.com', 'wikipedia.org', 'twitter.com', 'www.youtube.com']
 
 # プロンプトテンプレートの定義
 refine_first_template = """以下の文章は、長い記事をチャンクで分割したものの冒頭の文章です。それを留意し、次の文章の内容と結合することを留意したうえで以下の文章をテーマ毎にまとめて下さい。
@@ -62,7 +81,8 @@ refine_template = """下記の文章は、長い記事をチャンクで分割
 """
 refine_first_prompt = PromptTemplate(input_variables=["text"],template=refine_first_template)
 refine_prompt = PromptTemplate(input_variables=["existing_answer", "text"],template=refine_template)
-llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo-16k")
+# 再試行の回数は他のOpenAIの呼び出しとそろえる
+llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo-16k", max_retries=resilience.RETRY_MAX_ATTEMPTS - 1)
 # 要約チェーンの初期化
 refine_chain = load_summarize_chain(
     llm=llm,
@@ -93,15 +113,29 @@ def init_gspread():
 
 
 SHEET_CLIENT = init_gspread()
-
-
-
-# OpenAI API呼び出し関数
-def openai_api_call(model, temperature, messages, max_tokens, response_format):
-    client = OpenAI(api_key=OPENAI_api_key)  # 非同期クライアントのインスタンス化
+# 書き込みはローカルのストアに行い、シートにはバックグラウンドで同期する（キーはB列のURL）
+record_store.register_sheet('inoreader_articles', SHEET_CLIENT, 2)
+# 英語のタイトルはまとめて日本語の見出しにする（H列）
+headline_batch.register('inoreader_articles')
+# 処理済みURLのインデックス（B列のURLを一括で読み込む）
+PROCESSED_INDEX = processed_index.ProcessedIndex(SHEET_CLIENT, 2, 'inoreader_articles')
+# 同じ出来事の記事をまとめるクラスタ
+STORY_INDEX = story_clusters.StoryIndex('inoreader_articles')
+
+
+
+# OpenAI API呼び出し関数（stageは支出の台帳に記録する段階）
+def openai_api_call(model, temperature, messages, max_tokens, response_format, stage="other"):
+    spend_ledger.throttle(stage)
+    # 再試行はresilience.pyで行う
+    client = OpenAI(api_key=OPENAI_api_key, max_retries=0)
     try:
         # OpenAI API呼び出しを行う
-        response = client.chat.completions.create(model=model, temperature=temperature, messages=messages, max_tokens=max_tokens, response_format=response_format)
+        raw_response = resilience.call('openai', client.chat.completions.with_raw_response.create, model=model, temperature=temperature, messages=messages, max_tokens=max_tokens, response_format=response_format)
+        # レート制限の残りをモデルの選択に使う
+        model_router.record_rate_limits(model, raw_response.headers)
+        response = raw_response.parse()
+        spend_ledger.record_usage(model, stage, response.usage)
         return response.choices[0].message.content  # 辞書型アクセスから属性アクセスへ変更
     except Exception as e:
         logging.error(f"OpenAI API呼び出し中にエラーが発生しました: {e}")
@@ -112,45 +146,23 @@ def fetch_content_from_url(url):
     try:
         logging.info(f"URLからコンテンツの取得を開始: {url}")
 
-        # ユーザーエージェントを設定
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-
-        response = requests.get(url, headers=headers, timeout=100)
-        content = response.text
+        # ホストごとの同時接続数やcrawl-delayはスケジューラ側で制御する
+        content = fetch_scheduler.SCHEDULER.fetch(url)
 
         logging.info(f"URLからコンテンツの取得が成功: {url}")
         return content
 
+    except fetch_scheduler.PERMANENT_FETCH_ERRORS:
+        # 再試行しても取得できない記事は呼び出し元でスキップする
+        raise
     except Exception as e:
         logging.warning(f"URLからのコンテンツ取得中にエラーが発生しました: {e}")
         return None
 
-#　コンテンツをパースする関数 
+#　コンテンツをパースする関数（CPUを使う処理はプロセスプールで実行し、スレッドはLLMの呼び出しなどI/Oの待ちに使う）
 def parse_content(content):
     try:
-        # HTMLコンテンツをBeautiful Soupでパース
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # ヘッダーとフッターを削除（もし存在する場合）
-        header = soup.find('header')
-        if header:
-            header.decompose()
-
-        footer = soup.find('footer')
-        if footer:
-            footer.decompose()
-
-        # JavaScriptとCSSを削除
-        for script in soup(["script", "style"]):
-            script.decompose()
-
-        # HTMLタグを削除してテキストのみを取得
-        text = soup.get_text()
-
-        # 改行をスペースに置き換え
-        parsed_text = ' '.join(text.split())
+        parsed_text = parse_worker.parse_in_pool(content.kind, content.content)
 
         # パースされたテキストの文字数を出力
         print(f"パースされたテキストの文字数: {len(parsed_text)}")
@@ -193,12 +205,10 @@ def generate_opinion(content):
         opinion = openai_api_call(
             "gpt-3.5-turbo-1106",
             0.6,
-            [
-                {"role": "system", "content": f'あなたは"""{full_persona}"""です。提供された文章の内容に対し日本語で意見を生成してください。'},
-                {"role": "user", "content": content}
-            ],
+            prompt_builder.build_messages("opinion", content, "gpt-3.5-turbo-1106", 2000, extra=full_persona),
             2000,
-            {"type": "text"}
+            {"type": "text"},
+            stage="opinion"
         )
         opinion_with_name = f'{persona_name}: {opinion}'
         return opinion_with_name
@@ -210,151 +220,273 @@ def generate_opinion(content):
 
 
 
-    # スプレッドシートに書き出す
-@on_exception(expo, gspread.exceptions.APIError, max_tries=3)
-@on_exception(expo, gspread.exceptions.GSpreadException, max_tries=3)
-def write_to_spreadsheet(row):
-    if not SHEET_CLIENT:
-        logging.error("スプレッドシートのクライアントが初期化されていません。")
-        return False
+# ローカルのストアに書き出す（スプレッドシートには同期のスレッドがまとめて書き込む）
+def write_to_spreadsheet(row, text=None):
+    logging.info(f"ローカルのストアへの書き込みを開始: {row}")
+    # キーはB列のURL
+    record_store.write('inoreader_articles', row[1], row, url=row[1], text=text)
+    logging.info(f"ローカルのストアへの書き込みが成功: {row}")
+
+# メインのタスクの部分（書き込みまたはスキップで完了した場合はTrue、途中で失敗した場合は失敗した段階のStageErrorを送出する）
+def run_article(article_title, article_url, budget=None):
+    # 記事ごとの時間とコストの予算（Webhookの受信時に作ったものを受け取る）
+    budget = budget or pipeline_budget.ArticleBudget()
+    # 前回の試行で終わった段階はチェックポイントの出力を使う
+    checkpoint = checkpoint_store.ArticleCheckpoint(article_url)
+    # OpenAIの使用量を記事と記録元に紐づける
+    spend_ledger.set_article('inoreader', article_url)
+    # 予期しない例外が起きたときにStageErrorに記録する段階
+    stage = "fetch"
     try:
-        logging.info(f"スプレッドシートへの書き込みを開始: {row}")
-        # スプレッドシートの初期化
-        worksheet = SHEET_CLIENT
-
-        # スプレッドシートに指定行に挿入
-        worksheet.insert_row(row, 2)  # A2からD2に行を挿入
-
-        logging.info(f"スプレッドシートへの書き込みが成功: {row}")
-
-    except gspread.exceptions.APIError as e:
-        logging.warning(f"一時的なエラー、リトライ可能: {e}")
-        raise 
-
-    except gspread.exceptions.GSpreadException as e:
-        logging.error(f"致命的なエラー: {e}")
-        raise
-# メインのタスクの部分
-def heavy_task(article_title, article_url):
-    try:
-        # URLからコンテンツを取得し、パースする
-        content = fetch_content_from_url(article_url)
-        if content is None:
-            logging.warning(f"コンテンツが見つからない: {article_url}")
-            return
-
-        parsed_content = parse_content(content)
-        if parsed_content is None:
-            logging.warning(f"コンテンツのパースに失敗: {article_url}")
-            return
-
-        # parsed_contentが10000文字以下なら直接OpenAIに渡す
-        if len(parsed_content) <= 10000:
-            final_summary = openai_api_call(
-                "gpt-4-1106-preview",
+        parsed_content = checkpoint.get("parsed_text")
+        if not parsed_content:
+            # URLからコンテンツを取得し、パースする
+            try:
+                content = fetch_content_from_url(article_url)
+            except fetch_scheduler.PERMANENT_FETCH_ERRORS as e:
+                # robots.txtで禁止されている記事や対応していない形式の記事は再試行しても取得できない
+                logging.info(f"取得できない記事のためスキップします: {e}")
+                PROCESSED_INDEX.add(article_url)
+                return True
+            if content is None:
+                raise dead_letter.StageError("fetch", f"コンテンツが見つからない: {article_url}")
+
+            parsed_content = checkpoint.run("parsed_text", lambda: parse_content(content))
+            if parsed_content is None:
+                raise dead_letter.StageError("parse", f"コンテンツのパースに失敗: {article_url}")
+            admission.CONTROLLER.observe_text('inoreader', len(parsed_content))
+
+        # OpenAIを呼ぶ前に関連度を判定し、価値の低い記事はスキップまたは安いモデルで処理する
+        decision, _ = relevance_gate.evaluate(article_title, parsed_content)
+        if decision == 'skip':
+            PROCESSED_INDEX.add(article_url)
+            checkpoint.clear()
+            return True
+
+        # 同じ出来事の記事がすでにあれば、その記事の要約に出典としてまとめ、シートにはリーダーの記事へのリンクを書く
+        cluster = STORY_INDEX.assign(article_url, article_title, parsed_content)
+        if not cluster.leader:
+            stage = "write"
+            write_to_spreadsheet([article_title, article_url, story_clusters.leader_note(STORY_INDEX.leader(cluster.cluster_id)), ""], text=parsed_content)
+            PROCESSED_INDEX.add(article_url)
+            checkpoint.clear()
+            return True
+
+        stage = "summary"
+
+        final_summary = checkpoint.get("final_summary")
+        if not final_summary:
+            # 初期要約（refine）に時間が足りない場合は、本文を切り詰めて1回で要約する
+            if len(parsed_content) > 10000 and checkpoint.get("preliminary_summary") is None and not budget.can_afford("refine"):
+                budget.degrade("本文を切り詰めて1回で要約")
+                parsed_content = parsed_content[:pipeline_budget.SINGLE_SHOT_TEXT_LENGTH]
+
+            # parsed_contentが10000文字以下なら直接OpenAIに渡す（期限を過ぎたら途中までの出力を使う）
+            if len(parsed_content) <= 10000:
+                summary_input, summary_kind = parsed_content, "summarize_article"
+            else:
+                # 初期要約を生成
+                preliminary_summary = checkpoint.run("preliminary_summary", lambda: summarize_content(parsed_content))
+                if preliminary_summary is None:
+                    raise dead_letter.StageError("summary", f"コンテンツの要約に失敗: {article_url}")
+
+                # OpenAIを使用してさらに要約を洗練（期限を過ぎたら途中までの出力を使う）
+                summary_input, summary_kind = preliminary_summary, "refine_summary"
+
+            # 同じ出来事の記事が来ていれば、1回の呼び出しでまとめて要約する
+            sources = STORY_INDEX.sources(cluster.cluster_id)
+            if sources:
+                summary_input, summary_kind = story_clusters.merge_sources(article_title, article_url, summary_input, sources), "merge_sources"
+
+            # 入力の長さと予測スコアからモデルを選ぶ
+            summary_model = model_router.route("summary", prompt_builder.count_tokens(summary_input), 4000, decision)
+            messages = prompt_builder.build_messages(summary_kind, summary_input, summary_model, 4000)
+
+            summary_result = openai_streaming.stream_chat_completion(
+                summary_model,
                 0,
-                [
-                    {"role": "system", "content": "あなたは優秀な要約アシスタントです。提供された文章の内容を出来る限り残しつつ、日本語で要約してください。"},
-                    {"role": "user", "content": parsed_content}
-                ],
+                messages,
                 4000,
-                {"type": "text"}
+                total_timeout=budget.call_timeout(openai_streaming.TOTAL_TIMEOUT),
+                stage="final_summary"
             )
+            final_summary = summary_result.text
             if not final_summary:
-                logging.warning(f"要約の洗練に失敗: {article_url}")
-                return None
-        else:
-            # 初期要約を生成
-            preliminary_summary = summarize_content(parsed_content)
-            if preliminary_summary is None:
-                logging.warning(f"コンテンツの要約に失敗: {article_url}")
-                return
-
-            # OpenAIを使用してさらに要約を洗練
-            final_summary = openai_api_call(
-                "gpt-4-1106-preview",
+                raise dead_letter.StageError("final_summary", f"要約の洗練に失敗: {article_url}")
+            budget.charge(summary_model, messages, final_summary)
+            # 期限で途中までになった要約は使うが、チェックポイントには保存しない
+            checkpoint.save_result("final_summary", summary_result)
+
+        # リード文と意見はどちらも最終要約だけを入力にするので並行して生成する
+        def generate_lead(final_summary):
+            lead_sentence = checkpoint.get("lead")
+            if lead_sentence:
+                return lead_sentence
+            # リード文生成のためのOpenAI API呼び出し（余裕がなければ安いモデル、それもなければ省略）
+            lead_model = model_router.route("lead", prompt_builder.count_tokens(final_summary), 150, decision)
+            lead_messages = prompt_builder.build_messages("lead", final_summary, lead_model, 150)
+            lead_tokens = sum(prompt_builder.count_tokens(message["content"], lead_model) for message in lead_messages)
+            if lead_model != model_router.cheapest("lead") and not budget.can_afford("lead", lead_model, lead_tokens, 150):
+                budget.degrade("リード文を安いモデルで生成")
+                lead_model = model_router.cheapest("lead")
+                lead_messages = prompt_builder.build_messages("lead", final_summary, lead_model, 150)
+            if not budget.can_afford("lead_cheap"):
+                budget.degrade("リード文を省略")
+                return ""
+            try:
+                lead_result = openai_streaming.stream_chat_completion(
+                lead_model,
                 0,
-                [
-                    {"role": "system", "content": "あなたは優秀な要約アシスタントです。提供された文章の内容を出来る限り残しつつ、日本語で要約してください。テーマごとに分割してリスト形式にすることは行わないでください。"},
-                    {"role": "user", "content": preliminary_summary}
-                ],
-                4000,
-                {"type": "text"}
-            )
+                lead_messages,
+                150,  # リード文の最大トークン数を適宜設定
+                total_timeout=budget.call_timeout(openai_streaming.TOTAL_TIMEOUT),
+                stage="lead"
+                )
+                lead_sentence = lead_result.text
+                if not lead_sentence:
+                    logging.warning(f"リード文の生成に失敗: {article_url}")
+                    return "リード文の生成に失敗しました。"
+                budget.charge(lead_model, lead_messages, lead_sentence)
+                checkpoint.save_result("lead", lead_result)
+                return lead_sentence
+            except Exception as e:
+                logging.error(f"リード文生成中にエラーが発生: {e}")
+                return "リード文の生成中にエラーが発生しました。"
+
+        # ThreadPoolExecutorを使用して意見を並列生成（余裕がなければ省略）
+        def generate_opinions(final_summary):
+            opinions = checkpoint.get("opinions") or []
+            if opinions:
+                return opinions
+            if not budget.can_afford("opinions"):
+                budget.degrade("意見の生成を省略")
+                return []
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, generate_opinion, final_summary) for _ in range(3)]
+
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result.startswith("エラーが発生しました"):
+                        logging.warning(f"意見生成中にエラーが発生: {result}")
+                    else:
+                        opinions.append(result)
+
+            if not opinions:
+                logging.warning(f"すべての意見生成関数がエラーをスローしました: {article_url}")
+            else:
+                checkpoint.save("opinions", opinions)
+            return opinions
+
+        # どちらも失敗や期限切れで記事全体を落とさない（空のまま書き込む）
+        stage = "lead_opinions"
+        stage_timeout = max(budget.remaining_seconds(), 1)
+        graph = stage_graph.StageGraph(article_url)
+        graph.add("lead", generate_lead, inputs=("final_summary",), timeout=stage_timeout, optional=True)
+        graph.add("opinions", generate_opinions, inputs=("final_summary",), timeout=stage_timeout, optional=True)
+        outputs = graph.run({"final_summary": final_summary})
+        lead_sentence = outputs.get("lead") or ""
+        opinions = outputs.get("opinions") or []
 
-            if not final_summary:
-                logging.warning(f"要約の洗練に失敗: {article_url}")
-            return None
-        
-        # リード文生成のためのOpenAI API呼び出し
-        try:
-            lead_sentence = openai_api_call(
-            "gpt-4",
-            0,
-            [
-                {"role": "system", "content": "あなたは優秀なライターです。この要約のリード文（導入部）を簡潔に1～2センテンス程度でで作成してください。"},
-                {"role": "user", "content": final_summary}
-            ],
-            150,  # リード文の最大トークン数を適宜設定
-            {"type": "text"}
-            )
-            if not lead_sentence:
-                logging.warning(f"リード文の生成に失敗: {article_url}")
-                lead_sentence = "リード文の生成に失敗しました。"
-        except Exception as e:
-            logging.error(f"リード文生成中にエラーが発生: {e}")
-            lead_sentence = "リード文の生成中にエラーが発生しました。"
-        
-        
-        # ThreadPoolExecutorを使用して意見を並列生成
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            futures = [executor.submit(generate_opinion, final_summary) for _ in range(3)]
-
-            opinions = []
-            for future in as_completed(futures):
-                result = future.result()
-                if result.startswith("エラーが発生しました"):
-                    logging.warning(f"意見生成中にエラーが発生: {result}")
-                else:
-                    opinions.append(result)
-
-        if not opinions:
-            logging.warning(f"すべての意見生成関数がエラーをスローしました: {article_url}")
-
-        
         # スプレッドシートに書き込む準備
         spreadsheet_content = [article_title, article_url, final_summary, lead_sentence] + opinions
 
         # スプレッドシートに書き込む
-        write_to_spreadsheet(spreadsheet_content)
-        logging.info(f"処理完了: {article_url}")
-
+        stage = "write"
+        write_to_spreadsheet(spreadsheet_content, text=parsed_content)
+        PROCESSED_INDEX.add(article_url)
+        STORY_INDEX.mark_summarized(cluster.cluster_id)
+        checkpoint.clear()
+        logging.info(f"処理完了: {article_url}" + (f"（省略・縮退: {', '.join(budget.degraded)}）" if budget.degraded else ""))
+        return True
+
+    except dead_letter.StageError:
+        raise
     except Exception as e:
         logging.error(f"{article_url} の処理中にエラーが発生: {e}")
         traceback.print_exc()
+        raise dead_letter.StageError(stage, f"{article_url} の処理中にエラーが発生: {e}") from e
+    finally:
+        # 書き込みまで到達しなかった記事は次回また処理できるようにする
+        PROCESSED_INDEX.release(article_url)
+
+# 記事を処理し、失敗した場合はデッドレターに記録してFalseを返す関数（Webhookのスレッドとdead_letter_sweeper.pyの再処理で使う）
+def heavy_task(article_title, article_url, budget=None):
+    try:
+        return run_article(article_title, article_url, budget)
+    except dead_letter.StageError as e:
+        logging.warning(str(e))
+        dead_letter.record('inoreader', article_url, e.stage, e, title=article_title)
+        return False
+
+# デッドレターに記録された記事を再処理する関数（dead_letter_sweeper.pyから呼ばれる）
+def redrive_dead_letter(letter):
+    if not PROCESSED_INDEX.claim(letter['url']):
+        # 処理済み、またはこのプロセスで処理中
+        return PROCESSED_INDEX.contains(letter['url'])
+    return heavy_task(letter['title'], letter['url'])
+
+# 受け付けた記事を処理し、書き込んだ行をスプレッドシートに同期してから受付の枠を返す関数
+def run_admitted_task(title, url, budget, ticket):
+    try:
+        heavy_task(title, url, budget)
+        record_store.flush()
+    except record_store.MirrorFlushError as e:
+        logging.error(f"スプレッドシートへの同期が終わりませんでした: {url}: {e}")
+    finally:
+        spend_ledger.flush()
+        admission.CONTROLLER.finish(ticket)
+
+# 共通の処理キューから記事を1件処理する関数（pubsub_consumer.pyから呼ばれる。失敗の記録はpubsub_consumer.pyが行う）
+def process_article(title, url, metadata=None):
+    if fetch_scheduler.is_skipped_url(url):
+        return True
+    # 処理済み、または処理中の記事はスキップする
+    if not PROCESSED_INDEX.claim(url):
+        logging.info(f"処理済みの記事です: {url}")
+        return True
+    return run_article(title, url)
 
 @functions_framework.http
 def process_inoreader_update(request):
     request_json = request.get_json()
 
     if request_json and 'items' in request_json:
-        for item in request_json['items']:
-            article_title = escape(item.get('title', ''))
-            article_href = escape(item['canonical'][0]['href']) if 'canonical' in item and item['canonical'] else ''
+        items = ingestion.inoreader_news_items(request_json)
+
+        # 共通の処理キューがある場合はキューに送り、他の入口と同じ重複除去と同時実行数の制御を使う
+        if ingestion.INGEST_TOPIC:
+            queue = ingestion.get_queue()
+            queue.put_many(items)
+            queue.flush()
+            return '記事の更新を受け取りました', 200
+
+        deferred = 0
+        for item in items:
+            # ドメインルールでスキップ対象のURLを除外する（news.google.comなど）
+            if fetch_scheduler.is_skipped_url(item.url):
+                logging.info(f"スキップするドメインのURLです: {item.url}")
+                continue
 
+            # 処理済み、または処理中の記事はスキップする
+            if not PROCESSED_INDEX.claim(item.url):
+                logging.info(f"処理済みの記事です: {item.url}")
+                continue
 
-            # news.google.comを含むURLをスキップする
-            if 'news.google.com' in article_href:
-                logging.info(f"news.google.comのURLはスキップされます: {article_href}")
+            # 負荷が高い間は優先度の低い記事を後回しにするか捨てる
+            decision, ticket = admission.CONTROLLER.admit(item.source, item.title, item.url, item.metadata)
+            if decision != 'admit':
+                PROCESSED_INDEX.release(item.url)
+                if decision == 'defer':
+                    deferred += 1
                 continue
 
-            if article_title and article_href:
-                # 重い処理を非同期で実行するために別のスレッドを起動
-                thread = threading.Thread(target=heavy_task, args=(article_title, article_href))
-                thread.start()
+            # 重い処理を非同期で実行するために別のスレッドを起動
+            thread = threading.Thread(target=run_admitted_task, args=(item.title, item.url, pipeline_budget.ArticleBudget(), ticket))
+            thread.start()
+        # 後回しにした記事はInoreaderに送り直してもらう（受け付けた記事は送り直されても処理済みとしてスキップする）
+        if deferred:
+            return f'負荷が高いため{deferred}件の記事を後で送り直してください', 503, {'Retry-After': str(admission.ADMISSION_RETRY_AFTER_SECONDS)}
         # メインスレッドでは即座に応答を返す
         return '記事の更新を受け取りました', 200
     else:
         return '適切なデータがリクエストに含まれていません', 400
-         
-
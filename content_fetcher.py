@@ -11,10 +11,13 @@ from google.cloud import pubsub_v1
 from gspread import service_account_from_dict
 from html2text import html2text
 from openai import OpenAI, AsyncOpenAI
-from urllib.parse import urlparse
 import gspread
 import openai
 import time
+import document_extractor
+import fetch_scheduler
+import prompt_builder
+import spend_ledger
 
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,8 +26,6 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID') 
 GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-#　スクレイピングできなさそうなところ、できないものを追加しておく。
-EXCLUDED_DOMAINS = ['github.com', 'youtube.com', 'wikipedia.org']
 
 def init_openai():
   return OpenAI(api_key=OPENAI_API_KEY)
@@ -48,7 +49,7 @@ async_client = AsyncOpenAI()
 
 async def fetch_content_from_url(url):
     try:
-        logging.INFO(f"URLからコンテンツの取得を開始: {url}")
+        logging.info(f"URLからコンテンツの取得を開始: {url}")
 
         # ユーザーエージェントを設定
         headers = {
@@ -57,19 +58,25 @@ async def fetch_content_from_url(url):
 
         async with aiohttp.ClientSession(headers=headers) as session:
             async with session.get(url, timeout=100) as response:
-                content = await response.text()
+                # Content-Typeで振り分け、対応していない形式は本文を読まずに断る
+                download = document_extractor.DocumentDownload(url, response.headers.get('Content-Type'), response.headers.get('Content-Length'))
+                async for chunk in response.content.iter_chunked(document_extractor.CHUNK_SIZE):
+                    if not download.feed(chunk):
+                        break
 
-            logging.INFO(f"URLからコンテンツの取得が成功: {url}")
-            return content
+            logging.info(f"URLからコンテンツの取得が成功: {url}")
+            return download.document()
 
     except Exception as e:
         logging.error(f"URLからのコンテンツ取得中にエラーが発生しました: {e}")
         raise
 
-async def openai_api_call(model, temperature, messages, max_tokens, response_format):
+async def openai_api_call(model, temperature, messages, max_tokens, response_format, stage="other"):
     try:
         # OpenAI API呼び出しを行う非同期関数
         response = await async_client.chat.completions.create(model=model, temperature=temperature, messages=messages, max_tokens=max_tokens, response_format=response_format)
+        # 使用量を支出の台帳に記録する
+        spend_ledger.record_usage(model, stage, response.usage)
         return response.choices[0].message.content  # 辞書型アクセスから属性アクセスへ変更
     except Exception as e:
         logging.error(f"OpenAI API呼び出し中にエラーが発生しました: {e}")
@@ -80,13 +87,11 @@ async def summarize_content(content):
         summary = await openai_api_call(
         "gpt-3.5-turbo-1106",
         0,
-        [
-            {"role": "system", "content": f'あなたは優秀な要約アシスタントです。"""{content}"""の内容をできる限り多くの情報を残しながら日本語で要約して出力してください。'},
-            {"role": "user", "content": content}
-        ],
+        prompt_builder.build_messages("summarize", content, "gpt-3.5-turbo-1106", 2800),
         2800,
         # タイプ指定をサボらない
-        { "type": "text" }
+        { "type": "text" },
+        stage="summary"
         )
         return summary
     except Exception as e:
@@ -94,57 +99,6 @@ async def summarize_content(content):
         traceback.print_exc()
         return ""
 
-paramater = '''
-{
-    "properties": {
-        "importance": {
-            "type": "integer",
-            "description": "How impactful the topic of the article is. Scale: 0-10."
-        },
-        "timeliness": {
-            "type": "integer",
-            "description": "How relevant the information is to current events or trends. Scale: 0-10."
-        },
-        "objectivity": {
-            "type": "integer",
-            "description": "Whether the information is presented without bias or subjective opinion. Scale: 0-10."
-        },
-        "originality": {
-            "type": "integer",
-            "description": "The novelty or uniqueness of the content. Scale: 0-10."
-        },
-        "target_audience": {
-            "type": "integer",
-            "description": "How well the content is adjusted for a specific audience. Scale: 0-10."
-        },
-        "diversity": {
-            "type": "integer",
-            "description": "Reflection of different perspectives or cultures. Scale: 0-10."
-        },
-        "relation_to_advertising": {
-            "type": "integer",
-            "description": "If the content is biased due to advertising. Scale: 0-10."
-        },
-        "security_issues": {
-            "type": "integer",
-            "description": "Potential for raising security concerns. Scale: 0-10."
-        },
-        "social_responsibility": {
-            "type": "integer",
-            "description": "How socially responsible the content presentation is. Scale: 0-10."
-        },
-        "social_significance": {
-            "type": "integer",
-            "description": "The social impact of the content. Scale: 0-10."
-        }
-        "reason": {
-        "type": "string",
-        "description": "the basis for each numerical score. Output in 1-sentence Japanese with respect to all parameters"
-        }
-    },
-    "required": ["importance", "timeliness", "objectivity", "originality", "target_audience", "diversity", "relation_to_advertising", "security_issues", "social_responsibility", "social_significance", "reason"]
-}
-'''
     
 
 async def generate_score(summary):
@@ -152,12 +106,10 @@ async def generate_score(summary):
         score = await openai_api_call(
             "gpt-3.5-turbo-1106",
             0,
-            [
-                {"role": "system", "content": f'あなたは優秀な先進技術メディアのキュレーターです。信頼性,最新性,重要性,革新性,影響力,関連性,包括性,教育的価値,時事性,倫理性をもとに、"""{summary}"""を10点満点でスコアリングして、JSON形式で返します。平均点は5点でスコアを付けるようにしてください。"""{paramater}"""のJSON形式で返してください。'},
-                {"role": "user", "content": summary}
-            ],
+            prompt_builder.build_messages("score", summary, "gpt-3.5-turbo-1106", 4000),
             4000,
-            { "type":"json_object" }
+            { "type":"json_object" },
+            stage="score"
             )
         return score
     except Exception as e:
@@ -174,9 +126,8 @@ async def generate_textual_content(content):
     score = await generate_score(summary)
     score_json = json.loads(score)
     #それぞれの内容を取得
-    keys = ["importance", "timeliness", "objectivity", "originality", "target_audience", "diversity",  "relation_to_advertising", "security_issues", "social_responsibility", "social_significance"]
     #scoresはスコアの中身全部のこと
-    scores = [str(score_json[key]) for key in keys]
+    scores = [str(score_json[key]) for key in prompt_builder.SCORE_KEYS]
     reason = score_json["reason"]
     #それぞれの内容を返す。
     return summary, *scores, reason
@@ -186,27 +137,25 @@ async def generate_textual_content(content):
 def write_to_sheet_with_retry(row):
     time.sleep(1)  # 1秒スリープを追加
     try:
-        logging.INFO("Googleスプレッドシートへの書き込みを開始")
-        sheet.insert_row(row, index=2)
-        logging.INFO("Googleスプレッドシートへの書き込みが成功")
+        logging.info("Googleスプレッドシートへの書き込みを開始")
+        # 行の挿入はシート全体をずらすので末尾に追記する
+        sheet.append_row(row)
+        logging.info("Googleスプレッドシートへの書き込みが成功")
     except Exception as e:
         logging.error(f"Googleスプレッドシートへの書き込み中にエラーが発生しました: {e}")
         raise
 
 # Function to process content and write it to the sheet
 async def process_and_write_content(title, url):
-    # URLからドメインを解析
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc
-
-    # 特定のドメインをチェックしてスキップ
-    if any(excluded_domain in domain for excluded_domain in ['github.com', 'youtube.com', 'wikipedia.org']):
-        logging.INFO(f"処理をスキップ: {title} ({url}) は除外されたドメインに属しています。")
+    # ドメインルールでスキップ対象かチェック
+    if fetch_scheduler.is_skipped_url(url):
+        logging.info(f"処理をスキップ: {title} ({url}) は除外されたドメインに属しています。")
         return
 
-    logging.INFO(f"コンテンツ処理が開始されました: タイトル={title}, URL={url}")
-    html_content = await fetch_content_from_url(url)
-    text_content = html2text(html_content)
+    logging.info(f"コンテンツ処理が開始されました: タイトル={title}, URL={url}")
+    document = await fetch_content_from_url(url)
+    # PDFとプレーンテキストは取り出したテキストをそのまま使う
+    text_content = html2text(document.content) if document.kind == 'html' else document.content
     summary, scores, reason = await generate_textual_content(text_content)
     # 時刻
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
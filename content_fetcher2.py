@@ -1,23 +1,34 @@
+import importlib
 import json
 import logging
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
-from backoff import expo, on_exception
-from google.cloud import pubsub_v1
-from html2text import html2text
 from openai import OpenAI
 from urllib.parse import urlparse
 import gspread
-import time
 import traceback
-import requests
-from bs4 import BeautifulSoup
 from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
+from langchain.callbacks import get_openai_callback
 from langchain.chains.summarize import load_summarize_chain
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.docstore.document import Document
+import admission
+import checkpoint_store
+import dead_letter
+import fetch_scheduler
+import processed_index
+import headline_batch
+import parse_worker
+import record_store
+import relevance_gate
+import resilience
+import spend_ledger
+import stage_graph
+import story_clusters
+import prompt_builder
+import openai_streaming
+import model_router
 
 
 
@@ -27,7 +38,6 @@ from langchain.docstore.document import Document
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')  
 GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')   
 OPENAI_api_key = os.getenv('OPENAI_API_KEY')
-EXCLUDED_DOMAINS = ['github.com', 'youtube.com', 'wikipedia.org', 'twitter.com', 'www.youtube.com']
 
 # プロンプトテンプレートの定義
 refine_first_template = """以下の文章は、長い記事をチャンクで分割したものの冒頭の文章です。それを留意し、次の文章の内容と結合することを留意したうえで以下の文章をテーマ毎にまとめて下さい。
@@ -44,7 +54,8 @@ refine_template = """下記の文章は、長い記事をチャンクで分割
 """
 refine_first_prompt = PromptTemplate(input_variables=["text"],template=refine_first_template)
 refine_prompt = PromptTemplate(input_variables=["existing_answer", "text"],template=refine_template)
-llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo-16k")
+# 再試行の回数は他のOpenAIの呼び出しとそろえる
+llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo-16k", max_retries=resilience.RETRY_MAX_ATTEMPTS - 1)
 # 要約チェーンの初期化
 refine_chain = load_summarize_chain(
     llm=llm,
@@ -74,17 +85,31 @@ def init_gspread():
 
 
 SHEET_CLIENT = init_gspread()
+# 書き込みはローカルのストアに行い、シートにはバックグラウンドで同期する（キーはB列のURL）
+record_store.register_sheet('articles', SHEET_CLIENT, 2)
+# 英語のタイトルはまとめて日本語の見出しにする（F列）
+headline_batch.register('articles')
+# 処理済みURLのインデックス（B列のURLを一括で読み込む）
+PROCESSED_INDEX = processed_index.ProcessedIndex(SHEET_CLIENT, 2, 'articles')
+# 同じ出来事の記事をまとめるクラスタ
+STORY_INDEX = story_clusters.StoryIndex('articles')
 
 # OpenAIの同期クライアント初期化  
 def init_openai():
-  return OpenAI(api_key=OPENAI_api_key)
+  # 再試行はresilience.pyで行う
+  return OpenAI(api_key=OPENAI_api_key, max_retries=0)
 
-# OpenAI API呼び出し関数
-def openai_api_call(model, temperature, messages, max_tokens, response_format):
+# OpenAI API呼び出し関数（stageは支出の台帳に記録する段階）
+def openai_api_call(model, temperature, messages, max_tokens, response_format, stage="other"):
+    spend_ledger.throttle(stage)
     client = init_openai() 
     try:
         # OpenAI API呼び出しを行う
-        response = client.chat.completions.create(model=model, temperature=temperature, messages=messages, max_tokens=max_tokens, response_format=response_format)
+        raw_response = resilience.call('openai', client.chat.completions.with_raw_response.create, model=model, temperature=temperature, messages=messages, max_tokens=max_tokens, response_format=response_format)
+        # レート制限の残りをモデルの選択に使う
+        model_router.record_rate_limits(model, raw_response.headers)
+        response = raw_response.parse()
+        spend_ledger.record_usage(model, stage, response.usage)
         return response.choices[0].message.content  # 辞書型アクセスから属性アクセスへ変更
     except Exception as e:
         logging.error(f"OpenAI API呼び出し中にエラーが発生しました: {e}")
@@ -101,8 +126,12 @@ def summarize_content(content):
         )
         texts = text_splitter.create_documents([content])
 
-        # 要約チェーンを実行
-        result = refine_chain({"input_documents": texts}, return_only_outputs=True)
+        # 要約チェーンを実行（チェーン内の呼び出しの使用量をまとめて記録する）
+        spend_ledger.throttle("refine")
+        with get_openai_callback() as callback:
+            # OpenAIの障害中はチェーンを呼ばずにすぐ失敗させる（再試行はチェーンの中で行う）
+            result = resilience.call('openai', refine_chain, {"input_documents": texts}, return_only_outputs=True, max_attempts=1)
+        spend_ledger.record_tokens(llm.model_name, "refine", callback.prompt_tokens, callback.completion_tokens)
 
         # 要約されたテキストを結合して返す
         return result["output_text"]
@@ -111,71 +140,18 @@ def summarize_content(content):
         traceback.print_exc()
         return ""
 
-# パラメーターを書き出す
-parameter = '''
-{
-    "properties": {
-        "importance": {
-            "type": "integer",
-            "description": "How impactful the topic of the article is. Scale: 0-10."
-        },
-        "timeliness": {
-            "type": "integer",
-            "description": "How relevant the information is to current events or trends. Scale: 0-10."
-        },
-        "objectivity": {
-            "type": "integer",
-            "description": "Whether the information is presented without bias or subjective opinion. Scale: 0-10."
-        },
-        "originality": {
-            "type": "integer",
-            "description": "The novelty or uniqueness of the content. Scale: 0-10."
-        },
-        "target_audience": {
-            "type": "integer",
-            "description": "How well the content is adjusted for a specific audience. Scale: 0-10."
-        },
-        "diversity": {
-            "type": "integer",
-            "description": "Reflection of different perspectives or cultures. Scale: 0-10."
-        },
-        "relation_to_advertising": {
-            "type": "integer",
-            "description": "If the content is biased due to advertising. Scale: 0-10."
-        },
-        "security_issues": {
-            "type": "integer",
-            "description": "Potential for raising security concerns. Scale: 0-10."
-        },
-        "social_responsibility": {
-            "type": "integer",
-            "description": "How socially responsible the content presentation is. Scale: 0-10."
-        },
-        "social_significance": {
-            "type": "integer",
-            "description": "The social impact of the content. Scale: 0-10."
-        }
-        "reason": {
-        "type": "string",
-        "description": "the basis for each numerical score. Output in 1-sentence Japanese with respect to all parameters"
-        }
-    },
-    "required": ["importance", "timeliness", "objectivity", "originality", "target_audience", "diversity", "relation_to_advertising", "security_issues", "social_responsibility", "social_significance", "reason"]
-}
-'''
-
 # スコアを書き出す
 def generate_score(summary):
     try:
-        score = openai_api_call(
-            "gpt-3.5-turbo-1106",
-            0,
-            [
-                {"role": "system", "content": f'あなたは優秀な先進技術メディアのキュレーターです。信頼性,最新性,重要性,革新性,影響力,関連性,包括性,教育的価値,時事性,倫理性をもとに、"""{summary}"""を10点満点でスコアリングして、JSON形式で返します。平均点は5点でスコアを付けるようにしてください。"""{parameter}"""のJSON形式で返してください。'},
-                {"role": "user", "content": summary}
-            ],
-            4000,
-            { "type":"json_object" }
+        # 安いモデルで採点し、JSONが不正な場合だけ上位のモデルで採点し直す
+        messages = prompt_builder.build_messages("score", summary, model_router.cheapest("score"), 4000)
+        input_tokens = sum(prompt_builder.count_tokens(message["content"]) for message in messages)
+        score = model_router.cascade(
+            "score",
+            lambda model: openai_api_call(model, 0, messages, 4000, { "type":"json_object" }, stage="score"),
+            prompt_builder.is_valid_score,
+            input_tokens,
+            4000
             )
         score_json = json.loads(score)
         # 応答を整形して返す
@@ -186,45 +162,20 @@ def generate_score(summary):
         traceback.print_exc()
         return ""
     
-# スプレッドシートに書き出す
-@on_exception(expo, gspread.exceptions.APIError, max_tries=3)
-@on_exception(expo, gspread.exceptions.GSpreadException, max_tries=3)
-def write_to_spreadsheet(row):
-    if not SHEET_CLIENT:
-        logging.error("スプレッドシートのクライアントが初期化されていません。")
-        return False
-    time.sleep(1)  # 1秒スリープを追加
-    try:
-        logging.info(f"スプレッドシートへの書き込みを開始: {row}")
-        # スプレッドシートの初期化
-        worksheet = SHEET_CLIENT
-
-        # スプレッドシートに書き込み
-        worksheet.append_row(row)
+# ローカルのストアに書き出す（スプレッドシートには同期のスレッドがまとめて書き込む）
+def write_to_spreadsheet(row, text=None):
+    logging.info(f"ローカルのストアへの書き込みを開始: {row}")
+    # キーはB列のURL
+    record_store.write('articles', row[1], row, url=row[1], text=text)
+    logging.info(f"ローカルのストアへの書き込みが成功: {row}")
 
-        logging.info(f"スプレッドシートへの書き込みが成功: {row}")
-
-    except gspread.exceptions.APIError as e:
-        logging.warning(f"一時的なエラー、リトライ可能: {e}")
-        raise 
-
-    except gspread.exceptions.GSpreadException as e:
-        logging.error(f"致命的なエラー: {e}")
-        raise
-
-    
 # URLからコンテンツを取得する関数
 def fetch_content_from_url(url):
     try:
         logging.info(f"URLからコンテンツの取得を開始: {url}")
 
-        # ユーザーエージェントを設定
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-
-        response = requests.get(url, headers=headers, timeout=100)
-        content = response.text
+        # ホストごとの同時接続数やcrawl-delayはスケジューラ側で制御する
+        content = fetch_scheduler.SCHEDULER.fetch(url)
 
         logging.info(f"URLからコンテンツの取得が成功: {url}")
         return content
@@ -233,39 +184,184 @@ def fetch_content_from_url(url):
         logging.warning(f"URLからのコンテンツ取得中にエラーが発生しました: {e}")
         raise
 
-#　コンテンツをパースする関数 
-def parse_content(content):
+# 1記事分の処理を行う関数（書き込みまたはスキップで完了した場合はTrue、途中で失敗した場合はStageErrorなどを送出する）
+def process_article(title, url, metadata=None):
+    # URLの確認
+    if title and url:
+    # ドメインルールでスキップ対象かチェック
+        if fetch_scheduler.is_skipped_url(url):
+            logging.info(f"スキップするドメインです。: {urlparse(url).netloc}")
+            return True
+    else:
+        logging.warning(f"タイトルまたはURLがありません。: {title}, {url}")
+        return True
+    # 処理済み、または処理中の記事はスキップ
+    if not PROCESSED_INDEX.claim(url):
+        logging.info(f"処理済みの記事です。: {url}")
+        return True
     try:
-        # HTMLコンテンツをBeautiful Soupでパース
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # ヘッダーとフッターを削除（もし存在する場合）
-        header = soup.find('header')
-        if header:
-            header.decompose()
-
-        footer = soup.find('footer')
-        if footer:
-            footer.decompose()
+        return process_claimed_article(title, url, metadata)
+    finally:
+        PROCESSED_INDEX.release(url)
+
+# 記事を処理し、失敗した場合はデッドレターに記録する関数
+# 記録できた記事はdead_letter_sweeper.pyが再処理するのでFalseを返して関数を正常に終わらせ、Pub/Subには再配信させない。
+# 記録できなかった場合だけ例外を送出し、Pub/Subの再試行に任せる
+def handle_article(title, url, news_data=None):
+    try:
+        return process_article(title, url, news_data)
+    except dead_letter.StageError as e:
+        logging.warning(str(e))
+        if not dead_letter.record('hn_article', url, e.stage, e, title=title, payload=news_data):
+            raise
+        return False
+    except Exception as e:
+        logging.error(f"記事の処理中にエラーが発生しました: {url}: {e}")
+        if not dead_letter.record('hn_article', url, 'process', e, title=title, payload=news_data):
+            raise
+        return False
 
-        # JavaScriptとCSSを削除
-        for script in soup(["script", "style"]):
-            script.decompose()
+# デッドレターに記録された記事を再処理する関数（dead_letter_sweeper.pyから呼ばれる）
+def redrive_dead_letter(letter):
+    try:
+        return handle_article(letter['title'], letter['url'], letter['payload'])
+    except Exception as e:
+        logging.error(f"記事の再処理中にエラーが発生しました: {letter['url']}: {e}")
+        return False
 
-        # HTMLタグを削除してテキストのみを取得
-        text = soup.get_text()
+# 確保済みの記事を取得から書き込みまで処理する関数（段階の失敗はStageErrorを送出する）
+def process_claimed_article(title, url, metadata=None):
+    # 前回の試行で終わった段階はチェックポイントの出力を使う
+    checkpoint = checkpoint_store.ArticleCheckpoint(url)
+    # OpenAIの使用量を記事と記録元に紐づける
+    spend_ledger.set_article((metadata or {}).get('source', 'hn'), url)
 
-        # 改行をスペースに置き換え
-        parsed_text = ' '.join(text.split())
+    parsed_content = checkpoint.get("parsed_text")
+    if not parsed_content:
+        # コンテンツを取得
+        try:
+            content = fetch_content_from_url(url)
+        except fetch_scheduler.PERMANENT_FETCH_ERRORS as e:
+            # robots.txtで禁止されている記事や対応していない形式の記事は再試行しても取得できない
+            logging.info(f"取得できない記事のためスキップします。: {e}")
+            PROCESSED_INDEX.add(url)
+            return True
+        if not content:
+            raise dead_letter.StageError("fetch", f"コンテンツがありません。: {url}")
+
+        # コンテンツをパース（content_fetch_1201.pyと同じくparse_worker.pyのプロセスプールで実行する）
+        try:
+            parsed_content = checkpoint.run("parsed_text", lambda: parse_worker.parse_in_pool(content.kind, content.content))
+        except Exception as e:
+            raise dead_letter.StageError("parse", f"コンテンツのパース中にエラーが発生しました。: {url}: {e}") from e
+        logging.info(f"パースされたテキストの文字数: {len(parsed_content or '')}")
+        if not parsed_content:
+            raise dead_letter.StageError("parse", f"コンテンツのパースに失敗しました。: {url}")
+        admission.CONTROLLER.observe_text((metadata or {}).get('source', 'hn'), len(parsed_content))
+
+    # OpenAIを呼ぶ前に関連度を判定し、価値の低い記事はスキップまたは安いモデルで処理する
+    decision, _ = relevance_gate.evaluate(title, parsed_content, metadata)
+    if decision == 'skip':
+        PROCESSED_INDEX.add(url)
+        checkpoint.clear()
+        return True
+
+    # 同じ出来事の記事がすでにあれば、その記事の要約に出典としてまとめ、シートにはリーダーの記事へのリンクを書く
+    # （リーダーの要約の後に来た記事も失われない。スコアは空なのでscore_ranking.pyの投稿候補にはならない）
+    cluster = STORY_INDEX.assign(url, title, parsed_content)
+    if not cluster.leader:
+        written_at = (datetime.utcnow() + timedelta(hours=9)).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            write_to_spreadsheet([title, url, story_clusters.leader_note(STORY_INDEX.leader(cluster.cluster_id)), "", written_at], text=parsed_content)
+        except Exception as e:
+            raise dead_letter.StageError("write", f"スプレッドシートへの書き込みに失敗しました。: {url}: {e}") from e
+        PROCESSED_INDEX.add(url)
+        checkpoint.clear()
+        return True
+
+    # LangChainで初期要約
+    def summarize():
+        preliminary_summary = checkpoint.run("preliminary_summary", lambda: summarize_content(parsed_content))
+        if not preliminary_summary:
+            raise dead_letter.StageError("summary", f"要約に失敗しました。: {url}")
+        return preliminary_summary
+
+    # OpenAI APIを使用してさらに整形（期限を過ぎたら途中までの出力を使う）
+    def condense(preliminary_summary):
+        # 初期要約の間に同じ出来事の記事が来ていれば、1回の呼び出しでまとめて要約する
+        sources = STORY_INDEX.sources(cluster.cluster_id)
+        if sources:
+            kind, summary_input = "merge_sources", story_clusters.merge_sources(title, url, preliminary_summary, sources)
+        else:
+            kind, summary_input = "condense", preliminary_summary
+        # 要約の長さと予測スコアからモデルを選ぶ
+        final_model = model_router.route("summary", prompt_builder.count_tokens(summary_input), 2800, decision)
+        return openai_streaming.stream_chat_completion(
+            final_model,
+            0,
+            prompt_builder.build_messages(kind, summary_input, final_model, 2800),
+            2800,
+            stage="final_summary"
+        )
 
-        # パースされたテキストの文字数を出力
-        print(f"パースされたテキストの文字数: {len(parsed_text)}")
+    def finalize(preliminary_summary):
+        # 期限で途中までになった要約は使うが、チェックポイントには保存しない
+        final_summary = checkpoint.run("final_summary", lambda: condense(preliminary_summary))
+        if not final_summary:
+            raise dead_letter.StageError("final_summary", f"最終的な要約の整形に失敗しました。: {url}")
+        return final_summary
 
-        return parsed_text
+    # スコアを生成（最終要約を待たずに初期要約で採点する）
+    def score_summary(preliminary_summary):
+        score = checkpoint.run("score", lambda: generate_score(preliminary_summary))
+        if not score:
+            raise dead_letter.StageError("score", f"スコアの生成に失敗しました。: {url}")
+        return score
+
+    # 最終要約とスコアは初期要約だけを入力にするので並行して実行する
+    graph = stage_graph.StageGraph(url)
+    graph.add("preliminary_summary", summarize)
+    graph.add("final_summary", finalize, inputs=("preliminary_summary",))
+    graph.add("score", score_summary, inputs=("preliminary_summary",))
+    outputs = graph.run()
+    for name in ("preliminary_summary", "final_summary", "score"):
+        error = outputs.errors.get(name)
+        if error and not isinstance(error, stage_graph.UpstreamError):
+            raise error
+    final_summary, score = outputs.get("final_summary"), outputs.get("score")
+
+    # スプレッドシートに書き込み
+    try:
+        # E列の日付（日本時間）はscore_ranking.pyの順位付けの期間と減衰に使う
+        written_at = (datetime.utcnow() + timedelta(hours=9)).strftime('%Y-%m-%d %H:%M:%S')
+        write_to_spreadsheet([title, url, final_summary, score, written_at], text=parsed_content)
+    except Exception as e:
+        raise dead_letter.StageError("write", f"スプレッドシートへの書き込みに失敗しました。: {url}: {e}") from e
+    PROCESSED_INDEX.add(url)
+    STORY_INDEX.mark_summarized(cluster.cluster_id)
+    checkpoint.clear()
+    # ログを出力
+    logging.info(f"コンテンツの処理が完了: {url}")
+    return True
+
+# このパイプライン以外で処理する記録元（共通の処理キューの記事。pubsub_consumer.pyと同じ振り分け）
+OTHER_PIPELINES = {
+    "inoreader": ("content_fetch_1201", "inoreader"),
+}
 
+# 他のパイプラインの記事を処理し、失敗した場合はそのパイプラインのデッドレターに記録する関数
+# （ackして捨てないように、知らない記録元と記録できなかった失敗は例外を送出してPub/Subに再試行させる）
+def handle_other_source(source, title, url, news_data):
+    if source not in OTHER_PIPELINES:
+        raise ValueError(f"処理するパイプラインがない記録元です。: {source}")
+    module_name, dead_letter_source = OTHER_PIPELINES[source]
+    try:
+        return importlib.import_module(module_name).process_article(title, url, news_data)
     except Exception as e:
-        logging.warning(f"コンテンツのパース中にエラーが発生しました: {e}")
-        return ""
+        logging.error(f"記事の処理中にエラーが発生しました: {url}: {e}")
+        if not dead_letter.record(dead_letter_source, url, getattr(e, 'stage', 'process'), e, title=title, payload=news_data):
+            raise
+        return False
 
 # メイン関数
 def main(event, context):
@@ -274,59 +370,17 @@ def main(event, context):
         news_data = json.loads(base64.b64decode(event['data']).decode('utf-8'))
         title = news_data.get('title')
         url = news_data.get('url')
-        # URLの確認
-        if title and url:
-            parsed_url = urlparse(url)
-            domain = parsed_url.netloc
-        # 特定のドメインをチェックしてスキップ
-            if domain in EXCLUDED_DOMAINS:
-                logging.info(f"スキップするドメインです。: {domain}")
-                return
+        source = news_data.get('source', 'hn')
+        if source in ('hn', 'rss'):
+            handle_article(title, url, news_data)
         else:
-            logging.warning(f"タイトルまたはURLがありません。: {news_data}")
-            return
-        # コンテンツを取得
-        content = fetch_content_from_url(url)
-        if not content:
-            logging.warning(f"コンテンツがありません。: {url}")
-            return
-
-        # コンテンツをパース
-        parsed_content = parse_content(content)
-        if not parsed_content:
-            logging.warning(f"コンテンツのパースに失敗しました。: {url}")
-            return
-        
-        # LangChainで初期要約
-        preliminary_summary = summarize_content(parsed_content)
-        if not preliminary_summary:
-            logging.warning(f"要約に失敗しました。: {url}")
-            return
-        
-        # OpenAI APIを使用してさらに整形
-        final_summary = openai_api_call(
-            "gpt-4-1106-preview",
-            0,
-            [
-                {"role": "system", "content": f'以下の文章を簡潔にまとめて下さい。: """{preliminary_summary}"""'},
-                {"role": "user", "content": preliminary_summary}
-            ],
-            2800,
-            { "type": "text" }
-        )
-        if not final_summary:
-            logging.warning(f"最終的な要約の整形に失敗しました。: {url}")
-            return
-
-        # スコアを生成
-        score = generate_score(final_summary)
-        if not score:
-            logging.warning(f"スコアの生成に失敗しました。: {url}")
-            return
-        # スプレッドシートに書き込み
-        write_to_spreadsheet([title, url, final_summary, score])
-        # ログを出力
-        logging.info(f"コンテンツの処理が完了: {url}")
+            # 共通の処理キューのInoreaderの記事は、pubsub_consumer.pyがなくても失われないようにcontent_fetch_1201.pyのパイプラインで処理する
+            handle_other_source(source, title, url, news_data)
+        # 関数が終わる前に見出しを付け、シートへの同期を済ませる
+        headline_batch.flush()
+        record_store.flush()
+        spend_ledger.flush()
+        resilience.log_status()
     except Exception as e:
         logging.error(f"コンテンツの処理中にエラーが発生しました: {e}")
         raise
\ No newline at end of file
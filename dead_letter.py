@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+import processed_index
+
+# 処理に失敗した記事を記録しておくデッドレターのストア。
+# 以前は「Non-fatal exception」としてログに出して捨てていたため、OpenAIやSheetsの一時的な障害で記事が失われていた。
+# 記録した記事はdead_letter_sweeper.pyが空いている時間帯に再処理する。
+# 記録する関数とスイーパーは別のインスタンスで動くので、Cloud Functionでは両方から読み書きできるGCSのバケットに記録する。
+
+DEAD_LETTER_DB = os.getenv('DEAD_LETTER_DB', '/tmp/autonews_dead_letters.sqlite3')
+# 設定されている場合はGCSのバケットに記録する（既定はチェックポイントと同じバケット）
+DEAD_LETTER_BUCKET = os.getenv('DEAD_LETTER_BUCKET', os.getenv('CHECKPOINT_BUCKET'))
+DEAD_LETTER_PREFIX = os.getenv('DEAD_LETTER_PREFIX', 'dead_letters/')
+# 同時に同じ記事の失敗を記録した場合に読み直す回数
+RECORD_CONFLICT_RETRIES = 3
+# 再試行までの間隔（秒）。失敗するたびに倍にする
+RETRY_BASE_SECONDS = float(os.getenv('DEAD_LETTER_RETRY_BASE_SECONDS', '900'))
+RETRY_MAX_SECONDS = float(os.getenv('DEAD_LETTER_RETRY_MAX_SECONDS', '86400'))
+# この回数失敗した記事は諦める
+MAX_ATTEMPTS = int(os.getenv('DEAD_LETTER_MAX_ATTEMPTS', '6'))
+
+
+# 段階の処理に失敗したことを表す例外（stageは失敗した段階の名前）
+class StageError(Exception):
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+# 失敗の回数から次に再試行する時刻を決める
+def next_attempt_at(attempts, now):
+    return now + min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+
+
+# 記録した失敗をログに出す
+def log_recorded(source, url, stage, error_class, attempts, status):
+    if status == 'abandoned':
+        logging.error(f"{attempts}回失敗したため再処理を諦めます: {source} {url}（{stage}: {error_class}）")
+    else:
+        logging.warning(f"デッドレターに記録しました: {source} {url}（{stage}: {error_class}、{attempts}回目）")
+
+
+class DeadLetterStore:
+    def __init__(self, db_path=DEAD_LETTER_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS dead_letters ('
+            'source TEXT, key TEXT, url TEXT, title TEXT, stage TEXT, error_class TEXT, error_message TEXT, '
+            'attempts INTEGER, payload TEXT, first_failed_at REAL, last_failed_at REAL, next_attempt_at REAL, status TEXT, '
+            'PRIMARY KEY (source, key))'
+        )
+
+    # 失敗を記録する（同じ記事の失敗は回数を増やして次の再試行を遅らせる）
+    def record(self, source, url, stage, error, title=None, payload=None, now=None):
+        now = now or time.time()
+        key = processed_index.item_key(url)
+        # StageErrorに包まれた例外は元の例外の種類を記録する
+        error_class = type(error.__cause__ or error).__name__
+        with self.lock, self.db:
+            row = self.db.execute('SELECT attempts, first_failed_at FROM dead_letters WHERE source = ? AND key = ?', (source, key)).fetchone()
+            attempts, first_failed_at = (row[0] + 1, row[1]) if row else (1, now)
+            status = 'abandoned' if attempts >= MAX_ATTEMPTS else 'pending'
+            self.db.execute(
+                'INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (source, key, url, title, stage, error_class, str(error)[:1000], attempts,
+                 json.dumps(payload, ensure_ascii=False, default=str), first_failed_at, now, next_attempt_at(attempts, now), status)
+            )
+        log_recorded(source, url, stage, error_class, attempts, status)
+        return attempts
+
+    # 再処理に成功した記事を削除する
+    def resolve(self, source, url):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM dead_letters WHERE source = ? AND key = ?', (source, processed_index.item_key(url)))
+
+    # 再試行の時刻が来た記事を古い順に取得する
+    def due(self, limit, now=None, exclude=()):
+        now = now or time.time()
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT source, key, url, title, stage, error_class, attempts, payload FROM dead_letters '
+                'WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at',
+                ('pending', now)
+            ).fetchall()
+        letters = []
+        for source, key, url, title, stage, error_class, attempts, payload in rows:
+            if (source, key) in exclude:
+                continue
+            letters.append({
+                "source": source,
+                "key": key,
+                "url": url,
+                "title": title,
+                "stage": stage,
+                "error_class": error_class,
+                "attempts": attempts,
+                "payload": json.loads(payload) if payload else None
+            })
+            if len(letters) >= limit:
+                break
+        return letters
+
+    # 状態ごとの件数
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM dead_letters GROUP BY status').fetchall())
+
+
+# GCSのバケットに記録するストア（1記事1オブジェクト。状態と再試行の時刻はメタデータに置き、一覧だけで再処理の対象を選ぶ）
+class GCSDeadLetterStore:
+    def __init__(self, bucket_name=DEAD_LETTER_BUCKET, prefix=DEAD_LETTER_PREFIX):
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def _blob(self, source, key):
+        return self.bucket.blob(f'{self.prefix}{source}/{key}.json')
+
+    # 失敗を記録する（同じ記事の失敗は回数を増やして次の再試行を遅らせる。同時に書き込まれた場合は読み直す）
+    def record(self, source, url, stage, error, title=None, payload=None, now=None):
+        now = now or time.time()
+        key = processed_index.item_key(url)
+        error_class = type(error.__cause__ or error).__name__
+        for _ in range(RECORD_CONFLICT_RETRIES):
+            blob = self._blob(source, key)
+            try:
+                previous = json.loads(blob.download_as_text())
+                generation = blob.generation
+            except NotFound:
+                previous, generation = None, 0
+            attempts = previous['attempts'] + 1 if previous else 1
+            status = 'abandoned' if attempts >= MAX_ATTEMPTS else 'pending'
+            letter = {
+                "source": source,
+                "key": key,
+                "url": url,
+                "title": title,
+                "stage": stage,
+                "error_class": error_class,
+                "error_message": str(error)[:1000],
+                "attempts": attempts,
+                "payload": payload,
+                "first_failed_at": previous['first_failed_at'] if previous else now,
+                "last_failed_at": now,
+                "next_attempt_at": next_attempt_at(attempts, now),
+                "status": status
+            }
+            blob.metadata = {"status": status, "next_attempt_at": repr(letter['next_attempt_at'])}
+            try:
+                blob.upload_from_string(json.dumps(letter, ensure_ascii=False, default=str), content_type='application/json', if_generation_match=generation)
+            except PreconditionFailed:
+                continue
+            log_recorded(source, url, stage, error_class, attempts, status)
+            return attempts
+        raise RuntimeError(f"同じ記事のデッドレターが同時に更新され続けたため記録できませんでした: {source} {url}")
+
+    # 再処理に成功した記事を削除する
+    def resolve(self, source, url):
+        try:
+            self._blob(source, processed_index.item_key(url)).delete()
+        except NotFound:
+            pass
+
+    # 再試行の時刻が来た記事を古い順に取得する
+    def due(self, limit, now=None, exclude=()):
+        now = now or time.time()
+        candidates = []
+        for blob in self.client.list_blobs(self.bucket, prefix=self.prefix):
+            metadata = blob.metadata or {}
+            if metadata.get('status') != 'pending' or float(metadata.get('next_attempt_at', 0)) > now:
+                continue
+            source, _, name = blob.name[len(self.prefix):].rpartition('/')
+            if (source, name[:-len('.json')]) in exclude:
+                continue
+            candidates.append((float(metadata['next_attempt_at']), blob))
+        letters = []
+        for _, blob in sorted(candidates, key=lambda candidate: candidate[0])[:limit]:
+            try:
+                letter = json.loads(blob.download_as_text())
+            except NotFound:
+                # 一覧を取った後に解決された記事
+                continue
+            letters.append({name: letter.get(name) for name in ("source", "key", "url", "title", "stage", "error_class", "attempts", "payload")})
+        return letters
+
+    # 状態ごとの件数
+    def counts(self):
+        counts = {}
+        for blob in self.client.list_blobs(self.bucket, prefix=self.prefix):
+            status = (blob.metadata or {}).get('status', 'unknown')
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+# 環境変数に応じてストアを選ぶ（バケットがなければこのインスタンスのSQLite）
+def init_store():
+    if DEAD_LETTER_BUCKET:
+        return GCSDeadLetterStore()
+    if os.getenv('K_SERVICE'):
+        logging.warning("DEAD_LETTER_BUCKETが設定されていないため、デッドレターはこのインスタンスにだけ記録され、スイーパーからは再処理されません")
+    return DeadLetterStore()
+
+
+STORE = init_store()
+
+
+# 失敗を記録する（記録に失敗しても呼び出し元の処理は止めない）
+def record(source, url, stage, error, title=None, payload=None):
+    try:
+        return STORE.record(source, url, stage, error, title=title, payload=payload)
+    except Exception as e:
+        logging.error(f"デッドレターの記録に失敗しました: {source} {url}: {e}")
+        return 0
@@ -0,0 +1,107 @@
+import importlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import checkpoint_store
+import dead_letter
+import headline_batch
+import record_store
+import spend_ledger
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# デッドレターに記録された記事を再処理するジョブ。Cloud Schedulerから`sweep_dead_letters`を起動する。
+# 通常の取り込みと競合しないように、空いている時間帯に少ない同時実行数で少しずつ処理する。
+
+# 1回のバッチで再処理する件数と、1回の起動で処理するバッチ数
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', '10'))
+SWEEP_MAX_BATCHES = int(os.getenv('SWEEP_MAX_BATCHES', '5'))
+# 同時に再処理する記事の数
+SWEEP_CONCURRENCY = int(os.getenv('SWEEP_CONCURRENCY', '2'))
+# バッチの間に空ける時間（秒）
+SWEEP_BATCH_INTERVAL = float(os.getenv('SWEEP_BATCH_INTERVAL', '30'))
+# 再処理してよい時間帯（日本時間の開始時-終了時、空なら常に実行する）
+SWEEP_OFF_PEAK_HOURS = os.getenv('SWEEP_OFF_PEAK_HOURS', '1-6')
+
+# 記録元ごとの再処理関数を持つモジュール（使うときに読み込む）
+REDRIVE_MODULES = {
+    "hn_item": "main",
+    "hn_article": "content_fetcher2",
+    "inoreader": "content_fetch_1201",
+}
+
+
+# 空いている時間帯かどうか
+def is_off_peak(now=None):
+    if not SWEEP_OFF_PEAK_HOURS:
+        return True
+    now = now or datetime.utcnow() + timedelta(hours=9)
+    start, end = (int(hour) for hour in SWEEP_OFF_PEAK_HOURS.split('-'))
+    if start <= end:
+        return start <= now.hour < end
+    # 日付をまたぐ時間帯（例: 22-5）
+    return now.hour >= start or now.hour < end
+
+
+# 1件を再処理する（失敗の記録は各パイプラインが行う。解決済みにするのはシートへの同期の後）
+def redrive(letter):
+    try:
+        module = importlib.import_module(REDRIVE_MODULES[letter['source']])
+        return module.redrive_dead_letter(letter)
+    except Exception as e:
+        logging.error(f"再処理中にエラーが発生しました: {letter['source']} {letter['url']}: {e}")
+        dead_letter.STORE.record(letter['source'], letter['url'], letter['stage'], e, title=letter['title'], payload=letter['payload'])
+        return False
+
+
+# 再処理に成功した記事の行と見出しをシートに同期してから、デッドレターを解決済みにする
+# （同期が終わらなければ解決済みにせず、次の起動でもう一度再処理する。書き込み済みの行は処理済みとしてスキップされる）
+def resolve_after_flush(letters):
+    if not letters:
+        return 0
+    headline_batch.flush()
+    try:
+        record_store.flush()
+    except record_store.MirrorFlushError as e:
+        logging.error(f"シートへの同期が終わらないため、再処理した{len(letters)}件を解決済みにしません: {e}")
+        return 0
+    for letter in letters:
+        dead_letter.STORE.resolve(letter['source'], letter['url'])
+        logging.info(f"再処理に成功しました: {letter['source']} {letter['url']}（{letter['attempts']}回失敗）")
+    return len(letters)
+
+
+# 再試行の時刻が来た記事をバッチごとに再処理する
+def sweep():
+    tried = set()
+    succeeded = 0
+    for batch in range(SWEEP_MAX_BATCHES):
+        letters = dead_letter.STORE.due(SWEEP_BATCH_SIZE, exclude=tried)
+        if not letters:
+            break
+        if batch:
+            time.sleep(SWEEP_BATCH_INTERVAL)
+        tried.update((letter['source'], letter['key']) for letter in letters)
+        with ThreadPoolExecutor(max_workers=SWEEP_CONCURRENCY) as executor:
+            results = list(executor.map(redrive, letters))
+        succeeded += resolve_after_flush([letter for letter, done in zip(letters, results) if done])
+    logging.info(f"デッドレターの再処理が完了: {succeeded}/{len(tried)}件成功（残り: {dead_letter.STORE.counts()}）")
+    return succeeded
+
+
+# Cloud Schedulerから起動されるエントリポイント
+def sweep_dead_letters(event, context):
+    if not is_off_peak():
+        logging.info(f"空いている時間帯（{SWEEP_OFF_PEAK_HOURS}時）ではないため再処理しません。")
+        return
+    sweep()
+    spend_ledger.flush()
+    # 書き込みまで終わらなかった記事のチェックポイントが残り続けないように、古いものを削除する
+    checkpoint_store.prune()
+
+
+if __name__ == "__main__":
+    sweep()
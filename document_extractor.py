@@ -0,0 +1,155 @@
+import logging
+import os
+import re
+from dataclasses import dataclass
+from tempfile import SpooledTemporaryFile
+from urllib.parse import urlparse
+from pypdf import PdfReader
+
+# 取得した記事をContent-Typeで振り分けるモジュール。HTMLはそのまま、PDFはページ数と文字数の上限までテキストを取り出し、
+# プレーンテキストはそのまま渡す。画像や動画などそれ以外のバイナリはダウンロードが終わる前に断る。
+
+# 読み込む大きさの上限（バイト）。HTMLとテキストは上限で打ち切り、PDFは上限を超えたら断る（末尾がないと読めないため）
+MAX_HTML_BYTES = int(os.getenv('MAX_HTML_BYTES', str(5 * 1024 * 1024)))
+MAX_PDF_BYTES = int(os.getenv('MAX_PDF_BYTES', str(30 * 1024 * 1024)))
+# PDFから取り出すページ数と文字数の上限
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '30'))
+PDF_MAX_CHARS = int(os.getenv('PDF_MAX_CHARS', '60000'))
+# これを超えたダウンロードはメモリではなく一時ファイルに書く
+SPOOL_MEMORY_BYTES = 2 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+HTML_TYPES = {'text/html', 'application/xhtml+xml'}
+PDF_TYPES = {'application/pdf', 'application/x-pdf'}
+TEXT_TYPES = {'text/plain', 'text/markdown', 'text/x-markdown', 'text/x-rst', 'text/csv'}
+# 中身を見るまで種類がわからないContent-Type
+UNKNOWN_TYPES = {'', 'application/octet-stream', 'binary/octet-stream', 'application/x-download', 'application/force-download'}
+TEXT_EXTENSIONS = ('.txt', '.md', '.rst')
+
+META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+# 対応していない形式の場合の例外（再試行しても取得できない）
+class UnsupportedContentError(Exception):
+    pass
+
+
+@dataclass
+class FetchedDocument:
+    url: str
+    # 'html'、'pdf'、'text'のいずれか
+    kind: str
+    # HTMLはマークアップのまま、PDFとテキストは取り出したテキスト
+    content: str
+
+
+# Content-TypeとURLから種類を決める（中身を見ないとわからない場合は空文字、対応していない場合はNone）
+def classify(media_type, url):
+    path = urlparse(url).path.lower()
+    if media_type in PDF_TYPES:
+        return 'pdf'
+    if media_type in HTML_TYPES:
+        return 'html'
+    if media_type in TEXT_TYPES:
+        return 'text'
+    if media_type in UNKNOWN_TYPES:
+        if path.endswith('.pdf'):
+            return 'pdf'
+        if path.endswith(TEXT_EXTENSIONS):
+            return 'text'
+        return ''
+    return None
+
+
+# 先頭のバイト列から種類を判定する
+def sniff(head):
+    if head.startswith(b'%PDF-'):
+        return 'pdf'
+    if b'\x00' in head[:1024]:
+        return None
+    if re.search(rb'<(!doctype html|html|head|body)', head[:2048], re.IGNORECASE):
+        return 'html'
+    return 'text'
+
+
+# 文字コードを決めてデコードする（ヘッダー、metaタグ、UTF-8の順）
+def decode(data, charset, kind):
+    if not charset and kind == 'html':
+        match = META_CHARSET.search(data[:4096])
+        if match:
+            charset = match.group(1).decode('ascii', 'ignore')
+    try:
+        return data.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+# PDFのテキストをページ数と文字数の上限まで取り出す
+def extract_pdf_text(file, url):
+    reader = PdfReader(file)
+    pieces = []
+    length = 0
+    total_pages = len(reader.pages)
+    for index, page in enumerate(reader.pages):
+        if index >= PDF_MAX_PAGES or length >= PDF_MAX_CHARS:
+            logging.info(f"PDFの上限に達したため残りのページを読みません: {url} {index}/{total_pages}ページ、{length}文字")
+            break
+        text = page.extract_text() or ''
+        pieces.append(text)
+        length += len(text)
+    return '\n'.join(pieces)[:PDF_MAX_CHARS]
+
+
+# レスポンスを少しずつ受け取って文書にする（requestsとaiohttpの両方から使う）
+class DocumentDownload:
+    def __init__(self, url, content_type, content_length=None):
+        self.url = url
+        media_type, _, parameters = (content_type or '').partition(';')
+        self.media_type = media_type.strip().lower()
+        match = re.search(r'charset=["\']?([\w-]+)', parameters, re.IGNORECASE)
+        self.charset = match.group(1) if match else None
+
+        self.kind = classify(self.media_type, url)
+        if self.kind is None:
+            raise UnsupportedContentError(f"対応していない形式のため取得しません: {self.media_type} {url}")
+        if self.kind == 'pdf' and content_length and str(content_length).isdigit() and int(content_length) > MAX_PDF_BYTES:
+            raise UnsupportedContentError(f"PDFが大きすぎるため取得しません: {content_length}バイト {url}")
+
+        self.body = SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.size = 0
+        self.truncated = False
+
+    # 受け取ったチャンクを書き込む（これ以上読む必要がなければFalse）
+    def feed(self, chunk):
+        if not chunk:
+            return True
+        if self.size == 0 and not self.kind:
+            self.kind = sniff(chunk)
+            if self.kind is None:
+                raise UnsupportedContentError(f"バイナリのため取得しません: {self.media_type or '種類不明'} {self.url}")
+
+        limit = MAX_PDF_BYTES if self.kind == 'pdf' else MAX_HTML_BYTES
+        if self.size + len(chunk) > limit:
+            if self.kind == 'pdf':
+                raise UnsupportedContentError(f"PDFが大きすぎるため取得を中止しました: {self.url}")
+            self.body.write(chunk[:limit - self.size])
+            self.size = limit
+            self.truncated = True
+            return False
+        self.body.write(chunk)
+        self.size += len(chunk)
+        return True
+
+    # 受け取った内容から文書を作る
+    def document(self):
+        try:
+            self.body.seek(0)
+            if self.kind == 'pdf':
+                content = extract_pdf_text(self.body, self.url)
+            else:
+                content = decode(self.body.read(), self.charset, self.kind or 'text')
+        finally:
+            self.body.close()
+        if self.truncated:
+            logging.info(f"上限に達したため途中までを使います: {self.url} {self.size}バイト")
+        return FetchedDocument(url=self.url, kind=self.kind or 'text', content=content)
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+import requests
+import document_extractor
+import resilience
+
+# 記事取得のスケジューラ。ホストごとと全体の同時接続数を制限し、robots.txtのcrawl-delayと429/503のバックオフを守る。
+# 接続エラー、タイムアウト、サーバーエラーはresilience.pyのホストごとのブレーカーで再試行し、落ちているホストにはすぐ失敗させる。
+
+# 設定
+DOMAIN_RULES_PATH = os.getenv('DOMAIN_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'domain_rules.json'))
+GLOBAL_FETCH_CONCURRENCY = int(os.getenv('GLOBAL_FETCH_CONCURRENCY', '8'))
+PER_HOST_CONCURRENCY = int(os.getenv('PER_HOST_CONCURRENCY', '2'))
+# 接続と読み込み（データが届く間隔）のタイムアウト（秒）
+FETCH_CONNECT_TIMEOUT = 10
+DEFAULT_FETCH_TIMEOUT = int(os.getenv('DEFAULT_FETCH_TIMEOUT', '30'))
+# 1記事の取得で試す回数
+FETCH_MAX_ATTEMPTS = int(os.getenv('FETCH_MAX_ATTEMPTS', '2'))
+ROBOTS_CACHE_TTL = int(os.getenv('ROBOTS_CACHE_TTL', '3600'))
+ROBOTS_TIMEOUT = 10
+# 429/503を返したホストを休ませる時間（秒）
+HOST_BACKOFF_BASE = 30
+HOST_BACKOFF_MAX = 600
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+
+# 2階層のパブリックサフィックス（登録ドメインの判定に使う）
+SECOND_LEVEL_SUFFIXES = {
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp', 'ed.jp',
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk',
+    'com.au', 'net.au', 'org.au', 'co.kr', 'com.cn', 'com.br', 'co.in', 'com.tw',
+}
+
+
+# robots.txtで取得が許可されていない場合の例外
+class FetchDisallowedError(Exception):
+    pass
+
+
+# 429/503でホストがバックオフ中の場合の例外
+class HostBackoffError(Exception):
+    pass
+
+
+# 再試行しても取得できない記事の例外
+PERMANENT_FETCH_ERRORS = (FetchDisallowedError, document_extractor.UnsupportedContentError)
+
+
+# URLからホスト名を取り出す
+def get_host(url):
+    return (urlparse(url).hostname or '').lower()
+
+
+# ホスト名から登録ドメイン（example.co.jp、example.comなど）を求める
+def registered_domain(host):
+    labels = host.split('.')
+    if len(labels) >= 3 and '.'.join(labels[-2:]) in SECOND_LEVEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+# ドメインルールを読み込む
+def load_domain_rules(path=DOMAIN_RULES_PATH):
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        logging.warning(f"ドメインルールのファイルが見つかりません: {path}")
+        config = {}
+    default = config.get('default', {'action': 'allow'})
+    domains = {domain.lower(): rule for domain, rule in config.get('domains', {}).items()}
+    return default, domains
+
+
+DEFAULT_RULE, DOMAIN_RULES = load_domain_rules()
+
+
+# URLに適用されるルールを返す（ホスト名の完全一致を優先し、なければ登録ドメインで引く）
+def get_domain_rule(url):
+    host = get_host(url)
+    if host.startswith('www.'):
+        host = host[4:]
+    rule = DOMAIN_RULES.get(host)
+    if rule is None:
+        rule = DOMAIN_RULES.get(registered_domain(host), DEFAULT_RULE)
+    return rule
+
+
+# ドメインルールでスキップ対象かどうか（ネットワークアクセスなし）
+def is_skipped_url(url):
+    return get_domain_rule(url).get('action') == 'skip'
+
+
+class FetchScheduler:
+    def __init__(self, global_concurrency=GLOBAL_FETCH_CONCURRENCY, per_host_concurrency=PER_HOST_CONCURRENCY):
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.global_semaphore = threading.BoundedSemaphore(global_concurrency)
+        self.per_host_concurrency = per_host_concurrency
+        self.lock = threading.Lock()
+        self.host_semaphores = {}
+        # ホストごとの次にリクエストしてよい時刻、バックオフ状態、robots.txtのキャッシュ
+        self.next_request_at = {}
+        self.backoff_until = {}
+        self.backoff_count = {}
+        self.robots_cache = {}
+
+    def _host_semaphore(self, host, rule):
+        with self.lock:
+            semaphore = self.host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(rule.get('concurrency', self.per_host_concurrency))
+                self.host_semaphores[host] = semaphore
+            return semaphore
+
+    # robots.txtを取得してキャッシュする（取得できない場合はすべて許可として扱う）
+    def _robots(self, url):
+        parsed = urlparse(url)
+        host = parsed.netloc.lower()
+        with self.lock:
+            cached = self.robots_cache.get(host)
+        if cached and time.monotonic() - cached[1] < ROBOTS_CACHE_TTL:
+            return cached[0]
+
+        robots = RobotFileParser()
+        robots_url = f"{parsed.scheme}://{parsed.netloc}/robots.txt"
+        try:
+            response = self.session.get(robots_url, timeout=ROBOTS_TIMEOUT)
+            if response.status_code >= 400:
+                robots.allow_all = True
+            else:
+                robots.parse(response.text.splitlines())
+        except requests.RequestException as e:
+            logging.info(f"robots.txtの取得に失敗したため許可として扱います: {robots_url}: {e}")
+            robots.allow_all = True
+
+        with self.lock:
+            self.robots_cache[host] = (robots, time.monotonic())
+        return robots
+
+    # crawl-delayとバックオフを考慮して、リクエストできるまで待つ
+    def _wait_for_turn(self, host, crawl_delay):
+        with self.lock:
+            now = time.monotonic()
+            if self.backoff_until.get(host, 0) > now:
+                raise HostBackoffError(f"{host} はバックオフ中です")
+            start_at = max(now, self.next_request_at.get(host, 0))
+            self.next_request_at[host] = start_at + (crawl_delay or 0)
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    # 429/503を受けたホストにバックオフを設定する
+    def _set_backoff(self, host, response):
+        with self.lock:
+            count = self.backoff_count.get(host, 0) + 1
+            self.backoff_count[host] = count
+            delay = min(HOST_BACKOFF_BASE * 2 ** (count - 1), HOST_BACKOFF_MAX)
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = min(int(retry_after), HOST_BACKOFF_MAX)
+            self.backoff_until[host] = time.monotonic() + delay
+        logging.warning(f"{host} が {response.status_code} を返したため {delay} 秒バックオフします")
+
+    def _clear_backoff(self, host):
+        with self.lock:
+            self.backoff_count.pop(host, None)
+
+    # URLのコンテンツを取得する（Content-Typeで振り分けたFetchedDocumentを返す）
+    def fetch(self, url):
+        rule = get_domain_rule(url)
+        host = get_host(url)
+
+        robots = self._robots(url)
+        if not robots.can_fetch(USER_AGENT, url):
+            raise FetchDisallowedError(f"robots.txtで取得が許可されていません: {url}")
+        crawl_delay = robots.crawl_delay(USER_AGENT)
+
+        def fetch_once():
+            self._wait_for_turn(host, crawl_delay)
+            with self.global_semaphore:
+                # ヘッダーを見てから本文を少しずつ読む（対応していない形式は本文を読まずに断る）
+                with self.session.get(url, timeout=(FETCH_CONNECT_TIMEOUT, rule.get('timeout', DEFAULT_FETCH_TIMEOUT)), stream=True) as response:
+                    if response.status_code in (429, 503):
+                        # 429/503はホストのバックオフで待つので、ここでは再試行しない
+                        self._set_backoff(host, response)
+                        raise HostBackoffError(f"{host} が {response.status_code} を返しました: {url}")
+                    if response.status_code >= 500:
+                        response.raise_for_status()
+                    download = document_extractor.DocumentDownload(url, response.headers.get('Content-Type'), response.headers.get('Content-Length'))
+                    for chunk in response.iter_content(document_extractor.CHUNK_SIZE):
+                        if not download.feed(chunk):
+                            break
+            return download
+
+        # crawl-delayの待機中は全体の枠を占有しない
+        with self._host_semaphore(host, rule):
+            download = resilience.call(f'host:{host}', fetch_once, max_attempts=FETCH_MAX_ATTEMPTS)
+
+        self._clear_backoff(host)
+        # PDFのテキスト抽出は接続の枠を空けてから行う
+        return download.document()
+
+
+SCHEDULER = FetchScheduler()
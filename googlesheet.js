@@ -37,31 +37,7 @@ function postToWordpress() {
   });
 }
 
-function deleteOldRows() {
-  var sheet = SpreadsheetApp.getActiveSpreadsheet().getActiveSheet();
-  var rows = sheet.getDataRange().getValues();
-  var today = new Date();
-  var sevenDaysAgo = new Date(today.getFullYear(), today.getMonth(), today.getDate() - 7);
+// 古い行の削除は sheet_retention.py の prune_old_rows に移行（1回のbatch_updateで範囲ごとに削除する）
 
-  rows.forEach(function(row, index) {
-    var date = new Date(row[0]); // 日付は最初の列にあると仮定
-    if (date < sevenDaysAgo) {
-      sheet.deleteRow(index + 1); // 行は1から始まるので+1
-    }
-  });
-}
-
-function setupTriggers() {
-  // トリガーを設定して、postToWordpress関数を定期的に実行
-  ScriptApp.newTrigger('postToWordpress')
-    .timeBased()
-    .everyHours(1) // 1時間ごとに実行、必要に応じて変更
-    .create();
-
-  // トリガーを設定して、deleteOldRows関数を毎日実行
-  ScriptApp.newTrigger('deleteOldRows')
-    .timeBased()
-    .atHour(1) // 毎日1時に実行、必要に応じて変更
-    .everyDays(1)
-    .create();
-}
+// WordPressへの定期投稿は wordpress_publisher.py の publish_to_wordpress に移行（新しい行と変更された行だけを投稿する）
+// postToWordpress は手動で全件を投稿し直したいときだけ使うこと
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+import checkpoint_store
+import model_router
+import prompt_builder
+import record_store
+import resilience
+import spend_ledger
+
+# HNやInoreaderの英語のタイトルを、まとめて日本語の見出しにするモジュール。
+# 一定時間内にローカルのストアに書き込まれた行のタイトル（あればリード文も）を集め、1回の呼び出しでIDをキーにしたJSONの配列として見出しを受け取る。
+# 見出しはタイトルのハッシュごとにキャッシュし、同じタイトルの記事（HNとInoreaderの両方に出た記事など）では呼び出さない。
+# キャッシュはインスタンスのSQLiteと、インスタンスの間で共有するGCSの2段にする。
+
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+HEADLINE_CACHE_DB = os.getenv('HEADLINE_CACHE_DB', '/tmp/autonews_headlines.sqlite3')
+# インスタンスの間で共有するキャッシュのバケット（未設定ならインスタンスのキャッシュだけを使う）
+HEADLINE_CACHE_BUCKET = os.getenv('HEADLINE_CACHE_BUCKET', checkpoint_store.CHECKPOINT_BUCKET)
+HEADLINE_CACHE_PREFIX = os.getenv('HEADLINE_CACHE_PREFIX', 'headlines/')
+# 共有のキャッシュを並行して読み書きする数
+HEADLINE_CACHE_WORKERS = 8
+# 見出しを付ける行をまとめる間隔（秒）と、1回の呼び出しで送る記事の数
+HEADLINE_INTERVAL = float(os.getenv('HEADLINE_INTERVAL', '60'))
+HEADLINE_BATCH_SIZE = int(os.getenv('HEADLINE_BATCH_SIZE', '40'))
+# この時間（時間）より前に追加された行には見出しを付けない
+HEADLINE_WINDOW_HOURS = float(os.getenv('HEADLINE_WINDOW_HOURS', '24'))
+# プロンプトに含めるリード文の長さ（文字）
+HEADLINE_LEAD_CHARS = 300
+# 見出し1件あたりの出力トークン数の目安
+HEADLINE_OUTPUT_TOKENS = 80
+
+# シートごとの列の位置（0始まり）。titleはタイトル、leadはリード文（なければNone）、headlineは見出しを書き込む列
+DEFAULT_HEADLINE_COLUMNS = {
+    # [日付, タイトル, URL, ID]
+    "hn_items": {"title": 1, "lead": None, "headline": 4},
+    # [タイトル, URL, 要約, スコア, 日付]
+    "articles": {"title": 0, "lead": 2, "headline": 5},
+    # [タイトル, URL, 要約, リード文, 意見1-3]
+    "inoreader_articles": {"title": 0, "lead": 3, "headline": 7},
+}
+HEADLINE_COLUMNS = {**DEFAULT_HEADLINE_COLUMNS, **json.loads(os.getenv('HEADLINE_COLUMNS', '{}'))}
+
+
+# タイトルのハッシュ（空白の違いは無視する）
+def title_hash(title):
+    return hashlib.sha256(' '.join(title.split()).encode('utf-8')).hexdigest()
+
+
+class HeadlineCache:
+    def __init__(self, db_path=HEADLINE_CACHE_DB, shared=None):
+        # 共有のキャッシュ（checkpoint_store.pyのバックエンド。Noneならインスタンスのキャッシュだけ）
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS headlines (title_hash TEXT PRIMARY KEY, title TEXT, headline TEXT, model TEXT, created_at REAL)')
+
+    # タイトルのハッシュ -> 見出し（キャッシュにあるものだけ。インスタンスのキャッシュになければ共有のキャッシュを読む）
+    def get_many(self, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        with self.lock:
+            rows = self.db.execute(f'SELECT title_hash, headline FROM headlines WHERE title_hash IN ({",".join("?" * len(hashes))})', hashes).fetchall()
+        headlines = dict(rows)
+        missing = [digest for digest in hashes if digest not in headlines]
+        if self.shared and missing:
+            with ThreadPoolExecutor(max_workers=HEADLINE_CACHE_WORKERS) as executor:
+                entries = list(executor.map(self.load_shared, missing))
+            found = [entry for entry in entries if entry]
+            if found:
+                self.put_local(found)
+                headlines.update((title_hash(entry["title"]), entry["headline"]) for entry in found)
+        return headlines
+
+    # 共有のキャッシュから1件読む（読めなければNone）
+    def load_shared(self, digest):
+        try:
+            return self.shared.load(digest)
+        except Exception as e:
+            logging.warning(f"共有の見出しのキャッシュを読めませんでした: {digest}: {e}")
+            return None
+
+    def put_local(self, entries):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO headlines VALUES (?, ?, ?, ?, ?)',
+                [(title_hash(entry["title"]), entry["title"], entry["headline"], entry["model"], now) for entry in entries]
+            )
+
+    def put_many(self, items, model):
+        entries = [{"title": title, "headline": headline, "model": model} for title, headline in items]
+        self.put_local(entries)
+        if self.shared and entries:
+            with ThreadPoolExecutor(max_workers=HEADLINE_CACHE_WORKERS) as executor:
+                list(executor.map(self.save_shared, entries))
+
+    # 共有のキャッシュに1件書く（失敗してもインスタンスのキャッシュには残る）
+    def save_shared(self, entry):
+        try:
+            self.shared.save(title_hash(entry["title"]), entry)
+        except Exception as e:
+            logging.warning(f"共有の見出しのキャッシュに書き込めませんでした: {entry['title']}: {e}")
+
+
+# 見出しの呼び出し（再試行はresilience.pyで行う）
+def openai_api_call(model, messages, max_tokens):
+    spend_ledger.throttle("headline")
+    client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    raw_response = resilience.call('openai', client.chat.completions.with_raw_response.create, model=model, temperature=0, messages=messages, max_tokens=max_tokens, response_format={"type": "json_object"})
+    model_router.record_rate_limits(model, raw_response.headers)
+    response = raw_response.parse()
+    spend_ledger.record_usage(model, "headline", response.usage)
+    return response.choices[0].message.content
+
+
+# 見出しのJSONを読む（id -> 見出し。形式が違う項目は捨てる）
+def parse_headlines(text):
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return {}
+    items = data.get("headlines") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return {}
+    headlines = {}
+    for item in items:
+        if isinstance(item, dict) and isinstance(item.get("headline"), str) and item["headline"].strip():
+            headlines[str(item.get("id"))] = item["headline"].strip()
+    return headlines
+
+
+# 記事（{"title", "lead"}）のリストをまとめて見出しにする（タイトル -> 見出し。返ってこなかった記事は含まない）
+def generate_headlines(articles):
+    items = [{"id": str(index + 1), "title": article["title"]} for index, article in enumerate(articles)]
+    for item, article in zip(items, articles):
+        if article.get("lead"):
+            item["lead"] = article["lead"][:HEADLINE_LEAD_CHARS]
+    content = json.dumps(items, ensure_ascii=False)
+    max_tokens = HEADLINE_OUTPUT_TOKENS * len(items) + 100
+    model = model_router.route("headline", prompt_builder.count_tokens(content), max_tokens)
+    messages = prompt_builder.build_messages("headline", content, model, max_tokens)
+    headlines = parse_headlines(openai_api_call(model, messages, max_tokens))
+    results = {article["title"]: headlines[item["id"]] for item, article in zip(items, articles) if item["id"] in headlines}
+    if len(results) < len(articles):
+        logging.warning(f"見出しが返ってこなかった記事があります（{len(articles) - len(results)}/{len(articles)}件）。次回もう一度送ります")
+    return results, model
+
+
+class HeadlineBatcher:
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+        self.sheets = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # このプロセスで見出しを付けるシートを登録し、バックグラウンドのスレッドを起動する
+    def register(self, sheet):
+        if sheet not in HEADLINE_COLUMNS:
+            raise ValueError(f"見出しの列が設定されていないシートです: {sheet}")
+        self.sheets.add(sheet)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # 見出しがまだない最近の行（[(シート, キー, 行, タイトル, リード文)]）
+    def pending_rows(self):
+        since = time.time() - HEADLINE_WINDOW_HOURS * 3600
+        pending = []
+        for sheet in sorted(self.sheets):
+            columns = HEADLINE_COLUMNS[sheet]
+            for key, row in self.store.recent(sheet, since):
+                title = row[columns["title"]] if len(row) > columns["title"] else None
+                if not title or (len(row) > columns["headline"] and row[columns["headline"]]):
+                    continue
+                lead = row[columns["lead"]] if columns["lead"] is not None and len(row) > columns["lead"] else None
+                pending.append((sheet, key, row, title, lead))
+        return pending
+
+    # 見出しのセルだけを書き込む（呼び出しの間に他の段階が更新した行を古い内容で上書きしないように、ストアのロックの中で今の行に書く）
+    def write_headline(self, sheet, key, headline):
+        return record_store.set_cell(sheet, key, HEADLINE_COLUMNS[sheet]["headline"], headline, only_if_empty=True)
+
+    # 見出しのない行に見出しを付ける（キャッシュにないタイトルだけをまとめて呼び出す。付けた行数を返す）
+    def run_once(self):
+        with self.lock:
+            pending = self.pending_rows()
+            if not pending:
+                return 0
+            # タイトルのハッシュ -> 見出し
+            headlines = self.cache.get_many({title_hash(title) for _, _, _, title, _ in pending})
+            cached_rows = sum(1 for _, _, _, title, _ in pending if title_hash(title) in headlines)
+
+            # 同じタイトルは1回だけ送る
+            missing = {}
+            for _, _, _, title, lead in pending:
+                digest = title_hash(title)
+                if digest not in headlines and digest not in missing:
+                    missing[digest] = {"title": title, "lead": lead}
+            articles = list(missing.values())
+            calls = 0
+            for start in range(0, len(articles), HEADLINE_BATCH_SIZE):
+                results, model = generate_headlines(articles[start:start + HEADLINE_BATCH_SIZE])
+                calls += 1
+                self.cache.put_many(results.items(), model)
+                headlines.update((title_hash(title), headline) for title, headline in results.items())
+
+            written = 0
+            for sheet, key, row, title, _ in pending:
+                headline = headlines.get(title_hash(title))
+                if headline and self.write_headline(sheet, key, headline):
+                    written += 1
+            logging.info(f"見出しを付けました: {written}/{len(pending)}件（キャッシュ{cached_rows}件、呼び出し{calls}回）")
+            return written
+
+    # バックグラウンドのスレッド（失敗しても行は残るので次の間隔でもう一度試す）
+    def run(self):
+        while True:
+            time.sleep(HEADLINE_INTERVAL)
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.warning(f"見出しの生成に失敗しました。{HEADLINE_INTERVAL:.0f}秒後に再試行します: {e}")
+
+    # 見出しのない行をすぐに処理する（エントリポイントの終わりで、シートへの同期の前に使う）
+    def flush(self):
+        try:
+            return self.run_once()
+        except Exception as e:
+            logging.warning(f"見出しの生成に失敗しました（次回の起動で再試行します）: {e}")
+            return 0
+
+
+# 環境変数に応じて共有のキャッシュを選ぶ
+def init_cache():
+    if HEADLINE_CACHE_BUCKET:
+        return HeadlineCache(shared=checkpoint_store.GCSCheckpointBackend(HEADLINE_CACHE_BUCKET, HEADLINE_CACHE_PREFIX))
+    if os.getenv('K_SERVICE'):
+        logging.warning("HEADLINE_CACHE_BUCKETが未設定のため、見出しのキャッシュはインスタンスごとになります")
+    return HeadlineCache()
+
+
+CACHE = init_cache()
+BATCHER = HeadlineBatcher(record_store.STORE, CACHE)
+
+
+# シートをこのプロセスで見出しを付ける対象にする
+def register(sheet):
+    BATCHER.register(sheet)
+
+
+# 見出しのない行をすぐに処理する
+def flush():
+    return BATCHER.flush()
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import requests
+import main
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# HNのFirebase REST APIのストリーミング（Server-Sent Events）を購読し、新しい記事のIDだけを処理する常駐プロセス。
+# 5分ごとにmaxitemとnewstoriesを全件読むポーリングの代わりに使う。接続が続けて失敗する場合はしばらくポーリングに切り替える。
+
+# 購読するパス（newstoriesは記事IDの一覧、maxitemは最新のID）
+HN_STREAM_PATH = os.getenv('HN_STREAM_PATH', 'newstories')
+# サーバーは30秒ごとにkeep-aliveを送るので、それより長く何も届かなければ切断とみなす
+STREAM_CONNECT_TIMEOUT = 10
+STREAM_READ_TIMEOUT = float(os.getenv('HN_STREAM_READ_TIMEOUT', '90'))
+# 再接続の間隔（秒）。失敗するたびに倍にする
+RECONNECT_BASE_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+# この回数続けて接続に失敗したらポーリングに切り替える
+MAX_STREAM_FAILURES = int(os.getenv('HN_STREAM_MAX_FAILURES', '5'))
+# ポーリングの間隔と、ポーリングを続けてから再びストリーミングを試すまでの時間（秒）
+POLL_INTERVAL_SECONDS = int(os.getenv('HN_POLL_INTERVAL_SECONDS', '300'))
+POLL_FALLBACK_SECONDS = int(os.getenv('HN_POLL_FALLBACK_SECONDS', '900'))
+# 記事を1件処理するごとの待ち時間（main.pyのポーリングと同じ）
+ITEM_INTERVAL_SECONDS = 1
+# maxitemを購読する場合に、再接続時にさかのぼるIDの数の上限
+MAX_ITEM_BACKFILL = 1000
+# 処理に回したIDを覚えておく数（newstoriesは500件なので、それより十分多くする）。超えた分は古いIDから忘れる
+MAX_SEEN_IDS = int(os.getenv('HN_STREAM_MAX_SEEN_IDS', '5000'))
+
+
+# Server-Sent Eventsの行を(イベント名, データ)に変換する
+def parse_sse(lines):
+    event = None
+    data = []
+    for line in lines:
+        if line is None:
+            continue
+        if line == '':
+            if event or data:
+                yield event or 'message', '\n'.join(data)
+            event = None
+            data = []
+        elif line.startswith(':'):
+            continue
+        else:
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                event = value
+            elif field == 'data':
+                data.append(value)
+
+
+class HNStream:
+    def __init__(self, handle_id, base_url=main.HN_API_BASE, path=HN_STREAM_PATH, last_checked_id=None):
+        self.handle_id = handle_id
+        self.url = f'{base_url}/{path}.json'
+        self.path = path
+        self.session = requests.Session()
+        # newstoriesの現在の内容（位置 -> ID）
+        self.stories = {}
+        self.seen = set()
+        # 忘れたIDのうち最も新しいID（これ以下のIDは処理済みとみなす）
+        self.seen_floor = 0
+        # これより古いIDは処理しない（Noneの場合は最初に受け取った一覧をすべて処理済みとみなす）
+        self.last_checked_id = last_checked_id
+        self.high_water = last_checked_id or 0
+
+    # 新しいIDを処理に回す
+    def _emit(self, ids):
+        new_ids = sorted(news_id for news_id in ids if isinstance(news_id, int) and news_id > self.seen_floor and news_id not in self.seen)
+        self.seen.update(new_ids)
+        # 常駐プロセスなので、覚えておくIDは新しいものだけにする（IDは増えていくので、古いIDが新しい記事として届くことはない）
+        if len(self.seen) > MAX_SEEN_IDS:
+            forgotten = sorted(self.seen)[:len(self.seen) - MAX_SEEN_IDS]
+            self.seen.difference_update(forgotten)
+            self.seen_floor = forgotten[-1]
+        for news_id in new_ids:
+            if self.last_checked_id is not None and news_id > self.last_checked_id:
+                self.handle_id(news_id)
+            self.high_water = max(self.high_water, news_id)
+        # 2回目以降の一覧はすべて新しい記事として扱う
+        if self.last_checked_id is None:
+            self.last_checked_id = self.high_water
+
+    # putとpatchのイベントを現在の状態に反映し、新しいIDを返す
+    def apply(self, event, payload):
+        path = payload.get('path', '/')
+        data = payload.get('data')
+        if self.path == 'maxitem':
+            # maxitemには記事以外（コメントなど）のIDも含まれる
+            if isinstance(data, int):
+                start = self.high_water + 1 if self.high_water else data
+                return list(range(max(start, data - MAX_ITEM_BACKFILL + 1), data + 1))
+            return []
+
+        if path == '/':
+            if event == 'put':
+                self.stories = {}
+            if isinstance(data, list):
+                data = dict(enumerate(data))
+            for key, value in (data or {}).items():
+                self.stories[int(key)] = value
+        else:
+            self.stories[int(path.strip('/').split('/')[0])] = data
+        return [value for value in self.stories.values() if value is not None]
+
+    # ストリームに1回接続し、切断されるまでイベントを処理する
+    def listen(self):
+        headers = {'Accept': 'text/event-stream'}
+        with self.session.get(self.url, headers=headers, stream=True, timeout=(STREAM_CONNECT_TIMEOUT, STREAM_READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            logging.info(f"HNのストリームに接続しました: {self.url}")
+            for event, data in parse_sse(response.iter_lines(decode_unicode=True)):
+                if event in ('put', 'patch'):
+                    self._emit(self.apply(event, json.loads(data)))
+                elif event in ('cancel', 'auth_revoked'):
+                    raise ConnectionError(f"HNのストリームが終了しました: {event}")
+        raise ConnectionError("HNのストリームが切断されました")
+
+    # ストリーミングを続け、続けて失敗する場合はしばらくポーリングに切り替える
+    def run_forever(self, poll):
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                self.listen()
+            except Exception as e:
+                # しばらく接続できていた場合は続けての失敗に数えない
+                failures = 1 if time.monotonic() - started > RECONNECT_MAX_SECONDS else failures + 1
+                logging.warning(f"HNのストリームから切断されました（{failures}回目）: {e}")
+            if failures >= MAX_STREAM_FAILURES:
+                logging.warning(f"ストリーミングに接続できないため{POLL_FALLBACK_SECONDS}秒間ポーリングに切り替えます")
+                poll_until = time.monotonic() + POLL_FALLBACK_SECONDS
+                while time.monotonic() < poll_until:
+                    try:
+                        poll(self.high_water)
+                    except Exception as e:
+                        logging.error(f"ポーリング中にエラーが発生しました: {e}")
+                    time.sleep(POLL_INTERVAL_SECONDS)
+                failures = 0
+                continue
+            # 再接続するとサーバーは最初に現在の一覧を送るので、切断中に増えたIDもそこで拾える
+            time.sleep(min(RECONNECT_BASE_SECONDS * 2 ** max(failures - 1, 0), RECONNECT_MAX_SECONDS))
+
+
+# キューに入ったIDを順に処理するワーカー（書き込みとPub/Subへの送信はmain.pyと同じ処理）
+def item_worker(item_queue):
+    while True:
+        news_id = item_queue.get()
+        try:
+            if not main.processed_ids.contains(news_id):
+                main.process_news_item(news_id, story_only=HN_STREAM_PATH == 'maxitem')
+                time.sleep(ITEM_INTERVAL_SECONDS)
+        finally:
+            item_queue.task_done()
+
+
+# 常駐プロセスのエントリポイント
+def run_stream():
+    try:
+        last_checked_id = main.get_last_checked_id()
+    except Exception as e:
+        logging.warning(f"最後にチェックしたIDを取得できないため、接続後に届いた記事から処理します: {e}")
+        last_checked_id = None
+
+    item_queue = queue.Queue()
+    threading.Thread(target=item_worker, args=(item_queue,), daemon=True).start()
+    stream = HNStream(item_queue.put, last_checked_id=last_checked_id)
+    stream.run_forever(main.update_news_on_sheet)
+
+
+if __name__ == "__main__":
+    run_stream()
@@ -0,0 +1,313 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from dataclasses import dataclass, field
+from google.api_core.exceptions import NotFound
+from google.cloud import pubsub_v1
+from google.cloud import storage
+import requests
+import fetch_scheduler
+import processed_index
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 記事の入口（HNのポーリング、InoreaderのWebhook、RSS/Atomのフィード）を共通の形式（NewsItem）にそろえ、
+# 1つの処理キュー（Pub/Subのトピック）に重複を除いてまとめて送る。キューはpubsub_consumer.pyが記録元ごとのパイプラインで処理する。
+
+GCP_PROJECT_ID = os.getenv('GCP_PROJECT_ID')
+INGEST_TOPIC = os.getenv('INGEST_TOPIC')
+# Pub/Subへの送信をまとめる件数と待ち時間（秒）
+BATCH_MAX_MESSAGES = int(os.getenv('INGEST_BATCH_MAX_MESSAGES', '50'))
+BATCH_MAX_LATENCY = float(os.getenv('INGEST_BATCH_MAX_LATENCY', '1.0'))
+# キューに送ったことのある記事とフィードの状態を保存するSQLite（バケットが設定されていない場合）
+INGEST_STATE_DB = os.getenv('INGEST_STATE_DB', '/tmp/autonews_ingestion.sqlite3')
+# インスタンスの間で共有する状態のバケット（既定はチェックポイントと同じバケット）
+INGEST_STATE_BUCKET = os.getenv('INGEST_STATE_BUCKET', os.getenv('CHECKPOINT_BUCKET'))
+INGEST_STATE_PREFIX = os.getenv('INGEST_STATE_PREFIX', 'ingestion/')
+# 送信済みの記録を残す日数（これより古い記録は削除する）
+INGEST_SENT_TTL_DAYS = float(os.getenv('INGEST_SENT_TTL_DAYS', '14'))
+# 購読するRSS/Atomのフィード（カンマ区切り）
+RSS_FEEDS = [feed.strip() for feed in os.getenv('RSS_FEEDS', '').split(',') if feed.strip()]
+FEED_TIMEOUT = 30
+
+ATOM_NAMESPACE = '{http://www.w3.org/2005/Atom}'
+
+
+@dataclass
+class NewsItem:
+    # 記事の記録元（'hn'、'inoreader'、'rss'）
+    source: str
+    title: str
+    url: str
+    # 関連度ゲートなどで使う記録元ごとの情報（HNのポイントやフィードのURLなど）
+    metadata: dict = field(default_factory=dict)
+
+    def key(self):
+        return processed_index.item_key(self.url)
+
+    # Pub/Subのメッセージにする（以前のメッセージと同じくtitleとurlを最上位に置く）
+    def to_message(self):
+        return json.dumps({**self.metadata, "source": self.source, "title": self.title, "url": self.url}, ensure_ascii=False).encode('utf-8')
+
+    @classmethod
+    def from_message(cls, data):
+        message = json.loads(data.decode('utf-8'))
+        source = message.pop('source', 'hn')
+        title = message.pop('title', None)
+        url = message.pop('url', None)
+        return cls(source=source, title=title, url=url, metadata=message)
+
+
+# HNのアイテムをNewsItemにする
+def hn_news_item(news_data):
+    return NewsItem(
+        source='hn',
+        title=news_data.get('title'),
+        url=news_data.get('url'),
+        metadata={
+            "hn_id": news_data.get('id'),
+            "type": news_data.get('type'),
+            "score": news_data.get('score'),
+            "descendants": news_data.get('descendants')
+        }
+    )
+
+
+# InoreaderのWebhookのリクエストをNewsItemのリストにする
+def inoreader_news_items(request_json):
+    items = []
+    for item in (request_json or {}).get('items', []):
+        title = (item.get('title') or '').strip()
+        url = item['canonical'][0].get('href', '') if item.get('canonical') else ''
+        if title and url:
+            items.append(NewsItem(source='inoreader', title=title, url=url, metadata={"feed": (item.get('origin') or {}).get('title')}))
+    return items
+
+
+# RSS 2.0とAtomのフィードをNewsItemのリストにする
+def parse_feed(content, feed_url):
+    root = ElementTree.fromstring(content)
+    items = []
+    # RSS 2.0
+    for entry in root.iter('item'):
+        title = (entry.findtext('title') or '').strip()
+        url = (entry.findtext('link') or '').strip()
+        if title and url:
+            items.append(NewsItem(source='rss', title=title, url=url, metadata={"feed": feed_url}))
+    # Atom
+    for entry in root.iter(f'{ATOM_NAMESPACE}entry'):
+        title = (entry.findtext(f'{ATOM_NAMESPACE}title') or '').strip()
+        links = entry.findall(f'{ATOM_NAMESPACE}link')
+        link = next((link for link in links if link.get('rel', 'alternate') == 'alternate'), links[0] if links else None)
+        url = link.get('href', '').strip() if link is not None else ''
+        if title and url:
+            items.append(NewsItem(source='rss', title=title, url=url, metadata={"feed": feed_url}))
+    return items
+
+
+# 送信済みの記事とフィードの条件付きGETの状態を、このインスタンスのSQLiteに保存する
+class LocalIngestionState:
+    def __init__(self, db_path=INGEST_STATE_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sent (key TEXT PRIMARY KEY, source TEXT, sent_at REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS feeds (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)')
+
+    def is_sent(self, key):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM sent WHERE key = ?', (key,)).fetchone() is not None
+
+    def mark_sent(self, key, source, now=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO sent VALUES (?, ?, ?)', (key, source, now or time.time()))
+
+    # フィードの(ETag, Last-Modified)（なければ(None, None)）
+    def feed_state(self, feed_url):
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified FROM feeds WHERE url = ?', (feed_url,)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def save_feed_state(self, feed_url, etag, last_modified):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?)', (feed_url, etag, last_modified))
+
+    # 古い送信済みの記録を削除し、削除した件数を返す
+    def prune(self, max_age_days=INGEST_SENT_TTL_DAYS, now=None):
+        cutoff = (now or time.time()) - max_age_days * 86400
+        with self.lock, self.db:
+            return self.db.execute('DELETE FROM sent WHERE sent_at < ?', (cutoff,)).rowcount
+
+
+# 送信済みの記事とフィードの状態をGCSのバケットに保存する（インスタンスの間で共有し、コールドスタートでも失われない）
+class GCSIngestionState:
+    def __init__(self, bucket_name=INGEST_STATE_BUCKET, prefix=INGEST_STATE_PREFIX, client=None):
+        self.client = client or storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        self.prefix = prefix
+
+    # URLなどのキーはオブジェクト名に使えない文字を含むのでハッシュにする
+    def _blob(self, kind, key):
+        return self.bucket.blob(f'{self.prefix}{kind}/{hashlib.sha1(key.encode("utf-8")).hexdigest()}.json')
+
+    def is_sent(self, key):
+        return self._blob('sent', key).exists()
+
+    def mark_sent(self, key, source, now=None):
+        self._blob('sent', key).upload_from_string(json.dumps({"key": key, "source": source, "sent_at": now or time.time()}), content_type='application/json')
+
+    def feed_state(self, feed_url):
+        try:
+            state = json.loads(self._blob('feeds', feed_url).download_as_text())
+        except NotFound:
+            return None, None
+        return state.get('etag'), state.get('last_modified')
+
+    def save_feed_state(self, feed_url, etag, last_modified):
+        self._blob('feeds', feed_url).upload_from_string(
+            json.dumps({"url": feed_url, "etag": etag, "last_modified": last_modified}), content_type='application/json'
+        )
+
+    # 作成から日数が経った送信済みの記録を削除する（バケットのライフサイクルルールを設定している場合は不要）
+    def prune(self, max_age_days=INGEST_SENT_TTL_DAYS, now=None):
+        cutoff = (now or time.time()) - max_age_days * 86400
+        deleted = 0
+        for blob in self.client.list_blobs(self.bucket, prefix=f'{self.prefix}sent/'):
+            if blob.time_created and blob.time_created.timestamp() < cutoff:
+                try:
+                    blob.delete()
+                    deleted += 1
+                except NotFound:
+                    pass
+        return deleted
+
+
+# 環境変数に応じて状態の保存先を選ぶ（バケットがなければこのインスタンスのSQLite）
+def init_state():
+    if INGEST_STATE_BUCKET:
+        return GCSIngestionState()
+    if os.getenv('K_SERVICE'):
+        logging.warning("INGEST_STATE_BUCKETが設定されていないため、送信済みの記事とフィードの状態はインスタンスごとになります")
+    return LocalIngestionState()
+
+
+class IngestionQueue:
+    def __init__(self, topic=INGEST_TOPIC, state=None, publisher=None):
+        batch_settings = pubsub_v1.types.BatchSettings(max_messages=BATCH_MAX_MESSAGES, max_latency=BATCH_MAX_LATENCY)
+        self.publisher = publisher or pubsub_v1.PublisherClient(batch_settings)
+        self.topic_path = self.publisher.topic_path(GCP_PROJECT_ID, topic)
+        self.state = state or init_state()
+        self.lock = threading.Lock()
+        # 送信中の記事（送信に成功したら状態に記録する）
+        self.in_flight = set()
+        self.futures = []
+
+    def _mark_sent(self, item, future):
+        key = item.key()
+        try:
+            if future.exception() is None:
+                self.state.mark_sent(key, item.source)
+            else:
+                logging.error(f"キューへの送信に失敗しました: {item.url}: {future.exception()}")
+        except Exception as e:
+            logging.error(f"送信済みの記録に失敗しました: {item.url}: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(key)
+
+    # 記事をキューに送る（スキップ対象や送信済みの記事はNoneを返す）
+    def put(self, item):
+        if not item.title or not item.url:
+            return None
+        if fetch_scheduler.is_skipped_url(item.url):
+            logging.info(f"スキップするドメインのURLです: {item.url}")
+            return None
+        key = item.key()
+        with self.lock:
+            if key in self.in_flight:
+                return None
+            self.in_flight.add(key)
+        try:
+            sent = self.state.is_sent(key)
+        except Exception:
+            with self.lock:
+                self.in_flight.discard(key)
+            raise
+        if sent:
+            with self.lock:
+                self.in_flight.discard(key)
+            logging.info(f"キューに送信済みの記事です: {item.source} {item.url}")
+            return None
+        future = self.publisher.publish(self.topic_path, item.to_message())
+        future.add_done_callback(lambda done: self._mark_sent(item, done))
+        self.futures.append(future)
+        return future
+
+    # 複数の記事をキューに送り、送った件数を返す
+    def put_many(self, items):
+        return sum(1 for item in items if self.put(item) is not None)
+
+    # まとめている送信がすべて終わるまで待つ
+    def flush(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    # 条件付きGETでフィードを取得し、変わっていればNewsItemのリストを返す
+    def poll_feed(self, feed_url):
+        etag, last_modified = self.state.feed_state(feed_url)
+        headers = {'User-Agent': fetch_scheduler.USER_AGENT}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = requests.get(feed_url, headers=headers, timeout=FEED_TIMEOUT)
+        if response.status_code == 304:
+            return []
+        response.raise_for_status()
+        items = parse_feed(response.content, feed_url)
+        self.state.save_feed_state(feed_url, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return items
+
+
+QUEUE = None
+
+
+# 共通の処理キュー（最初に使うときに作る）
+def get_queue():
+    global QUEUE
+    if QUEUE is None:
+        QUEUE = IngestionQueue()
+    return QUEUE
+
+
+# RSS/Atomのフィードを巡回してキューに送るエントリポイント（Cloud Schedulerから起動する）
+def poll_feeds(event, context):
+    queue = get_queue()
+    sent = 0
+    for feed_url in RSS_FEEDS:
+        try:
+            sent += queue.put_many(queue.poll_feed(feed_url))
+        except Exception as e:
+            logging.error(f"フィードの取得中にエラーが発生しました: {feed_url}: {e}")
+    queue.flush()
+    logging.info(f"フィードから{sent}件の記事をキューに送りました")
+    # 古い送信済みの記録を削除する
+    try:
+        pruned = queue.state.prune()
+        if pruned:
+            logging.info(f"{INGEST_SENT_TTL_DAYS:.0f}日より古い送信済みの記録を{pruned}件削除しました")
+    except Exception as e:
+        logging.warning(f"送信済みの記録の削除に失敗しました: {e}")
+
+
+if __name__ == "__main__":
+    poll_feeds(None, None)
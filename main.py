@@ -2,13 +2,17 @@ import os
 import requests
 import base64
 import json
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
 import gspread
-from backoff import on_exception, expo
-from requests.exceptions import RequestException
 import time
-from google.cloud import pubsub_v1
 import logging
+import processed_index
+import dead_letter
+import ingestion
+import headline_batch
+import record_store
+import spend_ledger
+import resilience
 
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,9 +23,13 @@ GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')
 
 # エラーハンドリング用の最大リトライ回数
 MAX_RETRIES = 3
+# Hacker News APIのタイムアウト（秒）
+HN_API_TIMEOUT = 10
 
-# Hacker News APIの基本URL
-HN_API_BASE = 'https://hacker-news.firebaseio.com/v0'
+# Hacker News APIの基本URL（ローカルのスタンドインで試す場合は環境変数で差し替える）
+HN_API_BASE = os.getenv('HN_API_BASE', 'https://hacker-news.firebaseio.com/v0')
+# デッドレターに記録するHNの記事ページのURL
+HN_ITEM_URL = 'https://news.ycombinator.com/item?id={}'
 
 # Base64エンコードされたGoogleクレデンシャルをデコード
 creds_json = base64.b64decode(GOOGLE_CREDENTIALS_BASE64).decode('utf-8')
@@ -31,23 +39,36 @@ creds = json.loads(creds_json)
 gc = gspread.service_account_from_dict(creds)
 sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
 
-# API呼び出しのリトライ用デコレータ
-@on_exception(expo, RequestException, max_tries=MAX_RETRIES)
-# Hacker News APIを呼び出す関数
+# 書き込み済みのID（D列）のインデックス
+processed_ids = processed_index.ProcessedIndex(sheet, 4, 'hn_items')
+# 書き込みはローカルのストアに行い、シートにはバックグラウンドで同期する（キーはD列のID）
+record_store.register_sheet('hn_items', sheet, 4)
+# 英語のタイトルはまとめて日本語の見出しにする（E列）
+headline_batch.register('hn_items')
+
+# Hacker News APIを呼び出す関数（再試行とサーキットブレーカーはresilience.pyで共通）
 def fetch_hn_api(endpoint):
-    try:
-        url = f'{HN_API_BASE}/{endpoint}.json'
-        response = requests.get(url)
+    url = f'{HN_API_BASE}/{endpoint}.json'
+
+    def get():
+        response = requests.get(url, timeout=HN_API_TIMEOUT)
         response.raise_for_status()
         return response.json()
-    except RequestException as e:
+
+    try:
+        return resilience.call('hn_api', get, max_attempts=MAX_RETRIES)
+    except Exception as e:
         logging.error(f"Hacker News APIの呼び出し中にエラーが発生しました: {e}")
         raise
 
 def get_last_checked_id():
+    # ローカルのストアに書き込んだ最新のIDを使う（まだない場合はシートを読む）
+    last_id = record_store.STORE.max_int_key('hn_items')
+    if last_id:
+        return int(last_id)
     # F1セルから最後にチェックしたIDを取得
     cell = 'F1'
-    value = sheet.acell(cell).value
+    value = resilience.call('sheets', sheet.acell, cell).value
     if not value:
         raise ValueError(f"{cell}セルに最新の記事IDが存在しません。")
     return int(value)
@@ -58,21 +79,61 @@ def update_news_on_sheet(last_checked_id):
     new_news_ids = fetch_hn_api('newstories')
     
     new_news_ids = [news_id for news_id in new_news_ids if last_checked_id < news_id <= maxitem]
+    # 書き込み済みのIDはAPIを呼ばずにスキップ
+    new_news_ids = [news_id for news_id in new_news_ids if not processed_ids.contains(news_id)]
     
     for count, news_id in enumerate(new_news_ids):
-        try:
-            news_data = fetch_hn_api(f'item/{news_id}')
-            if news_data and not news_data.get('dead'):
-                row = write_news_to_sheet(news_data)
-                publish_to_topic(row)
-        except Exception as e:
-            logging.error(f"Non-fatal exception caught: {e}")
+        process_news_item(news_id)
         
         time.sleep(1)
         if count % 10 == 9:
             time.sleep(5)
 
-# スプレッドシートに書き込む関数
+# 1件のニュースを取得して書き込み、Pub/Subに送る関数（失敗したらデッドレターに記録する）
+# story_onlyがTrueの場合は記事以外（コメントなど）を書き込まない
+def process_news_item(news_id, story_only=False):
+    stage = 'fetch'
+    news_data = None
+    row = None
+    try:
+        news_data = fetch_hn_api(f'item/{news_id}')
+        if not news_data or news_data.get('dead'):
+            return True
+        if story_only and news_data.get('type') != 'story':
+            return True
+        stage = 'write'
+        row = write_news_to_sheet(news_data)
+        stage = 'publish'
+        publish_to_topic(row, news_data)
+        return True
+    except Exception as e:
+        logging.error(f"Non-fatal exception caught: {e}")
+        dead_letter.record(
+            'hn_item',
+            HN_ITEM_URL.format(news_id),
+            stage,
+            e,
+            title=news_data.get('title') if news_data else None,
+            payload={"id": news_id, "row": row, "news_data": news_data}
+        )
+        return False
+
+# デッドレターに記録されたニュースを再処理する関数（dead_letter_sweeper.pyから呼ばれる）
+def redrive_dead_letter(letter):
+    payload = letter['payload']
+    # 書き込み済みでPub/Subへの送信だけ失敗した場合は送信だけやり直す
+    if letter['stage'] == 'publish' and payload.get('row'):
+        try:
+            publish_to_topic(payload['row'], payload.get('news_data'))
+            return True
+        except Exception as e:
+            dead_letter.record('hn_item', letter['url'], 'publish', e, title=letter['title'], payload=payload)
+            return False
+    if processed_ids.contains(payload['id']):
+        return True
+    return process_news_item(payload['id'])
+
+# ローカルのストアに書き込む関数（スプレッドシートには同期のスレッドがまとめて書き込む）
 def write_news_to_sheet(news_data):
     datetime_jst = datetime.utcfromtimestamp(news_data['time']) + timedelta(hours=9)
     row = [
@@ -82,38 +143,26 @@ def write_news_to_sheet(news_data):
         news_data.get('id')
     ]
     try:
-        write_to_sheet_with_retry(row)
-        logging.info(f"ニュース {news_data.get('id')} をスプレッドシートに書き込みました。")
+        record_store.write('hn_items', news_data.get('id'), row, url=news_data.get('url'))
+        processed_ids.add(news_data.get('id'))
+        logging.info(f"ニュース {news_data.get('id')} をローカルのストアに書き込みました。")
     except Exception as e:
-        logging.error(f"ニュース {news_data.get('id')} のスプレッドシートへの書き込みに失敗しました: {e}")
-    time.sleep(1)
-
-@on_exception(expo, (gspread.exceptions.APIError, gspread.exceptions.GSpreadException), max_tries=MAX_RETRIES)
-def write_to_sheet_with_retry(row):
-    try:
-        index = 2  # 新しいエントリを挿入する行のインデックス
-        sheet.insert_row(row, index=index)
-    except Exception as e:
-        logging.error(f"Googleスプレッドシートへの書き込み中にエラーが発生しました: {e}")
+        logging.error(f"ニュース {news_data.get('id')} の書き込みに失敗しました: {e}")
         raise
+    return row
 
-def publish_to_topic(row):
+def publish_to_topic(row, news_data=None):
     try:
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = publisher.topic_path('あなたのGCPプロジェクトID', 'あなたのトピック名')
-
-        # rowからタイトルとURLを取得
-        message_data = {
-            "title": row[1],  # タイトル
-            "url": row[2]     # URL
-        }
-
-        # メッセージデータをJSON形式にエンコード
-        data = json.dumps(message_data).encode("utf-8")
-        
-        # データをパブリッシュ
-        publisher.publish(topic_path, data)
-        logging.info("Data published to Pub/Sub")
+        # 他の入口と同じ形式（NewsItem）にそろえて共通の処理キューに送る
+        if news_data:
+            item = ingestion.hn_news_item(news_data)
+        else:
+            item = ingestion.NewsItem(source='hn', title=row[1], url=row[2])
+        future = ingestion.get_queue().put(item)
+        # 送信の失敗をデッドレターに記録できるように完了を待つ
+        if future:
+            future.result()
+            logging.info("Data published to Pub/Sub")
     except Exception as e:
         logging.error(f"Pub/Subへのパブリッシュ中にエラーが発生しました: {e}")
         raise
@@ -123,6 +172,11 @@ def check_and_update_new_hn_content(event, context):
         logging.info("Starting update process...")
         last_checked_id = get_last_checked_id()
         update_news_on_sheet(last_checked_id)
+        # 関数が終わる前に見出しを付け、シートへの同期を済ませる
+        headline_batch.flush()
+        record_store.flush()
+        spend_ledger.flush()
+        resilience.log_status()
         logging.info("Update process completed.")
     except Exception as e:
         logging.error(f"An error occurred during the update process: {e}")
@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+import prompt_builder
+import spend_ledger
+
+# 呼び出しごとにモデルを選ぶルーティング層。
+# 入力のトークン数、記事の予測スコア（または前回のスコア）、レート制限の残りからモデルを決め、
+# カスケードでは安いモデルから試して検証に失敗したときだけ上位のモデルに切り替える。
+# 直近の支出が予算に近づいている間（spend_ledger.py）は、予測スコアに関係なく安いモデルだけを使う。
+
+# 用途ごとのモデルの候補（安い順）
+STAGE_MODELS = {
+    "summary": ["gpt-3.5-turbo-1106", "gpt-4-1106-preview"],
+    "lead": ["gpt-3.5-turbo-1106", "gpt-4"],
+    "score": ["gpt-3.5-turbo-1106", "gpt-4-1106-preview"],
+    "opinion": ["gpt-3.5-turbo-1106"],
+    "headline": ["gpt-3.5-turbo-1106"],
+}
+
+# 予測スコア（0-1）がこれ以上の記事には上位のモデルを使う（関連度ゲートはこれ未満の記事を'cheap'と判定する）
+PREMIUM_VALUE = float(os.getenv('ROUTER_PREMIUM_VALUE', '0.45'))
+# レート制限の残りがこの割合を下回ったモデルは避ける
+MIN_HEADROOM = float(os.getenv('ROUTER_MIN_HEADROOM', '0.1'))
+
+# モデルごとのレート制限の状態 {model: (残りトークン, 上限, 回復する時刻)}
+RATE_LIMITS = {}
+RATE_LIMITS_LOCK = threading.Lock()
+
+
+# "6m0s"や"1.5s"、"20ms"の形式の時間を秒に変換する
+def parse_reset_seconds(value):
+    seconds = 0.0
+    number = ''
+    i = 0
+    while i < len(value):
+        character = value[i]
+        if character.isdigit() or character == '.':
+            number += character
+        elif value.startswith('ms', i):
+            seconds += float(number or 0) / 1000
+            number = ''
+            i += 1
+        elif character in 'hms':
+            seconds += float(number or 0) * {'h': 3600, 'm': 60, 's': 1}[character]
+            number = ''
+        i += 1
+    return seconds
+
+
+# レスポンスヘッダーからレート制限の残りを記録する
+def record_rate_limits(model, headers):
+    try:
+        remaining = int(headers['x-ratelimit-remaining-tokens'])
+        limit = int(headers['x-ratelimit-limit-tokens'])
+        reset_at = time.monotonic() + parse_reset_seconds(headers.get('x-ratelimit-reset-tokens', '0s'))
+    except (KeyError, ValueError, TypeError):
+        return
+    with RATE_LIMITS_LOCK:
+        RATE_LIMITS[model] = (remaining, limit, reset_at)
+
+
+# レート制限の残りの割合（情報がない、または回復済みなら1.0）
+def headroom(model):
+    with RATE_LIMITS_LOCK:
+        state = RATE_LIMITS.get(model)
+    if not state:
+        return 1.0
+    remaining, limit, reset_at = state
+    if time.monotonic() >= reset_at or limit <= 0:
+        return 1.0
+    return remaining / limit
+
+
+# 入力と出力がコンテキストに収まるか
+def fits_context(model, input_tokens, max_output_tokens):
+    context = prompt_builder.MODEL_CONTEXT_TOKENS.get(model, prompt_builder.DEFAULT_CONTEXT_TOKENS)
+    return input_tokens + max_output_tokens <= context
+
+
+# 用途と入力からモデルを選ぶ（decisionは関連度ゲートの判定）
+def route(stage, input_tokens, max_output_tokens, decision=None):
+    candidates = [model for model in STAGE_MODELS[stage] if fits_context(model, input_tokens, max_output_tokens)]
+    if not candidates:
+        # どれにも収まらない場合は一番コンテキストの長いモデル（本文はprompt_builderで切り詰められる）
+        candidates = sorted(STAGE_MODELS[stage], key=lambda model: prompt_builder.MODEL_CONTEXT_TOKENS.get(model, 0))[-1:]
+
+    # 関連度ゲートが'cheap'と判定した記事以外は上位のモデルを使う（判定がなければ上位のモデル）
+    if spend_ledger.pressure() != 'ok':
+        logging.info(f"支出が予算に近づいているため安いモデルを使います: {stage}")
+        preferred = candidates
+    elif decision != 'cheap':
+        preferred = list(reversed(candidates))
+    else:
+        preferred = candidates
+
+    for model in preferred:
+        if headroom(model) >= MIN_HEADROOM:
+            break
+    else:
+        model = preferred[-1]
+    logging.info(f"モデルを選択: {stage} -> {model}（入力{input_tokens}トークン、関連度ゲートの判定{decision}）")
+    return model
+
+
+# 用途の一番安いモデル
+def cheapest(stage):
+    return STAGE_MODELS[stage][0]
+
+
+# 安いモデルから順に試し、validateに通った出力を返す（すべて失敗した場合は最後の出力）
+def cascade(stage, call, validate, input_tokens, max_output_tokens):
+    candidates = [model for model in STAGE_MODELS[stage] if fits_context(model, input_tokens, max_output_tokens)] or STAGE_MODELS[stage][-1:]
+    # 支出が予算に近づいている間は上位のモデルで再試行しない
+    if spend_ledger.pressure() != 'ok':
+        candidates = candidates[:1]
+    output = None
+    for model in candidates:
+        last = model == candidates[-1]
+        if not last and headroom(model) < MIN_HEADROOM:
+            continue
+        try:
+            output = call(model)
+        except Exception as e:
+            if last:
+                raise
+            logging.warning(f"呼び出しに失敗したため上位のモデルで再試行します: {stage} {model}: {e}")
+            continue
+        if validate(output):
+            return output
+        logging.info(f"出力の検証に失敗したため上位のモデルで再試行します: {stage} {model}")
+    return output
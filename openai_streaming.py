@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+import httpx
+import openai
+from openai import OpenAI
+import model_router
+import resilience
+import spend_ledger
+
+# チャット補完をストリーミングで受け取り、最初のトークンまでの期限と全体の期限を守るためのモジュール。
+# 期限は見張りのスレッドで守り、過ぎたら接続を閉じて途中までの出力（最初のトークンの前なら空）を返す。
+
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# 最初のトークンが届くまでの期限（秒）
+FIRST_TOKEN_TIMEOUT = float(os.getenv('OPENAI_FIRST_TOKEN_TIMEOUT', '30'))
+# チャンクの間隔がこれを超えたら止まったものとみなす（秒。httpxの読み込みのタイムアウト）
+STALL_TIMEOUT = float(os.getenv('OPENAI_STALL_TIMEOUT', '30'))
+# 呼び出し全体の期限（秒）
+TOTAL_TIMEOUT = float(os.getenv('OPENAI_TOTAL_TIMEOUT', '120'))
+CONNECT_TIMEOUT = 10
+
+CLIENT = None
+
+
+# 期限つきの呼び出しはSDKの自動リトライを使わない（リトライで期限を超えてしまうため）
+def init_openai():
+    global CLIENT
+    if CLIENT is None:
+        CLIENT = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    return CLIENT
+
+
+@dataclass
+class StreamResult:
+    text: str
+    # 期限やストリームの停止で打ち切った場合はTrue
+    truncated: bool
+    # モデルの終了理由、または打ち切った理由（first_token_timeout、deadline、stalled）
+    finish_reason: str
+    first_token_seconds: float
+    total_seconds: float
+
+
+# ストリーミングでチャット補完を呼び出す（stageは支出の台帳に記録する段階）
+def stream_chat_completion(model, temperature, messages, max_tokens, first_token_timeout=FIRST_TOKEN_TIMEOUT, total_timeout=TOTAL_TIMEOUT, stage="stream", stall_timeout=STALL_TIMEOUT):
+    spend_ledger.throttle(stage)
+    client = init_openai()
+    start = time.monotonic()
+    # readは読み込みごとの待ち時間なので、チャンクの間隔の上限になる（最初のトークンと全体の期限は下の見張りで守る）
+    timeout = httpx.Timeout(total_timeout, connect=CONNECT_TIMEOUT, read=stall_timeout)
+    # 期限があるので再試行はしないが、OpenAIの障害中はすぐ失敗させる
+    raw_response = resilience.call(
+        'openai',
+        client.chat.completions.with_raw_response.create,
+        max_attempts=1,
+        model=model,
+        temperature=temperature,
+        messages=messages,
+        max_tokens=max_tokens,
+        stream=True,
+        # 最後のチャンクで使用量を受け取る
+        stream_options={"include_usage": True},
+        timeout=timeout
+    )
+    # レート制限の残りをモデルの選択に使う
+    model_router.record_rate_limits(model, raw_response.headers)
+    stream = raw_response.parse()
+
+    # 最初のトークンの期限と全体の期限を見張り、過ぎたら接続を閉じて読み込み中のストリームも止める
+    first_token = threading.Event()
+    finished = threading.Event()
+    cancelled = threading.Event()
+    cancel_reason = []
+
+    def watch():
+        if not first_token.wait(max(start + min(first_token_timeout, total_timeout) - time.monotonic(), 0)):
+            reason = 'first_token_timeout' if first_token_timeout < total_timeout else 'deadline'
+        elif not finished.wait(max(start + total_timeout - time.monotonic(), 0)):
+            reason = 'deadline'
+        else:
+            return
+        if finished.is_set():
+            return
+        cancel_reason.append(reason)
+        cancelled.set()
+        stream.close()
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+
+    pieces = []
+    first_token_seconds = None
+    finish_reason = None
+    usage = None
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta and choice.delta.content:
+                if first_token_seconds is None:
+                    first_token_seconds = time.monotonic() - start
+                    first_token.set()
+                pieces.append(choice.delta.content)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    except Exception as e:
+        # 見張りが接続を閉じた場合は、読み込み側で何が送出されても（httpx.StreamClosedなど）途中までの出力を返す
+        if not cancelled.is_set():
+            if not isinstance(e, (httpx.HTTPError, openai.APIError)):
+                raise
+            # 最初のトークンが来ないまま止まった場合は部分的な出力もないのでエラーにする
+            if not pieces:
+                raise TimeoutError(f"OpenAIのストリームが応答しませんでした: {model}: {e}") from e
+            logging.warning(f"OpenAIのストリームが途中で止まったため部分的な出力を返します: {model}: {e}")
+            finish_reason = None
+            cancel_reason.append('stalled')
+    finally:
+        finished.set()
+        first_token.set()
+        stream.close()
+
+    if cancelled.is_set():
+        finish_reason = None
+    result = StreamResult(
+        text=''.join(pieces),
+        truncated=finish_reason is None,
+        finish_reason=finish_reason or (cancel_reason[0] if cancel_reason else 'incomplete'),
+        first_token_seconds=first_token_seconds if first_token_seconds is not None else -1.0,
+        total_seconds=time.monotonic() - start
+    )
+    # 途中で打ち切った場合は使用量が届かないのでトークン数を数えて記録する
+    if usage:
+        spend_ledger.record_usage(model, stage, usage)
+    else:
+        spend_ledger.record_estimate(model, stage, messages, result.text)
+    if result.truncated:
+        logging.warning(f"期限内に生成が終わらなかったため途中までの出力を使います: {model} {len(result.text)}文字（{result.finish_reason}）")
+    logging.info(f"OpenAIストリーミング: {model} 最初のトークンまで{result.first_token_seconds:.1f}秒、合計{result.total_seconds:.1f}秒、終了理由={result.finish_reason}")
+    return result
@@ -0,0 +1,68 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup
+import text_compactor
+
+# HTMLのパース、本文のコンパクション、トークン数の計算のようにCPUを使う処理を、プロセスプールで実行するためのモジュール。
+# ワーカーはこのモジュールだけを読み込む（gspreadやOpenAIのクライアントは作らない）。HTMLを渡してテキストだけを受け取る。
+
+# ワーカーのプロセス数（0ならプールを使わず呼び出し元のスレッドで処理する）
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', str(os.cpu_count() or 1)))
+# プールに同時に渡せるパースの数（超えた場合は空くまで待つ）
+PARSE_QUEUE_SIZE = int(os.getenv('PARSE_QUEUE_SIZE', str(max(PARSE_WORKERS, 1) * 2)))
+PARSE_TIMEOUT = 120
+
+POOL = None
+POOL_LOCK = threading.Lock()
+QUEUE_SLOTS = threading.BoundedSemaphore(PARSE_QUEUE_SIZE)
+
+
+# ワーカーのロギングの設定
+def init_worker():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# 文書をパースして要約に渡すテキストにする（'html'以外はHTMLとしてパースしない）
+def parse_document(kind, content):
+    if kind != 'html':
+        return text_compactor.compact_text(content)
+
+    # HTMLコンテンツをBeautiful Soupでパース
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # ヘッダーとフッターを削除（もし存在する場合）
+    header = soup.find('header')
+    if header:
+        header.decompose()
+
+    footer = soup.find('footer')
+    if footer:
+        footer.decompose()
+
+    # JavaScriptとCSSを削除
+    for script in soup(["script", "style"]):
+        script.decompose()
+
+    # 繰り返し、定型文、コメント欄、長いコードや表を取り除いてテキストのみを取得（チャンクに分割できるように改行は残す）
+    return text_compactor.compact(soup)
+
+
+# プロセスプールを取得する（最初に使うときに作る）
+def get_pool():
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            # 呼び出し元のスレッドやクライアントを引き継がないようにforkではなくspawnで起動する
+            POOL = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker)
+        return POOL
+
+
+# プロセスプールで文書をパースする（プールが満杯の間は待つ）
+def parse_in_pool(kind, content):
+    if PARSE_WORKERS <= 0:
+        return parse_document(kind, content)
+    with QUEUE_SLOTS:
+        return get_pool().submit(parse_document, kind, content).result(timeout=PARSE_TIMEOUT)
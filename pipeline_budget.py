@@ -0,0 +1,83 @@
+import logging
+import os
+import threading
+import time
+import prompt_builder
+
+# 1記事あたりの時間とコストの予算。heavy_taskの各段階の間で残りを確認し、足りない場合は段階的に処理を軽くする。
+# 途中で関数がタイムアウトして何も残らないより、一部が欠けた行でも書き込む方がよい。
+
+# Cloud Functionのタイムアウト（秒）と、書き込みのために残しておく時間
+FUNCTION_TIMEOUT_SECONDS = float(os.getenv('FUNCTION_TIMEOUT_SECONDS', '540'))
+WRITE_RESERVE_SECONDS = float(os.getenv('WRITE_RESERVE_SECONDS', '30'))
+# 1記事あたりのコストの上限（ドル）
+ARTICLE_COST_BUDGET = float(os.getenv('ARTICLE_COST_BUDGET', '0.30'))
+
+# 各段階にかかる時間の目安（秒）
+STAGE_SECONDS = {
+    "refine": 150,
+    "final_summary": 60,
+    "lead": 20,
+    "lead_cheap": 8,
+    "opinions": 40,
+}
+
+# 1000トークンあたりの料金（ドル、入力と出力）
+MODEL_PRICES = {
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+}
+
+# 余裕がないときに1回で要約する本文の長さ
+SINGLE_SHOT_TEXT_LENGTH = 10000
+
+
+# 呼び出し1回のコストを見積もる
+def estimate_cost(model, input_tokens, output_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES["gpt-4"])
+    return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+
+class ArticleBudget:
+    def __init__(self, seconds=FUNCTION_TIMEOUT_SECONDS - WRITE_RESERVE_SECONDS, cost=ARTICLE_COST_BUDGET):
+        self.deadline = time.monotonic() + seconds
+        self.cost_limit = cost
+        self.spent = 0.0
+        self.lock = threading.Lock()
+        # 軽くした段階の記録（ログ用）
+        self.degraded = []
+
+    # 残り時間（秒）
+    def remaining_seconds(self):
+        return self.deadline - time.monotonic()
+
+    # 残りのコスト
+    def remaining_cost(self):
+        return self.cost_limit - self.spent
+
+    # 呼び出しのコストを記録する
+    def charge(self, model, messages, output_text):
+        input_tokens = sum(prompt_builder.count_tokens(message["content"], model) for message in messages)
+        output_tokens = prompt_builder.count_tokens(output_text or "", model)
+        # 段階を並行して実行するため
+        with self.lock:
+            self.spent += estimate_cost(model, input_tokens, output_tokens)
+
+    # 段階を実行する時間とコストが残っているか
+    def can_afford(self, stage, model=None, input_tokens=0, max_output_tokens=0):
+        if self.remaining_seconds() < STAGE_SECONDS[stage]:
+            return False
+        if model and estimate_cost(model, input_tokens, max_output_tokens) > self.remaining_cost():
+            return False
+        return True
+
+    # ストリーミング呼び出しに渡す全体の期限
+    def call_timeout(self, default):
+        return max(min(default, self.remaining_seconds()), 1)
+
+    # 軽くした段階を記録する
+    def degrade(self, step):
+        self.degraded.append(step)
+        logging.warning(f"時間またはコストが足りないため処理を軽くします: {step}（残り{self.remaining_seconds():.0f}秒、${self.remaining_cost():.3f}）")
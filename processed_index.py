@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from urllib.parse import urlsplit, urlunsplit
+import resilience
+
+# 処理済みの記事URLやHNのIDを覚えておき、再処理や重複行の書き込みを防ぐためのインデックス。
+# 起動時にスプレッドシートの列を一括で読み込み、ローカルのSQLiteにも控えておく。
+
+PROCESSED_INDEX_DB = os.getenv('PROCESSED_INDEX_DB', '/tmp/autonews_processed_index.sqlite3')
+
+
+# URLやIDを正規化してハッシュ化する（フラグメントや末尾のスラッシュの違いは同じものとして扱う）
+def item_key(value):
+    value = str(value).strip()
+    if value.startswith(('http://', 'https://')):
+        parts = urlsplit(value)
+        value = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), parts.query, ''))
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class ProcessedIndex:
+    def __init__(self, worksheet, column, name, db_path=PROCESSED_INDEX_DB):
+        self.worksheet = worksheet
+        self.column = column
+        self.name = name
+        self.lock = threading.Lock()
+        self.keys = set()
+        # 処理中のキー（同じプロセス内で同じ記事が並行して処理されるのを防ぐ）
+        self.in_flight = set()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS processed (name TEXT, key TEXT, PRIMARY KEY (name, key))')
+        self.load()
+
+    # スプレッドシートの列とSQLiteの内容を読み込む
+    def load(self):
+        rows = self.db.execute('SELECT key FROM processed WHERE name = ?', (self.name,)).fetchall()
+        keys = {row[0] for row in rows}
+        try:
+            values = resilience.call('sheets', self.worksheet.col_values, self.column)
+            sheet_keys = {item_key(value) for value in values if value}
+        except Exception as e:
+            logging.warning(f"処理済みインデックスの読み込み中にエラーが発生しました: {e}")
+            sheet_keys = set()
+
+        with self.lock:
+            self.keys = keys | sheet_keys
+            missing = sheet_keys - keys
+            if missing:
+                with self.db:
+                    self.db.executemany('INSERT OR IGNORE INTO processed (name, key) VALUES (?, ?)', [(self.name, key) for key in missing])
+        logging.info(f"処理済みインデックスを読み込みました: {self.name} {len(self.keys)}件")
+
+    # 処理済みかどうか
+    def contains(self, value):
+        return item_key(value) in self.keys
+
+    # 未処理かつ処理中でなければ処理中として確保する
+    def claim(self, value):
+        key = item_key(value)
+        with self.lock:
+            if key in self.keys or key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+            return True
+
+    # 処理に失敗した場合に確保を解除する
+    def release(self, value):
+        with self.lock:
+            self.in_flight.discard(item_key(value))
+
+    # 処理済みとして記録する（スプレッドシートへの書き込みと同じタイミングで呼ぶ）
+    def add(self, *values):
+        keys = [item_key(value) for value in values]
+        with self.lock:
+            self.keys.update(keys)
+            self.in_flight.difference_update(keys)
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO processed (name, key) VALUES (?, ?)', [(self.name, key) for key in keys])
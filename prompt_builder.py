@@ -0,0 +1,123 @@
+import json
+import logging
+import tiktoken
+
+# OpenAIに送るメッセージを組み立てるモジュール。
+# システムプロンプトは記事に依存しない固定の文章にし（先頭が毎回同じなのでプロンプトキャッシュが効く）、本文はユーザーメッセージで1回だけ送る。
+
+SCORE_KEYS = ["importance", "timeliness", "objectivity", "originality", "target_audience", "diversity", "relation_to_advertising", "security_issues", "social_responsibility", "social_significance"]
+
+# 用途ごとの固定のシステムプロンプト
+SYSTEM_PROMPTS = {
+    # content_fetcher.pyの要約
+    "summarize": "あなたは優秀な要約アシスタントです。ユーザーが送る文章の内容をできる限り多くの情報を残しながら日本語で要約して出力してください。",
+    # content_fetcher2.pyの最終要約
+    "condense": "ユーザーが送る文章を簡潔にまとめて下さい。",
+    # content_fetch_1201.pyの要約
+    "summarize_article": "あなたは優秀な要約アシスタントです。提供された文章の内容を出来る限り残しつつ、日本語で要約してください。",
+    "refine_summary": "あなたは優秀な要約アシスタントです。提供された文章の内容を出来る限り残しつつ、日本語で要約してください。テーマごとに分割してリスト形式にすることは行わないでください。",
+    # 同じ出来事についての複数の記事をまとめた要約（story_clusters.py）
+    "merge_sources": "ユーザーが送る複数の出典は同じ出来事についての記事です。重複する内容は1つにまとめ、出典によって異なる点があれば明記して、日本語で簡潔に1つの要約にまとめて下さい。",
+    "lead": "あなたは優秀なライターです。この要約のリード文（導入部）を簡潔に1～2センテンス程度でで作成してください。",
+    "opinion": "提供された文章の内容に対し、以下の人物として日本語で意見を生成してください。",
+    # 複数の記事のタイトルをまとめて日本語の見出しにする（headline_batch.py）
+    "headline": (
+        "あなたは優秀な先進技術メディアの編集者です。ユーザーが送るJSONの配列の各記事（id、title、leadがあればその記事のリード文）について、"
+        "タイトルを日本語の見出し（40文字程度まで、固有名詞や製品名は原文のまま）に翻訳または書き直してください。"
+        "{\"headlines\": [{\"id\": 記事のid, \"headline\": 見出し}]}の形式のJSONで、すべての記事について返してください。"
+    ),
+    # スコアリング（以前はJSONスキーマ全文を埋め込んでいたが、キーの一覧だけを渡す）
+    "score": (
+        "あなたは優秀な先進技術メディアのキュレーターです。信頼性,最新性,重要性,革新性,影響力,関連性,包括性,教育的価値,時事性,倫理性をもとに、"
+        "ユーザーが送る文章を10点満点でスコアリングして、JSON形式で返します。平均点は5点でスコアを付けるようにしてください。"
+        f"キーは{', '.join(SCORE_KEYS)}（それぞれ0-10の整数）と、各スコアの根拠を全項目について日本語1文で述べたreason（文字列）です。"
+    ),
+}
+
+# 以前は本文をシステムプロンプトにも埋め込んで2回送っていた用途
+DUPLICATED_BEFORE = {"summarize", "condense", "score"}
+
+# モデルごとのコンテキスト長
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-1106-preview": 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+# メッセージごとの書式分のトークン
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# エンコーディングを読み込めないときの1トークンあたりの文字数の目安（日本語が多いので少なめに見積もる）
+FALLBACK_CHARS_PER_TOKEN = 2
+
+ENCODINGS = {}
+
+
+# モデルに対応するエンコーディングを取得する（辞書ファイルをダウンロードできない場合はNone）
+def get_encoding(model):
+    if model not in ENCODINGS:
+        try:
+            try:
+                ENCODINGS[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                ENCODINGS[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.warning(f"tiktokenのエンコーディングを読み込めないため文字数で見積もります: {e}")
+            ENCODINGS[model] = None
+    return ENCODINGS[model]
+
+
+# トークン数を数える
+def count_tokens(text, model="gpt-3.5-turbo-1106"):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+# トークン数の上限に収まるように本文を切り詰める
+def truncate_to_tokens(text, max_tokens, model="gpt-3.5-turbo-1106"):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * FALLBACK_CHARS_PER_TOKEN]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+# メッセージを組み立てる（extraは固定部分の後ろに付け足すシステムプロンプト）
+def build_messages(kind, content, model, max_tokens, extra=None):
+    system = SYSTEM_PROMPTS[kind]
+    if extra:
+        system = f'{system}\n{extra}'
+
+    system_tokens = count_tokens(system, model)
+    content_tokens = count_tokens(content, model)
+
+    # 入力と出力の合計がコンテキスト長を超える場合は本文を切り詰める
+    budget = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - max_tokens - system_tokens - 2 * MESSAGE_OVERHEAD_TOKENS
+    if content_tokens > budget:
+        logging.warning(f"トークン数が上限を超えるため本文を切り詰めます: {kind} {content_tokens} -> {budget}")
+        content = truncate_to_tokens(content, max(budget, 0), model)
+        content_tokens = max(budget, 0)
+
+    saved_tokens = content_tokens if kind in DUPLICATED_BEFORE else 0
+    logging.info(f"プロンプト: {kind} {model} 入力{system_tokens + content_tokens}トークン（本文の重複送信の削減: {saved_tokens}トークン）")
+
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": content}
+    ]
+
+
+# スコアのJSONがすべてのキーを0-10の整数で持っているか
+def is_valid_score(text):
+    try:
+        score_json = json.loads(text)
+    except (TypeError, ValueError):
+        return False
+    if not isinstance(score_json, dict) or not score_json.get("reason"):
+        return False
+    return all(isinstance(score_json.get(key), int) and 0 <= score_json[key] <= 10 for key in SCORE_KEYS)
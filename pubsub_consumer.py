@@ -0,0 +1,155 @@
+import asyncio
+import importlib
+import logging
+import os
+import threading
+from google.cloud import pubsub_v1
+import admission
+import dead_letter
+import ingestion
+import record_store
+import spend_ledger
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# content_fetcher2.pyのmainを1メッセージ1起動で動かす代わりに、常駐プロセスでまとめて処理するためのエントリポイント。
+# Cloud Functionのコールドスタートやクライアント初期化を記事ごとに払わずに済む。
+# ingestion.pyの共通の処理キューを購読する場合は、記録元ごとのパイプラインに振り分ける。
+
+# 環境変数からサブスクリプションの設定を取得
+GCP_PROJECT_ID = os.getenv('GCP_PROJECT_ID')
+PUBSUB_SUBSCRIPTION = os.getenv('PUBSUB_SUBSCRIPTION')
+
+# フロー制御（同時に受け取る未処理メッセージの上限）
+MAX_OUTSTANDING_MESSAGES = int(os.getenv('MAX_OUTSTANDING_MESSAGES', '10'))
+MAX_OUTSTANDING_BYTES = int(os.getenv('MAX_OUTSTANDING_BYTES', str(10 * 1024 * 1024)))
+
+# パイプラインの同時実行数とキューの長さ
+PIPELINE_CONCURRENCY = int(os.getenv('PIPELINE_CONCURRENCY', '4'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', str(PIPELINE_CONCURRENCY)))
+
+# 記録元ごとのパイプライン（process_articleを持つモジュール、使うときに読み込む）
+PIPELINE_MODULES = {
+    "hn": "content_fetcher2",
+    "rss": "content_fetcher2",
+    "inoreader": "content_fetch_1201",
+}
+
+# 処理に失敗した記事を記録するデッドレターの記録元（dead_letter_sweeper.pyの再処理先と対応）
+DEAD_LETTER_SOURCES = {
+    "hn": "hn_article",
+    "rss": "hn_article",
+    "inoreader": "inoreader",
+}
+
+
+# メッセージを1件処理する関数（スプレッドシートへの書き込みが終わってからackする。queuedは待機中のメッセージ数）
+async def handle_message(message, queued=0):
+    try:
+        item = ingestion.NewsItem.from_message(message.data)
+        module_name = PIPELINE_MODULES[item.source]
+    except Exception as e:
+        # 壊れたメッセージは何度再送しても処理できないのでackして捨てる
+        logging.error(f"メッセージのデコードに失敗しました: {e}")
+        message.ack()
+        return
+
+    # 負荷が高い間は優先度の低い記事を後回しにするか捨てる。後回しにした記事はnackし、
+    # サブスクリプションの再試行ポリシー（最小バックオフ）の後にPub/Subから再配信させる
+    metadata = {**item.metadata, "source": item.source}
+    decision, ticket = admission.CONTROLLER.admit(item.source, item.title, item.url, metadata, queued=queued)
+    if decision == 'defer':
+        message.nack()
+        return
+    if decision == 'drop':
+        message.ack()
+        return
+
+    try:
+        # 同期処理のパイプラインはスレッドで実行する
+        pipeline = importlib.import_module(module_name)
+        done = await asyncio.to_thread(pipeline.process_article, item.title, item.url, metadata)
+    except Exception as e:
+        # 失敗した記事はデッドレターに記録してackし、再処理はdead_letter_sweeper.pyに任せる（Pub/Subの再配信と二重に再処理しない）
+        logging.error(f"記事の処理中にエラーが発生しました: {item.url}: {e}")
+        recorded = await asyncio.to_thread(dead_letter.record, DEAD_LETTER_SOURCES[item.source], item.url, getattr(e, 'stage', 'process'), e, item.title, metadata)
+        # 記録できなかった場合だけ再配信させる
+        done = bool(recorded)
+    finally:
+        admission.CONTROLLER.finish(ticket)
+
+    # 書き込んだ行がスプレッドシートに届くまでackしない（ローカルのストアはインスタンスと一緒に消える）
+    if done:
+        try:
+            await asyncio.to_thread(record_store.flush)
+        except Exception as e:
+            logging.error(f"スプレッドシートへの同期が終わらないため再配信させます: {item.url}: {e}")
+            done = False
+
+    if done:
+        message.ack()
+    else:
+        # 再配信させて後で処理する
+        message.nack()
+
+
+# キューからメッセージを取り出して処理するワーカー
+async def pipeline_worker(queue):
+    while True:
+        message = await queue.get()
+        try:
+            await handle_message(message, queue.qsize())
+        finally:
+            queue.task_done()
+
+
+# イベントループを別スレッドで動かし、キューとワーカーを用意する
+def start_pipeline():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def setup():
+        queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        for _ in range(PIPELINE_CONCURRENCY):
+            asyncio.create_task(pipeline_worker(queue))
+        return queue
+
+    queue = asyncio.run_coroutine_threadsafe(setup(), loop).result()
+    return loop, queue
+
+
+# ストリーミングプルでサブスクリプションを購読し続けるエントリポイント
+def run_consumer():
+    loop, queue = start_pipeline()
+
+    # キューが満杯の間はコールバックをブロックして受信側に背圧をかける
+    def callback(message):
+        asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(GCP_PROJECT_ID, PUBSUB_SUBSCRIPTION)
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=MAX_OUTSTANDING_MESSAGES,
+        max_bytes=MAX_OUTSTANDING_BYTES
+    )
+    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control)
+    logging.info(f"サブスクリプションの購読を開始: {subscription_path}")
+
+    with subscriber:
+        try:
+            streaming_pull_future.result()
+        except KeyboardInterrupt:
+            streaming_pull_future.cancel()
+            streaming_pull_future.result()
+        except Exception as e:
+            logging.error(f"ストリーミングプル中にエラーが発生しました: {e}")
+            streaming_pull_future.cancel()
+            raise
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            spend_ledger.flush()
+
+
+if __name__ == "__main__":
+    run_consumer()
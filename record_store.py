@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from gspread.utils import rowcol_to_a1
+import processed_index
+import resilience
+
+# HNの記事、本文、要約、スコア、意見を最初に書き込むローカルのSQLite（WAL）。
+# このストアはスプレッドシートへの書き込みのバッファで、正はスプレッドシート。バックグラウンドのスレッドが新しい行と変更された行をまとめて同期する。
+# 各段階はスプレッドシートの応答やクォータを待たずに書き込み、エントリポイントは返る前（ackする前）にflush()で同期が終わるのを待つ。
+
+RECORD_DB = os.getenv('RECORD_DB', '/tmp/autonews_records.sqlite3')
+# 同期の間隔（秒）と1回に同期する行数の上限
+MIRROR_INTERVAL = float(os.getenv('MIRROR_INTERVAL', '5'))
+MIRROR_BATCH_SIZE = int(os.getenv('MIRROR_BATCH_SIZE', '500'))
+# 同期に失敗したときの待ち時間の上限（秒）
+MIRROR_MAX_BACKOFF = 300
+# 同期中の行を他のプロセスが同期しないように確保しておく時間（秒）
+MIRROR_LEASE_SECONDS = 120
+# エントリポイントの終わりに同期を待つ時間の上限（秒）
+MIRROR_FLUSH_TIMEOUT = float(os.getenv('MIRROR_FLUSH_TIMEOUT', '30'))
+
+
+# 時間内にスプレッドシートへの同期が終わらなかった（エントリポイントは失敗として扱い、再配信させる）
+class MirrorFlushError(Exception):
+    pass
+
+
+class RecordStore:
+    def __init__(self, db_path=RECORD_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        # 同期のスレッドや他のプロセスが読んでいる間も書き込めるように
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT, key TEXT, url TEXT, row TEXT, text TEXT, '
+            'version INTEGER, mirrored_version INTEGER DEFAULT 0, lease_until REAL DEFAULT 0, created_at REAL, updated_at REAL, UNIQUE (sheet, key))'
+        )
+        # 前回シートに同期した行（変わったセルだけを更新するため）。この列がない古いストアには追加する
+        try:
+            self.db.execute('ALTER TABLE records ADD COLUMN mirrored_row TEXT')
+        except sqlite3.OperationalError:
+            pass
+        self.db.execute('CREATE INDEX IF NOT EXISTS records_pending ON records (sheet, mirrored_version, version)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS records_created ON records (sheet, created_at)')
+
+    # 行を書き込む（同じキーの行があれば内容を更新し、次の同期でシートの行も更新する）
+    def put(self, sheet, key, row, url=None, text=None, now=None):
+        now = now or time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO records (sheet, key, url, row, text, version, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 1, ?, ?) '
+                'ON CONFLICT (sheet, key) DO UPDATE SET row = excluded.row, url = COALESCE(excluded.url, url), '
+                'text = COALESCE(excluded.text, text), version = version + 1, updated_at = excluded.updated_at',
+                (sheet, str(key), url, json.dumps(row, ensure_ascii=False, default=str), text, now, now)
+            )
+
+    # 行の1つのセルだけを書き込む（他の段階が同時に更新した列を古い内容で上書きしないように、ロックの中で今の行を読み直す）
+    # 行がない場合とonly_if_emptyでセルがすでに埋まっている場合はFalseを返す
+    def set_cell(self, sheet, key, index, value, only_if_empty=False, now=None):
+        now = now or time.time()
+        with self.lock, self.db:
+            current = self.db.execute('SELECT row FROM records WHERE sheet = ? AND key = ?', (sheet, str(key))).fetchone()
+            if not current:
+                return False
+            row = json.loads(current[0])
+            if only_if_empty and index < len(row) and row[index]:
+                return False
+            row += [""] * max(index + 1 - len(row), 0)
+            row[index] = value
+            self.db.execute(
+                'UPDATE records SET row = ?, version = version + 1, updated_at = ? WHERE sheet = ? AND key = ?',
+                (json.dumps(row, ensure_ascii=False, default=str), now, sheet, str(key))
+            )
+        return True
+
+    # 数値のキー（HNのIDなど）の最大値
+    def max_int_key(self, sheet):
+        with self.lock:
+            row = self.db.execute('SELECT MAX(CAST(key AS INTEGER)) FROM records WHERE sheet = ?', (sheet,)).fetchone()
+        return row[0]
+
+    # since（UNIX時刻）以降に追加された行（[(key, row)]）
+    def recent(self, sheet, since):
+        with self.lock:
+            rows = self.db.execute('SELECT key, row FROM records WHERE sheet = ? AND created_at >= ? ORDER BY id', (sheet, since)).fetchall()
+        return [(key, json.loads(row)) for key, row in rows]
+
+    # 同期が必要な行を確保する（[(id, key, row, version, mirrored_version, mirrored_row)]。mirrored_rowは前回同期した行かNone）
+    def claim(self, sheet, limit=MIRROR_BATCH_SIZE, now=None):
+        now = now or time.time()
+        with self.lock, self.db:
+            rows = self.db.execute(
+                'SELECT id, key, row, version, mirrored_version, mirrored_row FROM records '
+                'WHERE sheet = ? AND mirrored_version < version AND lease_until < ? ORDER BY id LIMIT ?',
+                (sheet, now, limit)
+            ).fetchall()
+            self.db.executemany('UPDATE records SET lease_until = ? WHERE id = ?', [(now + MIRROR_LEASE_SECONDS, row[0]) for row in rows])
+        return [
+            (row_id, key, json.loads(row), version, mirrored, json.loads(mirrored_row) if mirrored_row else None)
+            for row_id, key, row, version, mirrored, mirrored_row in rows
+        ]
+
+    # 同期した版と行を記録する（[(id, version, row)]。同期中に更新された行は次の同期でもう一度送る）
+    def mark_mirrored(self, versions):
+        with self.lock, self.db:
+            self.db.executemany(
+                'UPDATE records SET mirrored_version = ?, mirrored_row = ?, lease_until = 0 WHERE id = ?',
+                [(version, json.dumps(row, ensure_ascii=False, default=str), row_id) for row_id, version, row in versions]
+            )
+
+    # シートの行を上書きしてしまった可能性のある行を、次の同期で行全体を書き直させる（keysはキーの列の値）
+    def remirror(self, sheet, keys):
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        with self.lock, self.db:
+            self.db.execute(
+                f'UPDATE records SET mirrored_row = NULL, version = version + 1 '
+                f'WHERE sheet = ? AND mirrored_version > 0 AND key IN ({",".join("?" * len(keys))})',
+                [sheet] + keys
+            )
+
+    # 同期に失敗した行の確保を解く
+    def release(self, ids):
+        with self.lock, self.db:
+            self.db.executemany('UPDATE records SET lease_until = 0 WHERE id = ?', [(row_id,) for row_id in ids])
+
+    # 同期が必要な行の数
+    def pending_count(self, sheets):
+        if not sheets:
+            return 0
+        with self.lock:
+            row = self.db.execute(
+                f'SELECT COUNT(*) FROM records WHERE mirrored_version < version AND sheet IN ({",".join("?" * len(sheets))})',
+                list(sheets)
+            ).fetchone()
+        return row[0]
+
+
+# 前回同期した行から変わったセルだけを書き込む範囲（mirrored_rowがNoneなら行全体）
+def changed_cells(row_number, row, mirrored_row):
+    if mirrored_row is None:
+        return [{"range": f"A{row_number}", "values": [row]}]
+    updates = []
+    for index in range(max(len(row), len(mirrored_row))):
+        value = row[index] if index < len(row) else ""
+        if index >= len(mirrored_row) or mirrored_row[index] != value:
+            updates.append({"range": rowcol_to_a1(row_number, index + 1), "values": [[value]]})
+    return updates
+
+
+class SheetMirror:
+    def __init__(self, store):
+        self.store = store
+        # 名前 -> (ワークシート, キーの列番号(1始まり))
+        self.sheets = {}
+        self.wake = threading.Event()
+        self.sync_lock = threading.Lock()
+        self.thread = None
+
+    # このプロセスで同期するシートを登録し、同期のスレッドを起動する
+    def register(self, sheet, worksheet, key_column):
+        self.sheets[sheet] = (worksheet, key_column)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # 書き込みがあったことを同期のスレッドに知らせる
+    def notify(self):
+        self.wake.set()
+
+    # キーの列の今の値（正規化したキー -> 行番号、行番号 -> 値）
+    def key_positions(self, worksheet, key_column):
+        values = resilience.call('sheets', worksheet.col_values, key_column, max_attempts=1)
+        positions = {processed_index.item_key(value): index + 1 for index, value in enumerate(values) if value}
+        return positions, {index + 1: value for index, value in enumerate(values) if value}
+
+    # 1枚のシートの同期が必要な行をまとめて送る（送った行数を返す）
+    def sync_sheet(self, sheet):
+        worksheet, key_column = self.sheets[sheet]
+        batch = self.store.claim(sheet)
+        if not batch:
+            return 0
+        shifted = []
+        overwritten = []
+        try:
+            new_rows = [item for item in batch if item[4] == 0]
+            changed_rows = [item for item in batch if item[4] > 0]
+
+            if changed_rows:
+                # 古い行の削除やIDの書き戻しで行番号がずれるので、書き込む直前にキーの列を読んで今の位置を探し、変わったセルだけを書き込む
+                positions, _ = self.key_positions(worksheet, key_column)
+                updates = []
+                placed = []
+                for item in changed_rows:
+                    row_number = positions.get(processed_index.item_key(item[1]))
+                    if row_number:
+                        updates.extend(changed_cells(row_number, item[2], item[5]))
+                        placed.append((item, row_number))
+                    else:
+                        # シートから消えている行は追記し直す
+                        new_rows.append(item)
+                if updates:
+                    resilience.call('sheets', worksheet.batch_update, updates, max_attempts=1)
+                    # 書き込みの間に行がずれていたら、ずれた行は次の同期で書き直し、上書きしてしまった行も行全体を書き直させる
+                    after, values = self.key_positions(worksheet, key_column)
+                    for item, row_number in placed:
+                        if after.get(processed_index.item_key(item[1])) != row_number:
+                            shifted.append(item)
+                            if row_number in values:
+                                overwritten.append(values[row_number])
+                    if shifted:
+                        logging.warning(f"同期中にシートの行がずれました。次の同期で書き直します: {sheet} {len(shifted)}件")
+
+            if new_rows:
+                new_rows.sort(key=lambda item: item[0])
+                resilience.call('sheets', worksheet.append_rows, [item[2] for item in new_rows], max_attempts=1)
+        except Exception:
+            self.store.release([item[0] for item in batch])
+            raise
+        shifted_ids = {item[0] for item in shifted}
+        self.store.mark_mirrored([(item[0], item[3], item[2]) for item in batch if item[0] not in shifted_ids])
+        self.store.release(list(shifted_ids))
+        self.store.remirror(sheet, overwritten)
+        logging.info(f"スプレッドシートに同期しました: {sheet} 追記{len(new_rows)}件、更新{len(batch) - len(new_rows) - len(shifted)}件")
+        return len(batch)
+
+    # 登録したすべてのシートを1回同期する
+    def sync_once(self):
+        with self.sync_lock:
+            return sum(self.sync_sheet(sheet) for sheet in list(self.sheets))
+
+    # 同期のスレッド（失敗したら間隔を倍にして再試行し、行はストアに残しておく。再試行はここで行うのでresilience.callでは再試行しない）
+    def run(self):
+        backoff = MIRROR_INTERVAL
+        while True:
+            self.wake.wait(backoff)
+            self.wake.clear()
+            try:
+                # 上限まで送った場合は残りをすぐに送る
+                while self.sync_once() >= MIRROR_BATCH_SIZE:
+                    pass
+                backoff = MIRROR_INTERVAL
+            except Exception as e:
+                backoff = min(backoff * 2, MIRROR_MAX_BACKOFF)
+                logging.warning(f"スプレッドシートへの同期に失敗しました。{backoff:.0f}秒後に再試行します: {e}")
+
+    # 同期が必要な行がなくなるまで待つ（エントリポイントの終わりで使う。時間内に終わらなければMirrorFlushError）
+    def flush(self, timeout=MIRROR_FLUSH_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while self.store.pending_count(list(self.sheets)):
+            if time.monotonic() >= deadline:
+                raise MirrorFlushError(f"{timeout:.0f}秒以内にスプレッドシートへの同期が終わりませんでした（{self.store.pending_count(list(self.sheets))}行が未同期）")
+            try:
+                if not self.sync_once():
+                    # 他のスレッドやプロセスが同期中
+                    time.sleep(1)
+            except Exception as e:
+                logging.warning(f"スプレッドシートへの同期に失敗しました: {e}")
+                time.sleep(min(5, max(deadline - time.monotonic(), 0)))
+        return True
+
+
+STORE = RecordStore()
+MIRROR = SheetMirror(STORE)
+
+
+# シートをこのプロセスの同期の対象にする
+def register_sheet(sheet, worksheet, key_column):
+    MIRROR.register(sheet, worksheet, key_column)
+
+
+# 行をローカルのストアに書き込み、同期のスレッドに知らせる
+def write(sheet, key, row, url=None, text=None):
+    STORE.put(sheet, key, row, url=url, text=text)
+    MIRROR.notify()
+
+
+# 行の1つのセルだけをローカルのストアに書き込み、同期のスレッドに知らせる
+def set_cell(sheet, key, index, value, only_if_empty=False):
+    updated = STORE.set_cell(sheet, key, index, value, only_if_empty=only_if_empty)
+    if updated:
+        MIRROR.notify()
+    return updated
+
+
+# 同期が終わるまで待つ（終わらなければMirrorFlushError）
+def flush(timeout=MIRROR_FLUSH_TIMEOUT):
+    return MIRROR.flush(timeout)
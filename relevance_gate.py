@@ -0,0 +1,237 @@
+import base64
+import json
+import logging
+import math
+import os
+import re
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+import gspread
+import numpy as np
+import fetch_scheduler
+import model_router
+import parse_worker
+from prompt_builder import SCORE_KEYS
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# OpenAIを呼ぶ前に、読まれなさそうな記事をローカルで振り分けるゲート。
+# HNのメタデータ、本文の長さなどのヒューリスティック、過去のスコアで学習した小さなロジスティック回帰を組み合わせる。
+
+SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
+GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')
+GATE_MODEL_PATH = os.getenv('GATE_MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relevance_model.npz'))
+# 設定されている場合は学習したモデルをバケットに保存し、読み込み時にGATE_MODEL_PATHにダウンロードする（既定はチェックポイントと同じバケット）
+GATE_MODEL_BUCKET = os.getenv('GATE_MODEL_BUCKET', os.getenv('CHECKPOINT_BUCKET'))
+GATE_MODEL_OBJECT = os.getenv('GATE_MODEL_OBJECT', 'models/relevance_model.npz')
+
+# この値未満はスキップする。上位のモデルを使うかどうか（'cheap'と'full'の境目）はmodel_router.pyのPREMIUM_VALUEで決める
+GATE_SKIP_THRESHOLD = float(os.getenv('GATE_SKIP_THRESHOLD', '0.2'))
+# これより短い本文はリンク切れやペイウォールとみなす
+MIN_TEXT_LENGTH = int(os.getenv('MIN_TEXT_LENGTH', '500'))
+# 学習時にこの平均スコア以上を「読まれる記事」とする
+POSITIVE_SCORE = float(os.getenv('GATE_POSITIVE_SCORE', '6'))
+
+FEATURE_DIM = 2 ** 12
+# 分類器に渡す本文の長さ（学習時も推論時も同じ長さで切る）
+CLASSIFIER_TEXT_LENGTH = 3000
+# 学習時に記事の本文を並行して取得する数
+TRAIN_FETCH_WORKERS = int(os.getenv('GATE_TRAIN_FETCH_WORKERS', '8'))
+
+LOW_VALUE_TITLE = re.compile(r'^(show hn|ask hn|tell hn|launch hn)\b|\bis hiring\b|\bwe.?re hiring\b|\(yc [sw]\d+\)', re.IGNORECASE)
+WORD = re.compile(r'[a-z0-9]+')
+CJK_RUN = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]+')
+
+
+# 英単語と、日本語は文字のバイグラムに分割する
+def tokenize(text):
+    text = text.lower()
+    tokens = WORD.findall(text)
+    for run in CJK_RUN.findall(text):
+        tokens.extend(run[i:i + 2] for i in range(max(len(run) - 1, 1)))
+    return tokens
+
+
+# トークンをハッシュで固定長の次元に割り当てた出現回数
+def hashed_counts(text, dim=FEATURE_DIM):
+    indices = [zlib.crc32(token.encode('utf-8')) % dim for token in tokenize(text)]
+    return np.bincount(indices, minlength=dim).astype(np.float32) if indices else np.zeros(dim, dtype=np.float32)
+
+
+# 語彙を持たないハッシュ版のTF-IDF
+class HashingTfidf:
+    def __init__(self, dim=FEATURE_DIM, idf=None):
+        self.dim = dim
+        self.idf = idf if idf is not None else np.ones(dim, dtype=np.float32)
+
+    def fit(self, texts):
+        counts = np.stack([hashed_counts(text, self.dim) for text in texts])
+        document_frequency = (counts > 0).sum(axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        return self._weight(counts)
+
+    def transform(self, texts):
+        counts = np.stack([hashed_counts(text, self.dim) for text in texts])
+        return self._weight(counts)
+
+    def _weight(self, counts):
+        matrix = np.log1p(counts) * self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+
+# ロジスティック回帰（勾配降下法）
+def train_logistic(features, labels, epochs=300, learning_rate=0.5, l2=1e-4):
+    weights = np.zeros(features.shape[1], dtype=np.float32)
+    bias = 0.0
+    n = len(labels)
+    for _ in range(epochs):
+        predictions = 1 / (1 + np.exp(-(features @ weights + bias)))
+        error = predictions - labels
+        weights -= learning_rate * (features.T @ error / n + l2 * weights)
+        bias -= learning_rate * float(error.mean())
+    return weights, bias
+
+
+# 学習済みモデルを読み込む（なければNone）
+def load_model(path=GATE_MODEL_PATH, bucket_name=GATE_MODEL_BUCKET):
+    if bucket_name:
+        try:
+            storage.Client().bucket(bucket_name).blob(GATE_MODEL_OBJECT).download_to_filename(path)
+        except NotFound:
+            logging.info(f"バケットに関連度モデルがありません: gs://{bucket_name}/{GATE_MODEL_OBJECT}")
+        except Exception as e:
+            logging.warning(f"関連度モデルをバケットから取得できませんでした: {e}")
+    if not os.path.exists(path):
+        logging.info(f"関連度モデルがないためヒューリスティックのみで判定します: {path}")
+        return None
+    data = np.load(path)
+    return HashingTfidf(int(data['dim']), data['idf']), data['weights'], float(data['bias'])
+
+
+MODEL = load_model()
+
+
+# 分類器の入力（タイトルとパースした本文の冒頭。学習と推論で同じものを使う）
+def classifier_input(title, text):
+    return f'{title}\n{text[:CLASSIFIER_TEXT_LENGTH]}'
+
+
+# 分類器で読まれる確率を推定する
+def predict_value(title, text, model=MODEL):
+    if model is None:
+        return 0.5
+    vectorizer, weights, bias = model
+    features = vectorizer.transform([classifier_input(title, text)])[0]
+    return float(1 / (1 + math.exp(-(features @ weights + bias))))
+
+
+# 記事をどう処理するか判定する（'skip'、'cheap'、'full'のいずれかと推定値を返す）
+def evaluate(title, text, metadata=None):
+    metadata = metadata or {}
+
+    # 明らかに対象外のもの
+    if metadata.get('type') and metadata['type'] != 'story':
+        return 'skip', 0.0
+    if len(text) < MIN_TEXT_LENGTH:
+        return 'skip', 0.0
+
+    value = predict_value(title, text)
+
+    # ヒューリスティックで補正する
+    if LOW_VALUE_TITLE.search(title or ''):
+        value -= 0.2
+    score = metadata.get('score')
+    if score is not None:
+        # HNのポイントとコメント数が多いほど加点（投稿直後は小さいので控えめに）
+        value += min(0.2, 0.05 * math.log1p(max(score - 1, 0)) + 0.02 * math.log1p(metadata.get('descendants') or 0))
+    # 記号や数字ばかりの本文（リンク集、表、コードだけのページ）は減点
+    letters = sum(character.isalpha() for character in text[:5000])
+    if letters < 0.5 * min(len(text), 5000):
+        value -= 0.15
+
+    if value < GATE_SKIP_THRESHOLD:
+        decision = 'skip'
+    elif value < model_router.PREMIUM_VALUE:
+        decision = 'cheap'
+    else:
+        decision = 'full'
+    logging.info(f"関連度ゲートの判定: {decision} ({value:.2f}) {title}")
+    return decision, value
+
+
+# スコアのJSONから平均点を求める
+def average_score(score_text):
+    try:
+        score_json = json.loads(score_text)
+        return sum(float(score_json[key]) for key in SCORE_KEYS) / len(SCORE_KEYS)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+# 学習に使う記事の本文（推論と同じく取得してパースしたもの。取得できなければNone）
+def article_text(url):
+    try:
+        document = fetch_scheduler.SCHEDULER.fetch(url)
+        return parse_worker.parse_document(document.kind, document.content)
+    except Exception as e:
+        logging.info(f"学習に使う記事を取得できませんでした: {url}: {e}")
+        return None
+
+
+# シートの過去のスコアで学習する（content_fetcher2.pyのシート: タイトル、URL、要約、スコアJSON）
+def train_from_sheet(sheet_index=1, max_rows=3000, path=GATE_MODEL_PATH, bucket_name=GATE_MODEL_BUCKET):
+    creds_json = base64.b64decode(GOOGLE_CREDENTIALS_BASE64).decode('utf-8')
+    creds = json.loads(creds_json)
+    gc = gspread.service_account_from_dict(creds)
+    worksheet = gc.open_by_key(SPREADSHEET_ID).get_worksheet(sheet_index)
+    rows = worksheet.get_all_values()[-max_rows:]
+
+    # [タイトル, URL, 平均スコア]
+    examples = []
+    for row in rows:
+        if len(row) < 4 or not row[1]:
+            continue
+        average = average_score(row[3])
+        if average is None:
+            continue
+        examples.append((row[0], row[1], average))
+
+    # 推論と同じく記事の本文で学習する（シートの要約は日本語で、推論時の英語の本文とは語彙が違うため）
+    with ThreadPoolExecutor(max_workers=TRAIN_FETCH_WORKERS) as executor:
+        article_texts = list(executor.map(article_text, [url for _, url, _ in examples]))
+
+    texts = []
+    labels = []
+    for (title, _, average), text in zip(examples, article_texts):
+        if not text:
+            continue
+        texts.append(classifier_input(title, text))
+        labels.append(1.0 if average >= POSITIVE_SCORE else 0.0)
+    logging.info(f"学習に使う記事の本文を取得しました: {len(texts)}/{len(examples)}件")
+    if len(set(labels)) < 2:
+        raise ValueError("学習に使えるデータが足りません。")
+
+    vectorizer = HashingTfidf()
+    features = vectorizer.fit(texts)
+    weights, bias = train_logistic(features, np.array(labels, dtype=np.float32))
+    save_model(path, vectorizer, weights, bias, bucket_name)
+    logging.info(f"関連度モデルを保存しました: {path}（{len(labels)}件、正例{int(sum(labels))}件）")
+
+
+# モデルを保存する（バケットが設定されていればアップロードし、すべてのインスタンスが読み込めるようにする）
+def save_model(path, vectorizer, weights, bias, bucket_name=GATE_MODEL_BUCKET):
+    np.savez(path, dim=vectorizer.dim, idf=vectorizer.idf, weights=weights, bias=bias)
+    if bucket_name:
+        storage.Client().bucket(bucket_name).blob(GATE_MODEL_OBJECT).upload_from_filename(path)
+        logging.info(f"関連度モデルをバケットに保存しました: gs://{bucket_name}/{GATE_MODEL_OBJECT}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'train':
+        train_from_sheet()
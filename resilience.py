@@ -0,0 +1,211 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+import requests
+
+# 外部の依存先（OpenAI、スプレッドシート、HNのAPI、記事の取得先のホスト）の呼び出しに共通の再試行とサーキットブレーカー。
+# 依存先ごとにブレーカー（closed、open、half-open）を持ち、障害中は呼び出さずにすぐ失敗させる。
+# 再試行は再試行できるエラーだけ、ジッター付きの指数バックオフで行い、再試行の回数は呼び出し数に対する割合（予算）で抑える。
+
+# 続けてこの回数失敗したらブレーカーを開く
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+# ブレーカーを開いてから試しに呼び出すまでの時間（秒）
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+# half-openで同時に試す呼び出しの数
+BREAKER_HALF_OPEN_CALLS = 1
+# 1回の呼び出しで試す回数と、再試行の間隔（秒）
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_SECONDS = float(os.getenv('RETRY_BASE_SECONDS', '1'))
+RETRY_MAX_SECONDS = float(os.getenv('RETRY_MAX_SECONDS', '30'))
+# 直近1分間の再試行は呼び出し数のこの割合まで（最低RETRY_BUDGET_MIN回）
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+RETRY_BUDGET_MIN = 10
+RETRY_BUDGET_WINDOW = 60
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+# ブレーカーが開いているため呼び出さなかった場合の例外
+class CircuitOpenError(Exception):
+    pass
+
+
+# 例外からHTTPのステータスコードを取り出す（requests、gspread、openaiの例外）
+def status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+# 再試行で成功する見込みのあるエラーか（接続エラー、タイムアウト、レート制限、サーバーエラー）
+def is_retryable(error):
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (TimeoutError, ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    # openaiやhttpxの接続エラーとタイムアウト（APIConnectionError、APITimeoutError、ReadTimeoutなど）
+    name = type(error).__name__
+    return 'Timeout' in name or 'Connection' in name
+
+
+# レスポンスのRetry-Afterヘッダー（秒）
+def retry_after(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After') or headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self.rejected = 0
+
+    def _transition(self, state):
+        if state != self.state:
+            log = logging.info if state == 'closed' else logging.warning
+            log(f"サーキットブレーカーの状態が変わりました: {self.name} {self.state} -> {state}（続けての失敗{self.failures}回）")
+            self.state = state
+
+    # 呼び出してよいか
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    self.rejected += 1
+                    return False
+                self._transition('half_open')
+                self.half_open_calls = 0
+            if self.state == 'half_open':
+                if self.half_open_calls >= BREAKER_HALF_OPEN_CALLS:
+                    self.rejected += 1
+                    return False
+                self.half_open_calls += 1
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self._transition('closed')
+
+    # 成功とも失敗とも数えない呼び出し（half-openの試しの枠だけを返す）
+    def release(self):
+        with self.lock:
+            if self.state == 'half_open' and self.half_open_calls > 0:
+                self.half_open_calls -= 1
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition('open')
+
+    def snapshot(self):
+        with self.lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class RetryBudget:
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN, window=RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.retries = deque()
+
+    def _trim(self, now):
+        for events in (self.calls, self.retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_call(self):
+        with self.lock:
+            now = time.monotonic()
+            self._trim(now)
+            self.calls.append(now)
+
+    # 再試行してよければ記録してTrueを返す
+    def try_retry(self):
+        with self.lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self.retries) >= max(self.minimum, self.ratio * len(self.calls)):
+                return False
+            self.retries.append(now)
+            return True
+
+
+BREAKERS = {}
+BUDGETS = {}
+REGISTRY_LOCK = threading.Lock()
+
+
+# 依存先のブレーカーと再試行の予算（最初に使うときに作る）
+def get_breaker(dependency):
+    with REGISTRY_LOCK:
+        if dependency not in BREAKERS:
+            BREAKERS[dependency] = CircuitBreaker(dependency)
+            BUDGETS[dependency] = RetryBudget()
+        return BREAKERS[dependency], BUDGETS[dependency]
+
+
+# すべてのブレーカーの状態（ログや監視に出す）
+def snapshot():
+    with REGISTRY_LOCK:
+        breakers = dict(BREAKERS)
+    return {name: breaker.snapshot() for name, breaker in breakers.items()}
+
+
+# closedでないブレーカーと、呼び出しを断ったことのあるブレーカーをログに出す
+def log_status():
+    for name, state in snapshot().items():
+        if state["state"] != 'closed' or state["rejected"]:
+            logging.warning(f"サーキットブレーカー: {name} {state['state']}（続けての失敗{state['failures']}回、断った呼び出し{state['rejected']}回）")
+
+
+# 依存先を呼び出す（ブレーカーが開いていればCircuitOpenError、再試行できないエラーはそのまま送出する）
+def call(dependency, fn, *args, max_attempts=RETRY_MAX_ATTEMPTS, **kwargs):
+    breaker, budget = get_breaker(dependency)
+    attempt = 0
+    while True:
+        attempt += 1
+        if not breaker.allow():
+            raise CircuitOpenError(f"{dependency}の障害中のため呼び出しません")
+        budget.record_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            retryable = is_retryable(e)
+            # 依存先の障害ではないエラー（不正なリクエストなど）ではブレーカーの状態を変えない
+            if retryable:
+                breaker.record_failure()
+            else:
+                breaker.release()
+            if not retryable or attempt >= max_attempts:
+                raise
+            if not budget.try_retry():
+                logging.warning(f"再試行の予算を使い切ったため再試行しません: {dependency}: {e}")
+                raise
+            delay = retry_after(e) or random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+            logging.warning(f"{dependency}の呼び出しに失敗したため{delay:.1f}秒後に再試行します（{attempt}/{max_attempts}回目）: {e}")
+            time.sleep(min(delay, RETRY_MAX_SECONDS))
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,140 @@
+import heapq
+import json
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import prompt_builder
+from sheet_retention import parse_sheet_date
+
+# generate_scoreの10項目のスコアで記事を順位付けし、投稿する記事を選ぶモジュール。
+# シートを1回で読み込んだ行からスコアの行列を作り、項目ごとの正規化、重み付き和、時間による減衰をNumPyでまとめて計算する。
+
+# 項目ごとの重み（JSON）。指定のない項目は1.0、広告との関係は高いほど下げる
+DEFAULT_SCORE_WEIGHTS = {"relation_to_advertising": -1.0}
+SCORE_WEIGHTS = {**{key: 1.0 for key in prompt_builder.SCORE_KEYS}, **json.loads(os.getenv('SCORE_WEIGHTS', json.dumps(DEFAULT_SCORE_WEIGHTS)))}
+# スコアが半分になるまでの時間（時間）
+RANK_HALF_LIFE_HOURS = float(os.getenv('RANK_HALF_LIFE_HOURS', '12'))
+# 順位付けの対象にする期間（時間）と、その期間に投稿する記事の数
+RANK_WINDOW_HOURS = float(os.getenv('RANK_WINDOW_HOURS', '24'))
+PUBLISH_TOP_K = int(os.getenv('PUBLISH_TOP_K', '20'))
+# スコアのJSONを書いた列（content_fetcher2.py）と日付の列の見出し。JSONの列がなければ項目名の列（content_fetcher.py）から読む
+SCORE_COLUMN = os.getenv('RANK_SCORE_COLUMN', 'Score')
+DATE_COLUMN = os.getenv('RANK_DATE_COLUMN', 'Date')
+
+
+# 見出しからスコアを読む方法を決める（スコアの列がなければNone）
+def score_columns(headers):
+    if SCORE_COLUMN in headers:
+        return headers.index(SCORE_COLUMN)
+    if all(key in headers for key in prompt_builder.SCORE_KEYS):
+        return [headers.index(key) for key in prompt_builder.SCORE_KEYS]
+    return None
+
+
+# 1行のスコアを取り出す（読めない項目はNaN）
+def parse_scores(row, columns):
+    def cell(index):
+        return row[index] if index < len(row) else ''
+
+    if isinstance(columns, int):
+        try:
+            score_json = json.loads(cell(columns))
+        except ValueError:
+            score_json = {}
+        values = [score_json.get(key) if isinstance(score_json, dict) else None for key in prompt_builder.SCORE_KEYS]
+    else:
+        values = [cell(index) for index in columns]
+
+    scores = []
+    for value in values:
+        try:
+            scores.append(float(value))
+        except (TypeError, ValueError):
+            scores.append(math.nan)
+    return scores
+
+
+# 行からスコアの行列（行数×10）と記事の経過時間（時間）を作る
+def load_matrix(rows, headers, now=None):
+    columns = score_columns(headers)
+    if columns is None:
+        return None, None
+    matrix = np.array([parse_scores(row, columns) for row in rows], dtype=np.float64).reshape(len(rows), len(prompt_builder.SCORE_KEYS))
+
+    # シートの日付は日本時間で書かれている。日付がない行は経過時間をNaNにして順位付けから外す（新しい記事として扱わない）
+    now = now or datetime.utcnow() + timedelta(hours=9)
+    ages = np.full(len(rows), np.nan, dtype=np.float64)
+    if DATE_COLUMN not in headers:
+        logging.warning(f"日付の列（{DATE_COLUMN}）がないため、どの行も新しく投稿する記事に選びません")
+        return matrix, ages
+    date_index = headers.index(DATE_COLUMN)
+    for index, row in enumerate(rows):
+        date = parse_sheet_date(row[date_index]) if date_index < len(row) else None
+        if date:
+            ages[index] = max((now - date).total_seconds() / 3600, 0)
+    return matrix, ages
+
+
+# 重み付きのスコアを計算する（スコアが読めない行、日付がない行、期間外の行は-inf）
+def rank_scores(matrix, ages, weights=None):
+    weights = weights or SCORE_WEIGHTS
+    weight_vector = np.array([weights.get(key, 1.0) for key in prompt_builder.SCORE_KEYS], dtype=np.float64)
+
+    valid = ~np.isnan(matrix).any(axis=1) & ~np.isnan(ages) & (ages <= RANK_WINDOW_HOURS)
+    if not valid.any():
+        return np.full(len(matrix), -np.inf)
+
+    # 項目ごとに対象の行の最小値と最大値で0-1に正規化する（全行が同じ値の項目は0.5）
+    scope = matrix[valid]
+    low, high = scope.min(axis=0), scope.max(axis=0)
+    spread = np.where(high > low, high - low, 1.0)
+    normalized = np.where(high > low, (matrix - low) / spread, 0.5)
+
+    # 負の重みの項目は「低いほどよい」として0-1の範囲に収める
+    contributions = np.where(weight_vector >= 0, normalized, normalized - 1.0) * weight_vector
+    scores = contributions.sum(axis=1) / max(np.abs(weight_vector).sum(), 1e-9)
+    scores = scores * np.power(0.5, np.where(valid, ages, 0) / RANK_HALF_LIFE_HOURS)
+    return np.where(valid, scores, -np.inf)
+
+
+# スコアの高い順にK件を保持するヒープ
+class TopK:
+    def __init__(self, k=PUBLISH_TOP_K):
+        self.k = k
+        self.heap = []
+
+    # 候補を追加する（K件に入らなければFalse）
+    def push(self, score, key):
+        if self.k <= 0 or not np.isfinite(score):
+            return False
+        entry = (float(score), key)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+            return True
+        if entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+            return True
+        return False
+
+    def keys(self):
+        return {key for _, key in self.heap}
+
+    def ranked(self):
+        return sorted(self.heap, reverse=True)
+
+
+# 行を順位付けし、期間内の上位K件の行番号を返す（スコアの列がなければNone）
+def select_top_rows(rows, headers, k=PUBLISH_TOP_K, now=None):
+    matrix, ages = load_matrix(rows, headers, now)
+    if matrix is None:
+        return None
+    scores = rank_scores(matrix, ages)
+    top = TopK(k)
+    for index in np.flatnonzero(np.isfinite(scores)):
+        top.push(scores[index], int(index))
+    ranked = top.ranked()
+    if ranked:
+        logging.info(f"スコアの上位{len(ranked)}件を選びました（{int(np.isfinite(scores).sum())}件中、最低スコア{ranked[-1][0]:.3f}）")
+    return top.keys()
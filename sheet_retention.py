@@ -0,0 +1,149 @@
+import base64
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+import gspread
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# シートは追記のみ（append_row）で運用し、新しい順の表示はSORT関数のビューシートで行う。
+# 古い行はこのジョブで範囲ごとにまとめて、1回のbatch_updateで削除する。
+
+SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
+GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')
+
+# 対象シートごとの保持設定（sheetはシートのインデックス、date_columnは日付の列番号(1始まり)、viewは新しい順のビューシートの名前）
+DEFAULT_RETENTION_CONFIG = [
+    # main.pyのHNのシート（A列が日付）
+    {"sheet": 0, "date_column": 1, "max_age_days": 7, "view": "HN（新しい順）"},
+    # content_fetcher2.pyの記事のシート（E列が日付）
+    {"sheet": 1, "date_column": 5, "max_age_days": 30, "view": "記事（新しい順）"},
+    # content_fetch_1201.pyのInoreaderのシート（日付の列がないので行数で制限する）
+    {"sheet": 3, "max_rows": 5000, "view": "Inoreader（新しい順）"},
+]
+RETENTION_CONFIG = json.loads(os.getenv('RETENTION_CONFIG', json.dumps(DEFAULT_RETENTION_CONFIG)))
+
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d']
+
+
+# gspread初期化
+def init_spreadsheet():
+    creds_json = base64.b64decode(GOOGLE_CREDENTIALS_BASE64).decode('utf-8')
+    creds = json.loads(creds_json)
+    gc = gspread.service_account_from_dict(creds)
+    return gc.open_by_key(SPREADSHEET_ID)
+
+
+# シートに書かれた日付を読み取る（読めないものはNone）
+def parse_sheet_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format)
+        except ValueError:
+            continue
+    return None
+
+
+# 削除する行番号(0始まり、ヘッダー含む)を連続した範囲にまとめる
+def group_row_ranges(row_indices):
+    ranges = []
+    for index in sorted(row_indices):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+# 期限切れの行番号を求める（ヘッダー行は対象外）
+def find_expired_rows(values, date_column=None, max_age_days=None, max_rows=None, now=None):
+    data_rows = len(values) - 1
+    expired = set()
+
+    if date_column and max_age_days is not None:
+        # シートの日付は日本時間で書かれている
+        now = now or datetime.utcnow() + timedelta(hours=9)
+        threshold = now - timedelta(days=max_age_days)
+        for index, row in enumerate(values[1:], start=1):
+            if len(row) < date_column:
+                continue
+            date = parse_sheet_date(row[date_column - 1])
+            if date and date < threshold:
+                expired.add(index)
+
+    # 追記のみなので上にある行ほど古い
+    if max_rows is not None and data_rows > max_rows:
+        expired.update(range(1, data_rows - max_rows + 1))
+
+    return expired
+
+
+# 1枚のシートの期限切れの行をまとめて削除する
+def prune_worksheet(spreadsheet, worksheet, date_column=None, max_age_days=None, max_rows=None):
+    values = worksheet.get_all_values()
+    expired = find_expired_rows(values, date_column, max_age_days, max_rows)
+    if not expired:
+        logging.info(f"削除する行はありません: {worksheet.title}")
+        return 0
+
+    # 下の範囲から削除しないと上の削除で行番号がずれる
+    requests = [
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": worksheet.id,
+                    "dimension": "ROWS",
+                    "startIndex": start,
+                    "endIndex": end
+                }
+            }
+        }
+        for start, end in reversed(group_row_ranges(expired))
+    ]
+    spreadsheet.batch_update({"requests": requests})
+    logging.info(f"{worksheet.title} から {len(expired)} 行を削除しました（{len(requests)} 範囲）")
+    return len(expired)
+
+
+# 新しい順に並べたビューシートを用意する（元シートの行番号の降順で並べる）
+def ensure_newest_first_view(spreadsheet, source, view_title):
+    try:
+        view = spreadsheet.worksheet(view_title)
+    except gspread.exceptions.WorksheetNotFound:
+        view = spreadsheet.add_worksheet(title=view_title, rows=1000, cols=26)
+    quoted = "'" + source.title.replace("'", "''") + "'"
+    view.update(
+        range_name='A1:A2',
+        values=[
+            [f"={quoted}!A1:Z1"],
+            [f'=SORT(FILTER({quoted}!A2:Z, {quoted}!A2:A<>""), FILTER(ROW({quoted}!A2:A), {quoted}!A2:A<>""), FALSE)']
+        ],
+        value_input_option='USER_ENTERED'
+    )
+    return view
+
+
+# Cloud Schedulerから毎日起動するエントリポイント（古い行を削除し、新しい順のビューシートを用意する）
+def prune_old_rows(event, context):
+    try:
+        spreadsheet = init_spreadsheet()
+        for config in RETENTION_CONFIG:
+            worksheet = spreadsheet.get_worksheet(config['sheet'])
+            prune_worksheet(
+                spreadsheet,
+                worksheet,
+                config.get('date_column'),
+                config.get('max_age_days'),
+                config.get('max_rows')
+            )
+            if config.get('view'):
+                ensure_newest_first_view(spreadsheet, worksheet, config['view'])
+    except Exception as e:
+        logging.error(f"古い行の削除中にエラーが発生しました: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    prune_old_rows(None, None)
@@ -0,0 +1,304 @@
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from google.cloud import storage
+import pipeline_budget
+import processed_index
+import prompt_builder
+
+# OpenAIの呼び出しごとの使用量（usage）を、モデル、段階、記録元、記事ごとにSQLiteの台帳に記録するモジュール。
+# 1分ごとの集計から直近1時間と24時間の支出を求め、予算に近づいたら安いモデルに切り替え、超えたら呼び出しを待たせる。
+# 予算はすべてのインスタンスの合計にかけるので、各インスタンスは自分の1時間分の記録をGCSのバケットに置き、支出はバケットの全インスタンス分から求める。
+
+SPEND_LEDGER_DB = os.getenv('SPEND_LEDGER_DB', '/tmp/autonews_spend.sqlite3')
+# 直近1時間と24時間の予算（ドル、0なら制限しない）
+SPEND_HOURLY_BUDGET = float(os.getenv('SPEND_HOURLY_BUDGET', '0'))
+SPEND_DAILY_BUDGET = float(os.getenv('SPEND_DAILY_BUDGET', '0'))
+# 予算のこの割合を超えたら安いモデルだけを使う
+SPEND_DOWNGRADE_RATIO = float(os.getenv('SPEND_DOWNGRADE_RATIO', '0.8'))
+# 予算を超えている間に呼び出しを待たせる最大の時間（秒）。過ぎたらBudgetExceededErrorにする
+SPEND_MAX_WAIT_SECONDS = float(os.getenv('SPEND_MAX_WAIT_SECONDS', '60'))
+THROTTLE_CHECK_SECONDS = 5
+# 1分ごとの集計を残す期間（秒）
+MINUTE_RETENTION_SECONDS = 2 * 86400
+# 設定されている場合は全インスタンスの記録をGCSのバケットで共有する（既定はチェックポイントと同じバケット）
+SPEND_LEDGER_BUCKET = os.getenv('SPEND_LEDGER_BUCKET', os.getenv('CHECKPOINT_BUCKET'))
+SPEND_LEDGER_PREFIX = os.getenv('SPEND_LEDGER_PREFIX', 'spend/')
+# 共有の支出を読み直す間隔（秒）。この間の他のインスタンスの支出は予算の判定に遅れて反映される
+SPEND_SYNC_SECONDS = float(os.getenv('SPEND_SYNC_SECONDS', '30'))
+
+# 処理中の記事（記録元, URL）。スレッドやasyncio.to_threadごとに別の値になる
+CURRENT_ARTICLE = contextvars.ContextVar('spend_article', default=(None, None))
+
+
+# 予算を超えていて呼び出せない場合の例外
+class BudgetExceededError(Exception):
+    pass
+
+
+# これ以降の呼び出しを記事に紐づける
+def set_article(source, url):
+    CURRENT_ARTICLE.set((source, url))
+
+
+REPORT_GROUPS = ('stage', 'model', 'source', 'url')
+SPEND_COLUMNS = ('ts', 'model', 'stage', 'source', 'article_key', 'url', 'prompt_tokens', 'completion_tokens', 'cost')
+
+
+# 記録の行を段階、モデル、記録元、記事ごとに集計する（SQLiteのreportと同じ形の行を返す）
+def aggregate(rows, group_by):
+    groups = {}
+    for row in rows:
+        record = dict(zip(SPEND_COLUMNS, row))
+        group = groups.setdefault(record[group_by], [0, 0, 0, 0.0, set()])
+        group[0] += 1
+        group[1] += record['prompt_tokens'] or 0
+        group[2] += record['completion_tokens'] or 0
+        group[3] += record['cost'] or 0.0
+        if record['article_key']:
+            group[4].add(record['article_key'])
+    results = [(name, calls, prompt_tokens, completion_tokens, cost, len(articles)) for name, (calls, prompt_tokens, completion_tokens, cost, articles) in groups.items()]
+    return sorted(results, key=lambda result: result[4], reverse=True)
+
+
+# 全インスタンスの記録を共有するGCSのバケット（インスタンスと1時間ごとに1オブジェクト。1分ごとの集計はメタデータに置く）
+class SharedSpend:
+    def __init__(self, bucket_name=SPEND_LEDGER_BUCKET, prefix=SPEND_LEDGER_PREFIX):
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # 期間（秒） -> (読んだ時刻, 支出)
+        self.cache = {}
+
+    def _hour_prefix(self, hour):
+        return f'{self.prefix}{time.strftime("%Y%m%d%H", time.gmtime(hour * 3600))}/'
+
+    # このインスタンスの1時間分の記録を置き換える（自分のオブジェクトにしか書かないので競合しない）
+    def upload(self, instance_id, hour, rows):
+        minutes = {}
+        for row in rows:
+            minute = str(int(row[0] // 60))
+            minutes[minute] = round(minutes.get(minute, 0.0) + (row[8] or 0.0), 6)
+        blob = self.bucket.blob(f'{self._hour_prefix(hour)}{instance_id}.json')
+        blob.metadata = {"minutes": json.dumps(minutes)}
+        blob.upload_from_string(json.dumps(rows, ensure_ascii=False), content_type='application/json')
+
+    # 全インスタンスの直近seconds秒の支出（ドル、SPEND_SYNC_SECONDS秒の間は前回の値を使う）
+    def window_cost(self, seconds, now):
+        with self.lock:
+            cached = self.cache.get(seconds)
+            if cached and now - cached[0] < SPEND_SYNC_SECONDS:
+                return cached[1]
+        cutoff_minute = int((now - seconds) // 60)
+        total = 0.0
+        for hour in range(int((now - seconds) // 3600), int(now // 3600) + 1):
+            for blob in self.client.list_blobs(self.bucket, prefix=self._hour_prefix(hour)):
+                minutes = json.loads((blob.metadata or {}).get('minutes', '{}'))
+                total += sum(cost for minute, cost in minutes.items() if int(minute) > cutoff_minute)
+        with self.lock:
+            self.cache[seconds] = (now, total)
+        return total
+
+    # 全インスタンスの記録の行（since以降）
+    def rows(self, since, now):
+        rows = []
+        for hour in range(int(since // 3600), int(now // 3600) + 1):
+            for blob in self.client.list_blobs(self.bucket, prefix=self._hour_prefix(hour)):
+                rows.extend(row for row in json.loads(blob.download_as_text()) if row[0] >= since)
+        return rows
+
+
+class SpendLedger:
+    def __init__(self, db_path=SPEND_LEDGER_DB, shared=None):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        # 複数のプロセスから記録するため
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS spend (ts REAL, model TEXT, stage TEXT, source TEXT, article_key TEXT, url TEXT, '
+            'prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS spend_ts ON spend (ts)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS minutes (minute INTEGER PRIMARY KEY, cost REAL)')
+        # 共有のバケットでのこのDBの名前（同じDBを使うプロセスは同じ名前で同じ内容をアップロードする）
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('instance_id', uuid.uuid4().hex))
+        self.instance_id = self.db.execute('SELECT value FROM meta WHERE name = ?', ('instance_id',)).fetchone()[0]
+        self.shared = shared
+        self.pruned_minute = 0
+        # 共有のバケットにまだ反映していない時間（記録のたびにアップロードせず、SPEND_SYNC_SECONDS秒ごとにまとめて送る）
+        self.dirty_hours = set()
+        self.sync_lock = threading.Lock()
+        self.sync_thread = None
+
+    # 呼び出し1回の使用量を記録し、コストを返す
+    def record(self, model, stage, prompt_tokens, completion_tokens, now=None):
+        now = now or time.time()
+        source, url = CURRENT_ARTICLE.get()
+        cost = pipeline_budget.estimate_cost(model, prompt_tokens, completion_tokens)
+        minute = int(now // 60)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO spend VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (now, model, stage, source, processed_index.item_key(url) if url else None, url, prompt_tokens, completion_tokens, cost)
+            )
+            self.db.execute('INSERT INTO minutes VALUES (?, ?) ON CONFLICT(minute) DO UPDATE SET cost = cost + excluded.cost', (minute, cost))
+            # 古い1分ごとの集計は1時間に1回消す
+            if minute - self.pruned_minute >= 60:
+                self.db.execute('DELETE FROM minutes WHERE minute < ?', (minute - MINUTE_RETENTION_SECONDS // 60,))
+                self.pruned_minute = minute
+            if self.shared:
+                self.dirty_hours.add(minute // 60)
+                if self.sync_thread is None:
+                    self.sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+                    self.sync_thread.start()
+        return cost
+
+    # SPEND_SYNC_SECONDS秒ごとに共有のバケットに反映する（常駐プロセス向け。関数のエントリポイントは終わる前にflushを呼ぶ）
+    def _sync_loop(self):
+        while True:
+            time.sleep(SPEND_SYNC_SECONDS)
+            self.sync()
+
+    # 反映していない時間の記録を1時間分ずつアップロードする（失敗した時間は次の反映で送り直す）
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                hours, self.dirty_hours = self.dirty_hours, set()
+            for hour in sorted(hours):
+                try:
+                    self.shared.upload(self.instance_id, hour, self.rows_between(hour * 3600, (hour + 1) * 3600))
+                except Exception as e:
+                    logging.warning(f"支出を共有のバケットに反映できませんでした: {e}")
+                    with self.lock:
+                        self.dirty_hours.add(hour)
+
+    # このDBの記録の行（startからendまで）
+    def rows_between(self, start, end):
+        with self.lock:
+            return [list(row) for row in self.db.execute(f'SELECT {", ".join(SPEND_COLUMNS)} FROM spend WHERE ts >= ? AND ts < ? ORDER BY ts', (start, end)).fetchall()]
+
+    # 直近seconds秒の支出（ドル、共有のバケットがあれば全インスタンスの合計）
+    def window_cost(self, seconds, now=None):
+        now = now or time.time()
+        if self.shared:
+            return self.shared.window_cost(seconds, now)
+        with self.lock:
+            row = self.db.execute('SELECT SUM(cost) FROM minutes WHERE minute > ?', (int((now - seconds) // 60),)).fetchone()
+        return row[0] or 0.0
+
+    # 予算に対する支出の割合（予算が設定されていなければ0）
+    def usage_ratio(self, now=None):
+        ratios = [0.0]
+        if SPEND_HOURLY_BUDGET > 0:
+            ratios.append(self.window_cost(3600, now) / SPEND_HOURLY_BUDGET)
+        if SPEND_DAILY_BUDGET > 0:
+            ratios.append(self.window_cost(86400, now) / SPEND_DAILY_BUDGET)
+        return max(ratios)
+
+    # 段階、モデル、記録元ごとの支出を集計する（共有のバケットがあれば全インスタンス分）
+    def report(self, days=1, group_by='stage', now=None):
+        if group_by not in REPORT_GROUPS:
+            raise ValueError(f"集計できない項目です: {group_by}")
+        now = now or time.time()
+        since = now - days * 86400
+        if self.shared:
+            return aggregate(self.shared.rows(since, now), group_by)
+        with self.lock:
+            return self.db.execute(
+                f'SELECT {group_by}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), COUNT(DISTINCT article_key) '
+                f'FROM spend WHERE ts >= ? GROUP BY {group_by} ORDER BY SUM(cost) DESC',
+                (since,)
+            ).fetchall()
+
+
+# 環境変数に応じて共有のバケットを使う（なければ予算はこのインスタンスの支出だけにかかる）
+def init_ledger():
+    if SPEND_LEDGER_BUCKET:
+        return SpendLedger(shared=SharedSpend())
+    if os.getenv('K_SERVICE') and (SPEND_HOURLY_BUDGET > 0 or SPEND_DAILY_BUDGET > 0):
+        logging.warning("SPEND_LEDGER_BUCKETが設定されていないため、予算はこのインスタンスの支出だけで判定します（インスタンスごとの目安）")
+    return SpendLedger()
+
+
+LEDGER = init_ledger()
+
+
+# トークン数を記録する（記録に失敗しても呼び出し元の処理は止めない）
+def record_tokens(model, stage, prompt_tokens, completion_tokens):
+    try:
+        return LEDGER.record(model, stage, prompt_tokens or 0, completion_tokens or 0)
+    except Exception as e:
+        logging.error(f"使用量の記録に失敗しました: {model} {stage}: {e}")
+        return 0.0
+
+
+# レスポンスのusageを記録する
+def record_usage(model, stage, usage):
+    if usage is None:
+        return 0.0
+    return record_tokens(model, stage, usage.prompt_tokens, usage.completion_tokens)
+
+
+# usageがない場合（ストリームを途中で打ち切った場合など）はトークン数を数えて記録する
+def record_estimate(model, stage, messages, output_text):
+    prompt_tokens = sum(prompt_builder.count_tokens(message["content"], model) for message in messages)
+    return record_tokens(model, stage, prompt_tokens, prompt_builder.count_tokens(output_text or '', model))
+
+
+# 反映していない支出を共有のバケットに送る（関数が終わるとバックグラウンドのスレッドは止まるので、各エントリポイントの最後に呼ぶ）
+def flush():
+    if LEDGER.shared:
+        LEDGER.sync()
+
+
+# 予算の状況（'ok'、'downgrade'、'exhausted'のいずれか）
+def pressure():
+    try:
+        ratio = LEDGER.usage_ratio()
+    except Exception as e:
+        logging.error(f"支出の集計に失敗しました: {e}")
+        return 'ok'
+    if ratio >= 1.0:
+        return 'exhausted'
+    if ratio >= SPEND_DOWNGRADE_RATIO:
+        return 'downgrade'
+    return 'ok'
+
+
+# 予算を超えている間は呼び出しを待たせ、待っても下がらなければBudgetExceededErrorにする
+def throttle(stage):
+    deadline = time.monotonic() + SPEND_MAX_WAIT_SECONDS
+    warned = False
+    while pressure() == 'exhausted':
+        if time.monotonic() >= deadline:
+            raise BudgetExceededError(f"OpenAIの予算を超えているため呼び出しを見送りました: {stage}")
+        if not warned:
+            logging.warning(f"OpenAIの予算を超えているため呼び出しを待たせます: {stage}")
+            warned = True
+        time.sleep(THROTTLE_CHECK_SECONDS)
+
+
+# 支出のレポートを表示する（python spend_ledger.py report [日数] [stage|model|source|url]）
+def print_report(days=1, group_by='stage'):
+    rows = LEDGER.report(days, group_by)
+    total = sum(row[4] or 0 for row in rows)
+    print(f"直近{days}日間の支出（{group_by}ごと）: ${total:.4f}")
+    print(f"{group_by:<30} {'呼び出し':>8} {'入力トークン':>12} {'出力トークン':>12} {'記事':>6} {'コスト($)':>10} {'割合':>6}")
+    for name, calls, prompt_tokens, completion_tokens, cost, articles in rows:
+        share = cost / total if total else 0
+        print(f"{str(name):<30} {calls:>8} {prompt_tokens or 0:>12} {completion_tokens or 0:>12} {articles:>6} {cost or 0:>10.4f} {share:>6.1%}")
+    print(f"直近1時間: ${LEDGER.window_cost(3600):.4f}、直近24時間: ${LEDGER.window_cost(86400):.4f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        print_report(float(sys.argv[2]) if len(sys.argv) > 2 else 1, sys.argv[3] if len(sys.argv) > 3 else 'stage')
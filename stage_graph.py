@@ -0,0 +1,117 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+# 1記事の段階を依存関係のグラフとして実行するモジュール。
+# 各段階は入力にする段階を宣言し、入力がそろった段階から並行して実行する（リード文、意見、スコアなど）。
+# 1記事の処理時間は全段階の合計ではなく、一番長い依存の経路の長さになる。
+
+# 1記事で同時に実行する段階の数
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', '4'))
+
+
+# 入力の段階が失敗したために実行しなかった場合の例外
+class UpstreamError(Exception):
+    pass
+
+
+@dataclass
+class Stage:
+    name: str
+    # 入力の段階の出力をキーワード引数で受け取る関数
+    fn: object
+    inputs: tuple = ()
+    # 段階の期限（秒、Noneなら無制限）。期限を過ぎた段階は失敗として扱う（スレッドは止められないので結果を待たない）
+    timeout: float = None
+    # Trueなら失敗しても出力をNoneとして後の段階を実行する
+    optional: bool = False
+
+
+@dataclass
+class GraphResult:
+    outputs: dict = field(default_factory=dict)
+    errors: dict = field(default_factory=dict)
+    # 段階ごとの実行時間（秒）
+    seconds: dict = field(default_factory=dict)
+
+    def get(self, name, default=None):
+        return self.outputs.get(name, default)
+
+
+class StageGraph:
+    def __init__(self, name, max_workers=STAGE_WORKERS):
+        self.name = name
+        self.max_workers = max_workers
+        self.stages = {}
+
+    # 段階を追加する（入力は先に追加した段階か、runに渡す出力）
+    def add(self, name, fn, inputs=(), timeout=None, optional=False):
+        self.stages[name] = Stage(name, fn, tuple(inputs), timeout, optional)
+        return self
+
+    # 段階を実行する（initialはすでに出力がある段階。失敗した段階はerrorsに入れ、他の段階は続ける）
+    def run(self, initial=None):
+        result = GraphResult(outputs=dict(initial or {}))
+        pending = {name: stage for name, stage in self.stages.items() if name not in result.outputs}
+        defined = set()
+        for name, stage in self.stages.items():
+            for dependency in stage.inputs:
+                if dependency not in defined and dependency not in result.outputs:
+                    raise ValueError(f"未定義の段階に依存しています: {name} -> {dependency}")
+            defined.add(name)
+        running = {}
+        started_at = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                # 入力がそろった段階を起動し、必須の入力が失敗した段階は実行しない
+                for name, stage in list(pending.items()):
+                    failed = [dependency for dependency in stage.inputs if dependency in result.errors and not self.stages[dependency].optional]
+                    if failed:
+                        result.errors[name] = UpstreamError(f"入力の段階が失敗したため実行しません: {name} <- {', '.join(failed)}")
+                        del pending[name]
+                    elif all(dependency in result.outputs or dependency in result.errors for dependency in stage.inputs):
+                        kwargs = {dependency: result.outputs.get(dependency) for dependency in stage.inputs}
+                        # 記事に紐づけた情報（支出の台帳など）を段階のスレッドに引き継ぐ
+                        future = executor.submit(contextvars.copy_context().run, stage.fn, **kwargs)
+                        deadline = time.monotonic() + stage.timeout if stage.timeout else None
+                        running[future] = (stage, time.monotonic(), deadline)
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                deadlines = [deadline for _, _, deadline in running.values() if deadline]
+                wait_seconds = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+                done, _ = wait(list(running), timeout=wait_seconds, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage, stage_started_at, _ = running.pop(future)
+                    result.seconds[stage.name] = time.monotonic() - stage_started_at
+                    try:
+                        result.outputs[stage.name] = future.result()
+                    except Exception as e:
+                        logging.warning(f"段階が失敗しました: {self.name} {stage.name}: {e}")
+                        result.errors[stage.name] = e
+
+                now = time.monotonic()
+                for future, (stage, stage_started_at, deadline) in list(running.items()):
+                    if deadline and now >= deadline:
+                        running.pop(future)
+                        future.cancel()
+                        result.seconds[stage.name] = now - stage_started_at
+                        logging.warning(f"段階が期限の{stage.timeout:g}秒を過ぎました: {self.name} {stage.name}")
+                        result.errors[stage.name] = TimeoutError(f"段階が期限を過ぎました: {stage.name}")
+        finally:
+            # 期限を過ぎた段階の終了は待たない
+            executor.shutdown(wait=False)
+
+        for name in result.errors:
+            if self.stages[name].optional:
+                result.outputs[name] = None
+        total = time.monotonic() - started_at
+        logging.info(f"段階の実行が完了: {self.name} {total:.1f}秒（合計{sum(result.seconds.values()):.1f}秒分の段階）")
+        return result
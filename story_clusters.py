@@ -0,0 +1,347 @@
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+import numpy as np
+import processed_index
+import relevance_gate
+
+# 同じ出来事（モデルの発表や障害など）についての記事をまとめるクラスタリングの段階。
+# 直近の記事をハッシュ版のTF-IDFでベクトルにし、クラスタの重心とのコサイン類似度で振り分ける。
+# クラスタの最初の記事（リーダー）だけを要約し、後から来た記事はLLMを呼ばずにリーダーの要約の出典としてまとめる。
+# 後から来た記事もシートに行を残し、要約の代わりにリーダーの記事へのリンクを書く。
+
+CLUSTER_DB = os.getenv('CLUSTER_DB', '/tmp/autonews_clusters.sqlite3')
+# インスタンスの間で共有するクラスタの状態のバケット（既定はチェックポイントと同じバケット）
+CLUSTER_BUCKET = os.getenv('CLUSTER_BUCKET', os.getenv('CHECKPOINT_BUCKET'))
+CLUSTER_PREFIX = os.getenv('CLUSTER_PREFIX', 'clusters/')
+# 重心とのコサイン類似度がこれ以上なら同じ出来事とみなす
+CLUSTER_SIMILARITY = float(os.getenv('CLUSTER_SIMILARITY', '0.55'))
+# この時間更新のないクラスタには新しい記事を入れない（これより古いクラスタは削除する）
+CLUSTER_WINDOW_HOURS = float(os.getenv('CLUSTER_WINDOW_HOURS', '48'))
+# 他のインスタンスが作ったクラスタを取り込むため、重心を読み込み直す間隔（秒）
+CLUSTER_RELOAD_SECONDS = float(os.getenv('CLUSTER_RELOAD_SECONDS', '300'))
+# リーダーがこの時間（秒）要約を書き込まない場合は、次に来た記事がリーダーを引き継ぐ
+LEADER_TIMEOUT_SECONDS = float(os.getenv('CLUSTER_LEADER_TIMEOUT', '900'))
+# ベクトルにする本文の長さ
+CLUSTER_TEXT_LENGTH = 3000
+# リーダーの要約にまとめる出典の数と、1出典あたりの文字数
+MAX_MERGED_SOURCES = int(os.getenv('CLUSTER_MAX_MERGED_SOURCES', '5'))
+MEMBER_TEXT_LENGTH = 4000
+# 同時に同じクラスタを更新した場合に読み直す回数
+UPDATE_CONFLICT_RETRIES = 5
+
+
+@dataclass
+class Assignment:
+    cluster_id: str
+    # Trueならこの記事を要約する
+    leader: bool
+    similarity: float
+
+
+# 重心はfloat32のバイト列をBase64にしてJSONに入れる
+def encode_vector(vector):
+    return base64.b64encode(vector.astype(np.float32).tobytes()).decode('ascii')
+
+
+def decode_vector(data):
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32).copy()
+
+
+# クラスタ（重心、リーダー、メンバー）を1件1行のJSONでこのインスタンスのSQLiteに保存する
+class LocalClusterState:
+    def __init__(self, db_path=CLUSTER_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS cluster_documents (id TEXT PRIMARY KEY, name TEXT, updated_at REAL, data TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cluster_members (name TEXT, key TEXT, cluster_id TEXT, added_at REAL, PRIMARY KEY (name, key))')
+
+    # 更新期間内のクラスタ
+    def recent(self, name, since):
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM cluster_documents WHERE name = ? AND updated_at >= ?', (name, since)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, cluster_id):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM cluster_documents WHERE id = ?', (cluster_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # 記事が入っているクラスタのID（なければNone）
+    def find(self, name, key):
+        with self.lock:
+            row = self.db.execute('SELECT cluster_id FROM cluster_members WHERE name = ? AND key = ?', (name, key)).fetchone()
+        return row[0] if row else None
+
+    # クラスタを作成する（同じIDのクラスタがすでにあればFalse）
+    def create(self, cluster):
+        with self.lock, self.db:
+            created = self.db.execute(
+                'INSERT OR IGNORE INTO cluster_documents VALUES (?, ?, ?, ?)',
+                (cluster['id'], cluster['name'], cluster['updated_at'], json.dumps(cluster, ensure_ascii=False))
+            ).rowcount
+            if created:
+                self.db.execute('INSERT OR IGNORE INTO cluster_members VALUES (?, ?, ?, ?)', (cluster['name'], cluster['leader_key'], cluster['id'], cluster['updated_at']))
+        return bool(created)
+
+    # クラスタを読み、change(cluster)で書き換えて保存する（changeの戻り値を返す）。key（新しく入れた記事）があれば索引にも追加する
+    def update(self, cluster_id, change, key=None):
+        with self.lock, self.db:
+            row = self.db.execute('SELECT data FROM cluster_documents WHERE id = ?', (cluster_id,)).fetchone()
+            if not row:
+                return None
+            cluster = json.loads(row[0])
+            result = change(cluster)
+            self.db.execute('UPDATE cluster_documents SET updated_at = ?, data = ? WHERE id = ?', (cluster['updated_at'], json.dumps(cluster, ensure_ascii=False), cluster_id))
+            if key:
+                self.db.execute('INSERT OR IGNORE INTO cluster_members VALUES (?, ?, ?, ?)', (cluster['name'], key, cluster_id, cluster['updated_at']))
+        return result
+
+    # 更新期間を過ぎたクラスタと記事の索引を削除し、削除したクラスタの数を返す
+    def prune(self, before):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM cluster_members WHERE added_at < ?', (before,))
+            return self.db.execute('DELETE FROM cluster_documents WHERE updated_at < ?', (before,)).rowcount
+
+
+# クラスタをGCSのバケットに1クラスタ1オブジェクトで保存する（インスタンスの間で共有し、コールドスタートでも失われない）
+# 同時に同じクラスタを更新した場合は、世代番号を条件にして読み直す
+class GCSClusterState:
+    def __init__(self, bucket_name=CLUSTER_BUCKET, prefix=CLUSTER_PREFIX, client=None):
+        self.client = client or storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        self.prefix = prefix
+
+    # クラスタのIDは"{name}/{リーダーの記事のキー}"
+    def _cluster_blob(self, cluster_id):
+        return self.bucket.blob(f'{self.prefix}{cluster_id}.json')
+
+    def _member_blob(self, name, key):
+        return self.bucket.blob(f'{self.prefix}{name}/members/{key}.json')
+
+    def _read(self, blob):
+        try:
+            return json.loads(blob.download_as_text()), blob.generation
+        except NotFound:
+            return None, 0
+
+    def recent(self, name, since):
+        clusters = []
+        for blob in self.client.list_blobs(self.bucket, prefix=f'{self.prefix}{name}/clusters/'):
+            if blob.updated and blob.updated.timestamp() < since:
+                continue
+            cluster, _ = self._read(blob)
+            if cluster and cluster['updated_at'] >= since:
+                clusters.append(cluster)
+        return clusters
+
+    def get(self, cluster_id):
+        return self._read(self._cluster_blob(cluster_id))[0]
+
+    def find(self, name, key):
+        member, _ = self._read(self._member_blob(name, key))
+        return member['cluster_id'] if member else None
+
+    def _write(self, blob, data, generation):
+        blob.upload_from_string(json.dumps(data, ensure_ascii=False), content_type='application/json', if_generation_match=generation)
+
+    def _index(self, name, key, cluster_id):
+        self._member_blob(name, key).upload_from_string(json.dumps({"key": key, "cluster_id": cluster_id}), content_type='application/json')
+
+    def create(self, cluster):
+        try:
+            self._write(self._cluster_blob(cluster['id']), cluster, 0)
+        except PreconditionFailed:
+            return False
+        self._index(cluster['name'], cluster['leader_key'], cluster['id'])
+        return True
+
+    def update(self, cluster_id, change, key=None):
+        for _ in range(UPDATE_CONFLICT_RETRIES):
+            blob = self._cluster_blob(cluster_id)
+            cluster, generation = self._read(blob)
+            if not cluster:
+                return None
+            result = change(cluster)
+            try:
+                self._write(blob, cluster, generation)
+            except PreconditionFailed:
+                continue
+            if key:
+                self._index(cluster['name'], key, cluster_id)
+            return result
+        raise RuntimeError(f"クラスタ{cluster_id}の更新が他のインスタンスと競合し続けました")
+
+    # 作成や更新から日数が経ったオブジェクトを削除する（バケットのライフサイクルルールを設定している場合は不要）
+    def prune(self, before):
+        deleted = 0
+        for blob in self.client.list_blobs(self.bucket, prefix=self.prefix):
+            if blob.updated and blob.updated.timestamp() < before:
+                try:
+                    blob.delete()
+                except NotFound:
+                    continue
+                if '/clusters/' in blob.name:
+                    deleted += 1
+        return deleted
+
+
+# 環境変数に応じて状態の保存先を選ぶ（バケットがなければこのインスタンスのSQLite）
+def init_state():
+    if CLUSTER_BUCKET:
+        return GCSClusterState()
+    if os.getenv('K_SERVICE'):
+        logging.warning("CLUSTER_BUCKETが設定されていないため、記事のクラスタはインスタンスごとになります")
+    return LocalClusterState()
+
+
+class StoryIndex:
+    def __init__(self, name, state=None, vectorizer=None):
+        self.name = name
+        # 関連度ゲートのモデルがあればそのIDFを使う
+        self.vectorizer = vectorizer or (relevance_gate.MODEL[0] if relevance_gate.MODEL else relevance_gate.HashingTfidf())
+        self.lock = threading.Lock()
+        self.state = state or init_state()
+        self.pruned_at = 0
+        self.load()
+
+    # 更新期間内のクラスタの重心を読み込む（重心はこのインスタンスの振り分けの計算に使うだけで、更新は状態に書き込む）
+    def load(self, now=None):
+        now = now or time.time()
+        cutoff = now - CLUSTER_WINDOW_HOURS * 3600
+        # 古いクラスタは1時間ごとに削除する
+        if now - self.pruned_at > 3600:
+            self.state.prune(cutoff)
+            self.pruned_at = now
+        clusters = self.state.recent(self.name, cutoff)
+        self.ids = [cluster['id'] for cluster in clusters]
+        self.sizes = np.array([cluster['size'] for cluster in clusters], dtype=np.float32)
+        self.centroids = np.stack([decode_vector(cluster['centroid']) for cluster in clusters]) if clusters else np.zeros((0, self.vectorizer.dim), dtype=np.float32)
+        self.loaded_at = now
+
+    def vectorize(self, title, text):
+        return self.vectorizer.transform([f'{title}\n{title}\n{text[:CLUSTER_TEXT_LENGTH]}'])[0]
+
+    # 記事をクラスタに振り分ける
+    def assign(self, url, title, text, now=None):
+        now = now or time.time()
+        key = processed_index.item_key(url)
+        vector = self.vectorize(title, text)
+        with self.lock:
+            # 再試行や再配信で同じ記事が来た場合は前回の振り分けを使う（別のインスタンスが振り分けた記事も含む）
+            cluster_id = self.state.find(self.name, key)
+            cluster = self.state.get(cluster_id) if cluster_id else None
+            if cluster:
+                return Assignment(cluster_id, cluster['leader_key'] == key, 1.0)
+
+            # 古いクラスタを外し、他のインスタンスが作ったクラスタを取り込むため、定期的に読み込み直す
+            if now - self.loaded_at > CLUSTER_RELOAD_SECONDS:
+                self.load(now)
+
+            if len(self.ids):
+                similarities = self.centroids @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= CLUSTER_SIMILARITY:
+                    assignment = self._join(best, key, url, title, text, vector, float(similarities[best]), now)
+                    if assignment:
+                        return assignment
+            return self._create(key, url, title, vector, now)
+
+    def _create(self, key, url, title, vector, now):
+        cluster = {
+            "id": f'{self.name}/clusters/{key}',
+            "name": self.name,
+            "centroid": encode_vector(vector),
+            "size": 1,
+            "leader_key": key,
+            "leader_since": now,
+            "summarized": False,
+            "updated_at": now,
+            "members": [{"key": key, "url": url, "title": title, "text": None, "added_at": now}]
+        }
+        if not self.state.create(cluster):
+            # 別のインスタンスが同時に同じ記事でクラスタを作った
+            return Assignment(cluster['id'], False, 1.0)
+        self.ids.append(cluster['id'])
+        self.sizes = np.append(self.sizes, np.float32(1))
+        self.centroids = np.vstack([self.centroids, vector[None, :].astype(np.float32)])
+        return Assignment(cluster['id'], True, 1.0)
+
+    def _join(self, index, key, url, title, text, vector, similarity, now):
+        cluster_id = self.ids[index]
+
+        # 他のインスタンスが更新した重心やリーダーに対して変更する（競合した場合は読み直してもう一度呼ばれる）
+        def change(cluster):
+            # 重心を平均で更新し、コサイン類似度のために正規化し直す
+            size = cluster['size'] + 1
+            centroid = decode_vector(cluster['centroid'])
+            centroid = centroid + (vector - centroid) / size
+            norm = np.linalg.norm(centroid)
+            if norm:
+                centroid = centroid / norm
+            # リーダーが要約を書き込まないまま時間が経った場合は引き継ぐ
+            take_over = not cluster['summarized'] and now - cluster['leader_since'] > LEADER_TIMEOUT_SECONDS
+            if take_over:
+                cluster['leader_key'], cluster['leader_since'] = key, now
+            # 要約の前に来た記事は本文を残し、リーダーの要約に出典としてまとめる
+            member_text = None if cluster['summarized'] or take_over else text[:MEMBER_TEXT_LENGTH]
+            cluster['members'].append({"key": key, "url": url, "title": title, "text": member_text, "added_at": now})
+            cluster.update(centroid=encode_vector(centroid), size=size, updated_at=now)
+            return take_over, centroid, size
+
+        result = self.state.update(cluster_id, change, key=key)
+        if result is None:
+            # 別のインスタンスが期間を過ぎたクラスタを削除した
+            return None
+        take_over, centroid, size = result
+        self.centroids[index] = centroid
+        self.sizes[index] = size
+        if take_over:
+            logging.warning(f"クラスタ{cluster_id}のリーダーが要約を書き込まないため引き継ぎます: {url}")
+        else:
+            logging.info(f"同じ出来事の記事としてクラスタ{cluster_id}にまとめ、LLMの呼び出しを省略します: {url}（類似度{similarity:.2f}）")
+        return Assignment(cluster_id, take_over, similarity)
+
+    # リーダーの要約にまとめる出典（タイトル、URL、本文）を取得する
+    def sources(self, cluster_id):
+        cluster = self.state.get(cluster_id) or {"members": []}
+        members = sorted((member for member in cluster['members'] if member['text'] is not None), key=lambda member: member['added_at'])
+        return [(member['title'], member['url'], member['text']) for member in members[:MAX_MERGED_SOURCES]]
+
+    # クラスタのリーダーの記事（タイトル、URL）
+    def leader(self, cluster_id):
+        cluster = self.state.get(cluster_id)
+        if not cluster:
+            return None
+        return next(((member['title'], member['url']) for member in cluster['members'] if member['key'] == cluster['leader_key']), None)
+
+    # 要約を書き込んだクラスタを記録する（これ以降の記事は出典として記録するだけ）
+    def mark_summarized(self, cluster_id):
+        def change(cluster):
+            cluster['summarized'] = True
+            for member in cluster['members']:
+                member['text'] = None
+        self.state.update(cluster_id, change)
+
+
+# 後から来た記事の行に要約の代わりに書く、リーダーの記事へのリンク
+def leader_note(leader):
+    if not leader:
+        return '同じ出来事の記事があります'
+    title, url = leader
+    return f'同じ出来事の記事: {title} ({url})'
+
+
+# リーダーの本文と同じ出来事の他の記事を、1回の要約に渡す入力にまとめる
+def merge_sources(title, url, text, sources):
+    parts = [f'出典1: {title} ({url})\n{text}']
+    for number, (source_title, source_url, source_text) in enumerate(sources, start=2):
+        parts.append(f'出典{number}: {source_title} ({source_url})\n{source_text}')
+    return '\n\n'.join(parts)
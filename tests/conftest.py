@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+# テストからリポジトリ直下のモジュールを読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# モジュールの読み込み時に作られるローカルのストアを、テストごとの一時ディレクトリに置く（GCSは使わない）
+STATE_DIR = tempfile.mkdtemp(prefix='autonews_test_')
+for name, filename in [
+    ('CHECKPOINT_DIR', 'checkpoints'),
+    ('DEAD_LETTER_DB', 'dead_letters.sqlite3'),
+    ('HEADLINE_CACHE_DB', 'headlines.sqlite3'),
+    ('INGEST_STATE_DB', 'ingestion.sqlite3'),
+    ('PROCESSED_INDEX_DB', 'processed_index.sqlite3'),
+    ('RECORD_DB', 'records.sqlite3'),
+    ('SPEND_LEDGER_DB', 'spend.sqlite3'),
+    ('CLUSTER_DB', 'clusters.sqlite3'),
+    ('GATE_MODEL_PATH', 'relevance_model.npz'),
+]:
+    os.environ[name] = os.path.join(STATE_DIR, filename)
+for name in ('CHECKPOINT_BUCKET', 'K_SERVICE'):
+    os.environ.pop(name, None)
@@ -0,0 +1,54 @@
+import os
+import time
+import pytest
+import checkpoint_store
+from openai_streaming import StreamResult
+
+URL = 'https://example.com/article'
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return checkpoint_store.LocalCheckpointBackend(str(tmp_path / 'checkpoints'))
+
+
+def stream_result(text, truncated):
+    return StreamResult(text=text, truncated=truncated, finish_reason='deadline' if truncated else 'stop', first_token_seconds=0.1, total_seconds=1.0)
+
+
+def test_retry_resumes_from_saved_stages(backend):
+    checkpoint_store.ArticleCheckpoint(URL, backend).run('parsed_text', lambda: 'body')
+    # 別の呼び出し（再試行）は保存済みの段階を実行しない
+    resumed = checkpoint_store.ArticleCheckpoint(URL, backend)
+    assert resumed.run('parsed_text', lambda: pytest.fail('保存済みの段階を実行しない')) == 'body'
+
+
+def test_empty_outputs_are_not_saved(backend):
+    checkpoint_store.ArticleCheckpoint(URL, backend).run('summary', lambda: '')
+    assert checkpoint_store.ArticleCheckpoint(URL, backend).get('summary') is None
+
+
+def test_truncated_stream_result_is_used_but_not_saved(backend):
+    checkpoint = checkpoint_store.ArticleCheckpoint(URL, backend)
+    assert checkpoint.run('final_summary', lambda: stream_result('途中まで', truncated=True)) == '途中まで'
+    resumed = checkpoint_store.ArticleCheckpoint(URL, backend)
+    assert resumed.run('final_summary', lambda: stream_result('完全な要約', truncated=False)) == '完全な要約'
+    assert checkpoint_store.ArticleCheckpoint(URL, backend).get('final_summary') == '完全な要約'
+
+
+def test_clear_removes_the_checkpoint(backend):
+    checkpoint = checkpoint_store.ArticleCheckpoint(URL, backend)
+    checkpoint.save('lead', 'リード文')
+    checkpoint.clear()
+    assert checkpoint_store.ArticleCheckpoint(URL, backend).data == {}
+
+
+def test_prune_removes_only_expired_checkpoints(backend):
+    checkpoint_store.ArticleCheckpoint(URL, backend).save('lead', 'old')
+    checkpoint_store.ArticleCheckpoint('https://example.com/new', backend).save('lead', 'new')
+    old_path = backend._path(checkpoint_store.ArticleCheckpoint(URL, backend).key)
+    eight_days_ago = time.time() - 8 * 86400
+    os.utime(old_path, (eight_days_ago, eight_days_ago))
+    assert backend.prune(7) == 1
+    assert checkpoint_store.ArticleCheckpoint(URL, backend).data == {}
+    assert checkpoint_store.ArticleCheckpoint('https://example.com/new', backend).get('lead') == 'new'
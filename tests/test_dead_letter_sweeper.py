@@ -0,0 +1,54 @@
+import sys
+import types
+import pytest
+import dead_letter_sweeper
+import record_store
+
+
+class FakeStore:
+    def __init__(self):
+        self.resolved = []
+
+    def resolve(self, source, url):
+        self.resolved.append(url)
+
+
+def letter(url):
+    return {"source": "hn_article", "url": url, "key": url, "title": "t", "stage": "fetch", "attempts": 1, "payload": None}
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(dead_letter_sweeper.dead_letter, 'STORE', store)
+    monkeypatch.setattr(dead_letter_sweeper.headline_batch, 'flush', lambda: 0)
+    return store
+
+
+def test_resolves_only_after_flush(store, monkeypatch):
+    calls = []
+    monkeypatch.setattr(dead_letter_sweeper.headline_batch, 'flush', lambda: calls.append('headline'))
+    monkeypatch.setattr(dead_letter_sweeper.record_store, 'flush', lambda: calls.append('record'))
+    assert dead_letter_sweeper.resolve_after_flush([letter('https://a.example')]) == 1
+    assert calls == ['headline', 'record']
+    assert store.resolved == ['https://a.example']
+
+
+def test_flush_timeout_leaves_letters_due(store, monkeypatch):
+    def fail():
+        raise record_store.MirrorFlushError('timeout')
+    monkeypatch.setattr(dead_letter_sweeper.record_store, 'flush', fail)
+    assert dead_letter_sweeper.resolve_after_flush([letter('https://a.example')]) == 0
+    assert store.resolved == []
+
+
+def test_failed_redrive_is_not_resolved(store, monkeypatch):
+    monkeypatch.setattr(dead_letter_sweeper.record_store, 'flush', lambda: True)
+    monkeypatch.setitem(sys.modules, 'fake_pipeline', types.SimpleNamespace(redrive_dead_letter=lambda item: item['url'].endswith('ok')))
+    monkeypatch.setitem(dead_letter_sweeper.REDRIVE_MODULES, 'hn_article', 'fake_pipeline')
+    letters = [letter('https://a.example/ok'), letter('https://b.example/ng')]
+    results = [dead_letter_sweeper.redrive(item) for item in letters]
+    assert results == [True, False]
+    assert store.resolved == []
+    dead_letter_sweeper.resolve_after_flush([item for item, done in zip(letters, results) if done])
+    assert store.resolved == ['https://a.example/ok']
@@ -0,0 +1,131 @@
+import json
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+
+# main.pyは読み込み時にスプレッドシートへ接続するので、hn_streamが使う属性だけを持つ代わりのモジュールを入れる
+sys.modules.setdefault('main', types.SimpleNamespace(HN_API_BASE='https://hacker-news.firebaseio.com/v0'))
+
+import hn_stream
+
+
+def make_stream(last_checked_id=None, path='newstories'):
+    handled = []
+    stream = hn_stream.HNStream(handled.append, path=path, last_checked_id=last_checked_id)
+    return stream, handled
+
+
+def test_first_put_without_checkpoint_is_treated_as_processed():
+    stream, handled = make_stream()
+    stream._emit(stream.apply('put', {"path": "/", "data": [103, 101, 102]}))
+    assert handled == []
+    assert stream.last_checked_id == 103
+
+    stream._emit(stream.apply('patch', {"path": "/", "data": {"0": 104}}))
+    assert handled == [104]
+
+
+def test_put_emits_only_ids_newer_than_checkpoint_in_order():
+    stream, handled = make_stream(last_checked_id=100)
+    stream._emit(stream.apply('put', {"path": "/", "data": [102, 99, 101]}))
+    assert handled == [101, 102]
+    assert stream.high_water == 102
+
+
+def test_put_replaces_list_and_patch_updates_positions():
+    stream, _ = make_stream(last_checked_id=0)
+    stream.apply('put', {"path": "/", "data": [3, 2, 1]})
+    assert sorted(stream.apply('patch', {"path": "/1", "data": 5})) == [1, 3, 5]
+    assert sorted(stream.apply('patch', {"path": "/", "data": {"0": 7, "2": None}})) == [5, 7]
+    assert stream.apply('put', {"path": "/", "data": [9]}) == [9]
+
+
+def test_reconnect_put_emits_only_unseen_ids():
+    stream, handled = make_stream(last_checked_id=100)
+    stream._emit(stream.apply('put', {"path": "/", "data": [102, 101]}))
+    # 再接続するとサーバーは現在の一覧を最初から送り直す
+    stream._emit(stream.apply('put', {"path": "/", "data": [104, 103, 102, 101]}))
+    assert handled == [101, 102, 103, 104]
+
+
+def test_maxitem_reconnect_backfills_ids_since_high_water():
+    stream, handled = make_stream(last_checked_id=100, path='maxitem')
+    stream._emit(stream.apply('put', {"path": "/", "data": 103}))
+    assert handled == [101, 102, 103]
+    stream._emit(stream.apply('put', {"path": "/", "data": 105}))
+    assert handled == [101, 102, 103, 104, 105]
+
+
+def test_maxitem_backfill_is_capped(monkeypatch):
+    monkeypatch.setattr(hn_stream, 'MAX_ITEM_BACKFILL', 3)
+    stream, _ = make_stream(last_checked_id=100, path='maxitem')
+    assert stream.apply('put', {"path": "/", "data": 110}) == [108, 109, 110]
+
+
+def test_maxitem_ignores_non_integer_data():
+    stream, _ = make_stream(last_checked_id=100, path='maxitem')
+    assert stream.apply('put', {"path": "/", "data": None}) == []
+
+
+@pytest.mark.parametrize("lines, expected", [
+    (["event: put", 'data: {"path": "/", "data": 1}', ""], [("put", '{"path": "/", "data": 1}')]),
+    ([": keep-alive", "event: keep-alive", "data: null", ""], [("keep-alive", "null")]),
+])
+def test_parse_sse(lines, expected):
+    assert list(hn_stream.parse_sse(lines)) == expected
+
+
+def test_seen_ids_are_capped_to_the_newest(monkeypatch):
+    monkeypatch.setattr(hn_stream, 'MAX_SEEN_IDS', 3)
+    stream, handled = make_stream(last_checked_id=100)
+    stream._emit(stream.apply('put', {"path": "/", "data": [105, 104, 103, 102, 101]}))
+    assert stream.seen == {103, 104, 105}
+    # 忘れたIDが一覧に残っていても、もう一度処理しない
+    stream._emit(stream.apply('put', {"path": "/", "data": [106, 105, 104, 103, 102, 101]}))
+    assert handled == [101, 102, 103, 104, 105, 106]
+
+
+class StopStream(Exception):
+    pass
+
+
+def test_reconnect_after_drop_catches_up_missed_ids(monkeypatch):
+    # 接続ごとに現在の一覧を1回送って切断するローカルのSSEサーバー（2回目の一覧には切断中に増えた記事がある）
+    lists = [[102, 101], [104, 103, 102, 101]]
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append((self.path, self.headers['Accept']))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            body = f'event: put\ndata: {json.dumps({"path": "/", "data": lists.pop(0)})}\n\n'
+            self.wfile.write(body.encode('utf-8'))
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if not lists:
+            raise StopStream()
+
+    monkeypatch.setattr(hn_stream.time, 'sleep', sleep)
+    handled = []
+    stream = hn_stream.HNStream(handled.append, base_url=f'http://127.0.0.1:{server.server_port}/v0', last_checked_id=100)
+    try:
+        with pytest.raises(StopStream):
+            stream.run_forever(poll=lambda high_water: pytest.fail('ポーリングに切り替えない'))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert requested == [('/v0/newstories.json', 'text/event-stream')] * 2
+    assert handled == [101, 102, 103, 104]
+    assert sleeps == [hn_stream.RECONNECT_BASE_SECONDS, hn_stream.RECONNECT_BASE_SECONDS * 2]
@@ -0,0 +1,106 @@
+from concurrent.futures import Future
+import pytest
+import ingestion
+
+RSS = b'''<?xml version="1.0"?><rss><channel>
+<item><title>First</title><link>https://a.example/1</link></item>
+<item><title>Second</title><link>https://a.example/2</link></item>
+</channel></rss>'''
+
+
+class FakePublisher:
+    def __init__(self, fail=False):
+        self.messages = []
+        self.fail = fail
+
+    def topic_path(self, project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic_path, data):
+        future = Future()
+        if self.fail:
+            future.set_exception(RuntimeError('unavailable'))
+        else:
+            self.messages.append(data)
+            future.set_result('id')
+        return future
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+@pytest.fixture
+def state(tmp_path):
+    return ingestion.LocalIngestionState(str(tmp_path / 'ingestion.sqlite3'))
+
+
+def make_queue(state, publisher=None):
+    return ingestion.IngestionQueue(topic='news', state=state, publisher=publisher or FakePublisher())
+
+
+def item(url, source='rss'):
+    return ingestion.NewsItem(source=source, title='t', url=url)
+
+
+def test_conditional_get_sends_saved_validators(state, monkeypatch):
+    requests_seen = []
+    responses = [
+        FakeResponse(200, RSS, {'ETag': '"v1"', 'Last-Modified': 'Mon, 19 Oct 2026 00:00:00 GMT'}),
+        FakeResponse(304),
+    ]
+
+    def get(url, headers, timeout):
+        requests_seen.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(ingestion.requests, 'get', get)
+    queue = make_queue(state)
+    assert [news.url for news in queue.poll_feed('https://feed.example/rss')] == ['https://a.example/1', 'https://a.example/2']
+    assert queue.poll_feed('https://feed.example/rss') == []
+    assert 'If-None-Match' not in requests_seen[0]
+    assert requests_seen[1]['If-None-Match'] == '"v1"'
+    assert requests_seen[1]['If-Modified-Since'] == 'Mon, 19 Oct 2026 00:00:00 GMT'
+
+
+def test_feed_state_survives_a_new_queue(state, monkeypatch):
+    # 同じ状態を使う別のインスタンス（コールドスタート後）も条件付きGETを続ける
+    monkeypatch.setattr(ingestion.requests, 'get', lambda url, headers, timeout: FakeResponse(200, RSS, {'ETag': '"v1"'}))
+    make_queue(state).poll_feed('https://feed.example/rss')
+    seen = []
+    monkeypatch.setattr(ingestion.requests, 'get', lambda url, headers, timeout: seen.append(headers) or FakeResponse(304))
+    assert make_queue(state).poll_feed('https://feed.example/rss') == []
+    assert seen[0]['If-None-Match'] == '"v1"'
+
+
+def test_sent_items_are_not_published_again(state):
+    publisher = FakePublisher()
+    queue = make_queue(state, publisher)
+    assert queue.put_many([item('https://a.example/1'), item('https://A.example/1/')]) == 1
+    queue.flush()
+    # 別の入口や別のインスタンスから同じ記事が来ても送らない
+    assert make_queue(state, publisher).put(item('https://a.example/1', source='inoreader')) is None
+    assert len(publisher.messages) == 1
+
+
+def test_failed_publish_is_not_marked_sent(state):
+    queue = make_queue(state, FakePublisher(fail=True))
+    queue.put(item('https://a.example/1'))
+    queue.flush()
+    assert not state.is_sent(ingestion.NewsItem('rss', 't', 'https://a.example/1').key())
+    assert make_queue(state).put(item('https://a.example/1')) is not None
+
+
+def test_prune_removes_old_sent_records(state):
+    state.mark_sent('old', 'rss', now=1000)
+    state.mark_sent('new', 'rss', now=1000 + 20 * 86400)
+    assert state.prune(max_age_days=14, now=1000 + 20 * 86400) == 1
+    assert not state.is_sent('old')
+    assert state.is_sent('new')
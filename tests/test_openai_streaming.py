@@ -0,0 +1,88 @@
+import threading
+from types import SimpleNamespace
+import httpx
+import pytest
+import openai_streaming
+
+
+def chunk(content=None, finish_reason=None, usage=None):
+    choices = [] if content is None and finish_reason is None else [SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeStream:
+    # [(届くまでの秒数, チャンクまたは送出する例外)]。閉じられると読み込み中のhttpxと同じくStreamClosedを送出する
+    def __init__(self, events):
+        self.events = events
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for delay, event in self.events:
+            if self.closed.wait(delay):
+                raise httpx.StreamClosed()
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    def close(self):
+        self.closed.set()
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(openai_streaming.spend_ledger, 'throttle', lambda stage: None)
+    monkeypatch.setattr(openai_streaming.spend_ledger, 'record_usage', lambda model, stage, usage: recorded.append(('usage', usage)))
+    monkeypatch.setattr(openai_streaming.spend_ledger, 'record_estimate', lambda model, stage, messages, text: recorded.append(('estimate', text)))
+
+    def use(events):
+        fake = FakeStream(events)
+        raw_response = SimpleNamespace(headers={}, parse=lambda: fake)
+        create = lambda **kwargs: raw_response
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=create))))
+        monkeypatch.setattr(openai_streaming, 'CLIENT', client)
+        return recorded
+    return use
+
+
+def call(**timeouts):
+    return openai_streaming.stream_chat_completion('gpt-3.5-turbo-1106', 0, [{"role": "user", "content": "hi"}], 100, **timeouts)
+
+
+def test_complete_stream_reports_timings_and_usage(stream):
+    usage = SimpleNamespace(prompt_tokens=5, completion_tokens=2)
+    recorded = stream([(0.05, chunk('Hel')), (0, chunk('lo')), (0, chunk(finish_reason='stop')), (0, chunk(usage=usage))])
+    result = call()
+    assert (result.text, result.truncated, result.finish_reason) == ('Hello', False, 'stop')
+    assert 0.05 <= result.first_token_seconds <= result.total_seconds
+    assert recorded == [('usage', usage)]
+
+
+def test_first_token_deadline_returns_empty_text(stream):
+    recorded = stream([(5, chunk('late'))])
+    result = call(first_token_timeout=0.1, total_timeout=5)
+    assert (result.text, result.truncated, result.finish_reason) == ('', True, 'first_token_timeout')
+    assert result.first_token_seconds == -1.0
+    assert result.total_seconds < 1
+    assert recorded == [('estimate', '')]
+
+
+def test_total_deadline_keeps_partial_text(stream):
+    recorded = stream([(0, chunk('The first sentence. ')), (5, chunk('Never sent.'))])
+    result = call(first_token_timeout=1, total_timeout=0.2)
+    assert (result.text, result.truncated, result.finish_reason) == ('The first sentence. ', True, 'deadline')
+    assert 0 <= result.first_token_seconds < 0.2 <= result.total_seconds < 1
+    # 使用量が届かないので出力から見積もって記録する
+    assert recorded == [('estimate', 'The first sentence. ')]
+
+
+def test_stalled_stream_keeps_partial_text(stream):
+    stream([(0, chunk('Partial')), (0, httpx.ReadTimeout('stalled'))])
+    result = call()
+    assert (result.text, result.truncated, result.finish_reason) == ('Partial', True, 'stalled')
+
+
+def test_stream_stalled_before_first_token_is_an_error(stream):
+    stream([(0, httpx.ReadTimeout('stalled'))])
+    with pytest.raises(TimeoutError):
+        call()
@@ -0,0 +1,43 @@
+import parse_worker
+
+ARTICLE = (
+    '<html><head><style>.menu {color: red}</style></head><body>'
+    '<header>Site Menu</header>'
+    '<article><h1>Big News</h1><p>The model was released today with many new features for developers.</p>'
+    '<script>var tracking = 1;</script>{code}</article>'
+    '<footer>Copyright footer</footer>'
+    '</body></html>'
+)
+
+
+def test_html_drops_header_footer_script_and_style():
+    text = parse_worker.parse_document('html', ARTICLE.replace('{code}', ''))
+    assert 'Big News' in text
+    assert 'The model was released today' in text
+    for removed in ('Site Menu', 'Copyright footer', 'tracking', 'color: red'):
+        assert removed not in text
+
+
+def test_html_keeps_line_breaks_between_blocks():
+    text = parse_worker.parse_document('html', ARTICLE.replace('{code}', ''))
+    assert text.splitlines()[:2] == ['Big News', 'The model was released today with many new features for developers.']
+
+
+def test_html_replaces_long_code_blocks_with_placeholder():
+    code = '<pre>' + 'x = 1\n' * 200 + '</pre>'
+    text = parse_worker.parse_document('html', ARTICLE.replace('{code}', code))
+    assert text.count('x = 1') == 1
+    assert '200行省略' in text
+
+
+def test_non_html_is_not_parsed_as_html():
+    assert parse_worker.parse_document('text', '<b>not html</b>') == '<b>not html</b>'
+
+
+def test_non_html_collapses_blank_lines():
+    assert parse_worker.parse_document('pdf', 'Line one\n\n\n\nLine two   ') == 'Line one\nLine two'
+
+
+def test_parse_in_pool_runs_inline_without_workers(monkeypatch):
+    monkeypatch.setattr(parse_worker, 'PARSE_WORKERS', 0)
+    assert parse_worker.parse_in_pool('pdf', 'Line one\n\nLine two') == 'Line one\nLine two'
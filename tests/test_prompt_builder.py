@@ -0,0 +1,55 @@
+import json
+from types import SimpleNamespace
+import pytest
+import prompt_builder
+
+MODEL = 'gpt-4'
+CONTEXT = prompt_builder.MODEL_CONTEXT_TOKENS[MODEL]
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    # 1文字1トークンのエンコーディング（辞書ファイルをダウンロードせずに数え方と切り詰め方を確かめる）
+    monkeypatch.setitem(prompt_builder.ENCODINGS, MODEL, SimpleNamespace(encode=list, decode=''.join))
+
+
+def input_tokens(messages):
+    return sum(prompt_builder.count_tokens(message['content'], MODEL) + prompt_builder.MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def test_content_is_sent_once_after_the_fixed_system_prompt(encoding):
+    messages = prompt_builder.build_messages('condense', 'article body', MODEL, 500)
+    assert messages == [
+        {"role": "system", "content": prompt_builder.SYSTEM_PROMPTS['condense']},
+        {"role": "user", "content": 'article body'},
+    ]
+
+
+def test_oversized_content_is_truncated_to_fit_the_context(encoding):
+    content = 'x' * CONTEXT
+    messages = prompt_builder.build_messages('summarize_article', content, MODEL, 1000, extra='追加の指示')
+    assert messages[0]['content'].endswith('\n追加の指示')
+    assert content.startswith(messages[1]['content'])
+    assert input_tokens(messages) + 1000 == CONTEXT
+
+
+def test_content_is_emptied_when_the_output_fills_the_context(encoding):
+    messages = prompt_builder.build_messages('lead', 'summary', MODEL, CONTEXT)
+    assert messages[1]['content'] == ''
+
+
+def test_truncation_estimates_characters_without_an_encoding(monkeypatch):
+    monkeypatch.setitem(prompt_builder.ENCODINGS, MODEL, None)
+    assert prompt_builder.count_tokens('abcde', MODEL) == 3
+    messages = prompt_builder.build_messages('condense', 'あ' * CONTEXT * 2, MODEL, 1000)
+    assert prompt_builder.count_tokens(messages[1]['content'], MODEL) <= CONTEXT - 1000 - prompt_builder.count_tokens(messages[0]['content'], MODEL)
+
+
+@pytest.mark.parametrize("score, valid", [
+    ({**{key: 5 for key in prompt_builder.SCORE_KEYS}, "reason": "理由"}, True),
+    ({**{key: 5 for key in prompt_builder.SCORE_KEYS}, "reason": ""}, False),
+    ({**{key: 11 for key in prompt_builder.SCORE_KEYS}, "reason": "理由"}, False),
+    ({"importance": 5, "reason": "理由"}, False),
+])
+def test_is_valid_score(score, valid):
+    assert prompt_builder.is_valid_score(json.dumps(score, ensure_ascii=False)) is valid
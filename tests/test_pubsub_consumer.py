@@ -0,0 +1,30 @@
+import asyncio
+import ingestion
+import pubsub_consumer
+
+
+class FakeMessage:
+    def __init__(self, item):
+        self.data = item.to_message()
+        self.acked = None
+
+    def ack(self):
+        self.acked = True
+
+    def nack(self):
+        self.acked = False
+
+
+def test_admission_sees_the_source_in_the_metadata(monkeypatch):
+    admitted = []
+
+    def admit(source, title, url, metadata=None, queued=0):
+        admitted.append(metadata)
+        return 'defer', None
+
+    monkeypatch.setattr(pubsub_consumer.admission.CONTROLLER, 'admit', admit)
+    message = FakeMessage(ingestion.NewsItem(source='hn', title='Story', url='https://a.example/1', metadata={"score": 120}))
+    asyncio.run(pubsub_consumer.handle_message(message))
+    assert admitted == [{"score": 120, "source": "hn"}]
+    # 後回しにした記事はnackしてPub/Subから再配信させる
+    assert message.acked is False
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import model_router
+import relevance_gate
+
+ARTICLE = 'The new compiler release improves build times for large projects and adds incremental linking. ' * 10
+
+
+@pytest.fixture
+def value(monkeypatch):
+    # 分類器の推定値を固定して、ヒューリスティックとしきい値だけを確かめる
+    def set_value(estimate):
+        monkeypatch.setattr(relevance_gate, 'predict_value', lambda title, text: estimate)
+    set_value(0.5)
+    return set_value
+
+
+@pytest.mark.parametrize("title, text, metadata", [
+    ('Comment', ARTICLE, {'type': 'comment'}),
+    ('Paywalled article', 'Subscribe to continue reading.', {}),
+])
+def test_obvious_rejects_are_skipped(value, title, text, metadata):
+    assert relevance_gate.evaluate(title, text, metadata) == ('skip', 0.0)
+
+
+def test_low_value_titles_and_symbol_pages_are_penalized(value):
+    _, plain = relevance_gate.evaluate('Compiler release', ARTICLE)
+    _, show_hn = relevance_gate.evaluate('Show HN: my compiler', ARTICLE)
+    _, table = relevance_gate.evaluate('Benchmarks', '| 1 | 2 | 3 |\n' * 100)
+    assert show_hn == pytest.approx(plain - 0.2)
+    assert table == pytest.approx(plain - 0.15)
+
+
+def test_hn_points_raise_the_value(value):
+    _, fresh = relevance_gate.evaluate('Compiler release', ARTICLE, {'type': 'story', 'score': 1})
+    _, popular = relevance_gate.evaluate('Compiler release', ARTICLE, {'type': 'story', 'score': 300, 'descendants': 200})
+    assert popular == pytest.approx(fresh + 0.2)
+
+
+def test_thresholds_match_the_router(value):
+    value(relevance_gate.GATE_SKIP_THRESHOLD - 0.01)
+    assert relevance_gate.evaluate('Compiler release', ARTICLE)[0] == 'skip'
+    value(model_router.PREMIUM_VALUE - 0.01)
+    assert relevance_gate.evaluate('Compiler release', ARTICLE)[0] == 'cheap'
+    value(model_router.PREMIUM_VALUE)
+    assert relevance_gate.evaluate('Compiler release', ARTICLE)[0] == 'full'
+
+
+def test_router_uses_the_gate_decision(monkeypatch):
+    monkeypatch.setattr(model_router.spend_ledger, 'pressure', lambda: 'ok')
+    cheap, premium = model_router.STAGE_MODELS['summary']
+    assert model_router.route('summary', 1000, 500, 'cheap') == cheap
+    assert model_router.route('summary', 1000, 500, 'full') == premium
+
+
+def test_trained_model_round_trips(tmp_path):
+    texts = [relevance_gate.classifier_input(title, text) for title, text in [
+        ('New open source database', 'database query engine storage performance ' * 20),
+        ('Database benchmark', 'database storage index performance ' * 20),
+        ('Celebrity gossip', 'celebrity party fashion gossip ' * 20),
+        ('Fashion week', 'fashion party celebrity outfit ' * 20),
+    ]]
+    labels = np.array([1, 1, 0, 0], dtype=np.float32)
+    vectorizer = relevance_gate.HashingTfidf()
+    weights, bias = relevance_gate.train_logistic(vectorizer.fit(texts), labels)
+    path = str(tmp_path / 'relevance_model.npz')
+    relevance_gate.save_model(path, vectorizer, weights, bias, bucket_name=None)
+
+    model = relevance_gate.load_model(path, bucket_name=None)
+    assert np.array_equal(model[0].idf, vectorizer.idf) and model[2] == pytest.approx(bias)
+    assert relevance_gate.predict_value('Database release', 'database storage engine ' * 20, model) > 0.5
+    assert relevance_gate.predict_value('Party photos', 'celebrity fashion party ' * 20, model) < 0.5
+
+
+def test_missing_model_falls_back_to_heuristics(tmp_path):
+    assert relevance_gate.load_model(str(tmp_path / 'missing.npz'), bucket_name=None) is None
+    assert relevance_gate.predict_value('Anything', ARTICLE, None) == 0.5
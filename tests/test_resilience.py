@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+import pytest
+import resilience
+
+
+class HTTPError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(status)
+        self.response = SimpleNamespace(status_code=status, headers=headers or {})
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(resilience, 'BREAKERS', {})
+    monkeypatch.setattr(resilience, 'BUDGETS', {})
+    sleeps = []
+    monkeypatch.setattr(resilience.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def flaky(*outcomes):
+    outcomes = list(outcomes)
+
+    def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return call
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (HTTPError(429), True),
+    (HTTPError(503), True),
+    (HTTPError(400), False),
+    (HTTPError(404), False),
+    (TimeoutError(), True),
+    (ConnectionError(), True),
+    (ValueError(), False),
+    (resilience.CircuitOpenError(), False),
+])
+def test_is_retryable(error, retryable):
+    assert resilience.is_retryable(error) is retryable
+
+
+def test_retryable_errors_are_retried_honoring_retry_after(fresh_registry):
+    assert resilience.call('sheets', flaky(HTTPError(429, {'Retry-After': '7'}), TimeoutError(), 'ok')) == 'ok'
+    assert fresh_registry[0] == 7
+    assert 0 <= fresh_registry[1] <= resilience.RETRY_BASE_SECONDS * 4
+    assert resilience.snapshot()['sheets'] == {"state": "closed", "failures": 0, "rejected": 0}
+
+
+def test_non_retryable_errors_are_raised_without_tripping_the_breaker(fresh_registry):
+    with pytest.raises(HTTPError):
+        resilience.call('sheets', flaky(HTTPError(400), 'ok'))
+    assert fresh_registry == []
+    assert resilience.snapshot()['sheets']['failures'] == 0
+
+
+def test_breaker_opens_then_half_opens_after_the_reset(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(resilience.time, 'monotonic', lambda: clock[0])
+    for _ in range(resilience.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(TimeoutError):
+            resilience.call('openai', flaky(TimeoutError()), max_attempts=1)
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call('openai', flaky('ok'))
+    assert resilience.snapshot()['openai'] == {"state": "open", "failures": resilience.BREAKER_FAILURE_THRESHOLD, "rejected": 1}
+
+    # 回復を待った後の試しの呼び出しが失敗すれば、すぐにまた開く
+    clock[0] += resilience.BREAKER_RESET_SECONDS
+    with pytest.raises(TimeoutError):
+        resilience.call('openai', flaky(TimeoutError()), max_attempts=1)
+    assert resilience.snapshot()['openai']['state'] == 'open'
+
+    # 成功すれば閉じる
+    clock[0] += resilience.BREAKER_RESET_SECONDS
+    assert resilience.call('openai', flaky('ok')) == 'ok'
+    assert resilience.snapshot()['openai']['state'] == 'closed'
+
+
+def test_half_open_allows_one_trial_call(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(resilience.time, 'monotonic', lambda: clock[0])
+    breaker = resilience.CircuitBreaker('fetch', failure_threshold=1, reset_seconds=10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    # 成功とも失敗とも数えない呼び出しは試しの枠を返す
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_retry_budget_limits_retries_to_a_share_of_calls():
+    budget = resilience.RetryBudget(ratio=0.5, minimum=1)
+    resilience.BREAKERS['hn'], resilience.BUDGETS['hn'] = resilience.CircuitBreaker('hn'), budget
+    with pytest.raises(TimeoutError):
+        resilience.call('hn', flaky(TimeoutError(), TimeoutError(), 'ok'))
+    # 2回の呼び出しに対して再試行は1回まで
+    assert (len(budget.calls), len(budget.retries)) == (2, 1)
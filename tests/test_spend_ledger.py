@@ -0,0 +1,51 @@
+import pytest
+import spend_ledger
+
+NOW = 1_800_000_000.0
+
+
+class FakeShared:
+    def __init__(self, fail=False):
+        self.uploads = []
+        self.fail = fail
+
+    def upload(self, instance_id, hour, rows):
+        if self.fail:
+            raise RuntimeError('unavailable')
+        self.uploads.append((hour, len(rows)))
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return spend_ledger.SpendLedger(str(tmp_path / 'spend.sqlite3'), shared=FakeShared())
+
+
+def test_records_are_uploaded_in_one_batch_per_hour(ledger):
+    for offset in (0, 1, 2):
+        ledger.record('gpt-3.5-turbo-1106', 'summary', 1000, 100, now=NOW + offset)
+    ledger.record('gpt-3.5-turbo-1106', 'summary', 1000, 100, now=NOW + 3600)
+    # 記録のたびにはアップロードしない
+    assert ledger.shared.uploads == []
+    ledger.sync()
+    hour = int(NOW // 3600)
+    assert ledger.shared.uploads == [(hour, 3), (hour + 1, 1)]
+    # 新しい記録がなければ何も送らない
+    ledger.sync()
+    assert len(ledger.shared.uploads) == 2
+
+
+def test_failed_upload_is_retried_on_the_next_sync(ledger):
+    ledger.shared.fail = True
+    ledger.record('gpt-4', 'lead', 100, 10, now=NOW)
+    ledger.sync()
+    ledger.shared.fail = False
+    ledger.sync()
+    assert ledger.shared.uploads == [(int(NOW // 3600), 1)]
+
+
+def test_local_window_cost_sums_recent_minutes(tmp_path):
+    ledger = spend_ledger.SpendLedger(str(tmp_path / 'spend.sqlite3'))
+    first = ledger.record('gpt-4', 'summary', 1000, 100, now=NOW - 7200)
+    second = ledger.record('gpt-4', 'summary', 1000, 100, now=NOW)
+    assert ledger.window_cost(3600, now=NOW) == pytest.approx(second)
+    assert ledger.window_cost(86400, now=NOW) == pytest.approx(first + second)
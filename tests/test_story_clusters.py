@@ -0,0 +1,121 @@
+import time
+from datetime import datetime, timezone
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import story_clusters
+
+TEXT = 'OpenAI released a new reasoning model today with faster inference and lower prices for developers.'
+OTHER = 'A volcano erupted in Iceland and flights across northern Europe were cancelled on Sunday.'
+NOW = time.time()
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.updated = None
+
+    def download_as_text(self):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        data, self.generation, self.updated = self.bucket.objects[self.name]
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        current = self.bucket.objects.get(self.name, (None, 0, None))[1]
+        if self.bucket.conflicts:
+            # 読んでから書くまでの間に他のインスタンスが書き込んだ
+            self.bucket.conflicts -= 1
+            raise PreconditionFailed(self.name)
+        if if_generation_match is not None and if_generation_match != current:
+            raise PreconditionFailed(self.name)
+        self.bucket.objects[self.name] = (data, current + 1, datetime.fromtimestamp(self.bucket.now, timezone.utc))
+
+    def delete(self):
+        if self.bucket.objects.pop(self.name, None) is None:
+            raise NotFound(self.name)
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+        self.conflicts = 0
+        self.now = NOW
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeClient:
+    def __init__(self):
+        self.shared = FakeBucket()
+
+    def bucket(self, name):
+        return self.shared
+
+    def list_blobs(self, bucket, prefix):
+        blobs = []
+        for name in sorted(bucket.objects):
+            if name.startswith(prefix):
+                blob = FakeBlob(bucket, name)
+                blob.updated = bucket.objects[name][2]
+                blobs.append(blob)
+        return blobs
+
+
+@pytest.fixture
+def index(tmp_path):
+    return story_clusters.StoryIndex('articles', state=story_clusters.LocalClusterState(str(tmp_path / 'clusters.sqlite3')))
+
+
+def test_first_article_leads_a_new_cluster(index):
+    first = index.assign('https://a.example/1', 'New model', TEXT, now=NOW)
+    assert first.leader
+    # 再配信された同じ記事は前回の振り分けを使う
+    assert index.assign('https://a.example/1', 'New model', TEXT, now=NOW + 1) == story_clusters.Assignment(first.cluster_id, True, 1.0)
+    other = index.assign('https://b.example/1', 'Eruption', OTHER, now=NOW + 2)
+    assert other.leader and other.cluster_id != first.cluster_id
+
+
+def test_similar_article_joins_and_is_merged_into_the_leader_summary(index):
+    leader = index.assign('https://a.example/1', 'New model', TEXT, now=NOW)
+    member = index.assign('https://b.example/1', 'New model', TEXT + ' More coverage.', now=NOW + 10)
+    assert member.cluster_id == leader.cluster_id and not member.leader
+    assert index.leader(leader.cluster_id) == ('New model', 'https://a.example/1')
+    assert index.sources(leader.cluster_id) == [('New model', 'https://b.example/1', TEXT + ' More coverage.')]
+    # 要約を書き込んだ後に来た記事は出典に加えない
+    index.mark_summarized(leader.cluster_id)
+    index.assign('https://c.example/1', 'New model', TEXT, now=NOW + 20)
+    assert index.sources(leader.cluster_id) == []
+
+
+def test_late_article_takes_over_a_stalled_leader(index):
+    leader = index.assign('https://a.example/1', 'New model', TEXT, now=NOW)
+    late = index.assign('https://b.example/1', 'New model', TEXT, now=NOW + story_clusters.LEADER_TIMEOUT_SECONDS + 1)
+    assert late.cluster_id == leader.cluster_id and late.leader
+    assert index.leader(leader.cluster_id) == ('New model', 'https://b.example/1')
+    # 引き継いだ記事は自分の本文を要約するので、出典にはしない
+    assert index.sources(leader.cluster_id) == []
+
+
+def test_instances_share_clusters_through_gcs():
+    client = FakeClient()
+    first = story_clusters.StoryIndex('articles', state=story_clusters.GCSClusterState('bucket', client=client))
+    leader = first.assign('https://a.example/1', 'New model', TEXT, now=NOW)
+    # コールドスタートした別のインスタンスも同じクラスタに入れ、リーダーの要約に出典を渡す
+    second = story_clusters.StoryIndex('articles', state=story_clusters.GCSClusterState('bucket', client=client))
+    client.shared.conflicts = 1
+    member = second.assign('https://b.example/1', 'New model', TEXT, now=NOW + 10)
+    assert member.cluster_id == leader.cluster_id and not member.leader
+    assert client.shared.conflicts == 0
+    assert [url for _, url, _ in first.sources(leader.cluster_id)] == ['https://b.example/1']
+    assert first.assign('https://b.example/1', 'New model', TEXT, now=NOW + 20) == story_clusters.Assignment(leader.cluster_id, False, 1.0)
+
+
+def test_expired_clusters_are_pruned():
+    client = FakeClient()
+    state = story_clusters.GCSClusterState('bucket', client=client)
+    story_clusters.StoryIndex('articles', state=state).assign('https://a.example/1', 'New model', TEXT, now=NOW)
+    assert state.prune(before=NOW + 1) == 1
+    assert client.shared.objects == {}
@@ -0,0 +1,38 @@
+from bs4 import BeautifulSoup
+import text_compactor
+
+
+def test_short_japanese_lines_and_list_items_are_kept():
+    # 見出しの文字のn-gramはどれも箇条書きに3回以上出てくるが、短い行なので定型文とはみなさない
+    text = '\n'.join(['新製品を発表', '東京で新製品を発表', '大阪で新製品を発表', '札幌で新製品を発表', '- Python 3.12', '- Python 3.11', '- Python 3.10'])
+    assert text_compactor.compact_lines(text) == text
+
+
+def test_long_japanese_lines_made_of_repeated_ngrams_are_removed():
+    # ページごとに付くフッターの共通部分だけの行は、文字のn-gramがすべて繰り返しなので取り除く
+    footer = '株式会社サンプル編集部が運営するニュースサイト'
+    lines = [f'{footer}（東京）', f'{footer}（大阪）', f'{footer}（札幌）', footer, '新しい言語モデルが公開され、推論の速度が大きく向上した。']
+    assert text_compactor.compact_lines('\n'.join(lines)).split('\n') == lines[:3] + lines[4:]
+
+
+def test_boilerplate_and_duplicate_lines_are_removed():
+    text = '\n'.join(['We use cookies to improve your experience.', 'Body paragraph.', 'Body paragraph.', '関連記事', 'プライバシーポリシー', 'Second paragraph.'])
+    assert text_compactor.compact_lines(text) == 'Body paragraph.\nSecond paragraph.'
+
+
+def test_trailing_comments_are_cut_only_for_html():
+    text = '\n'.join(['First paragraph.', 'Second paragraph.', 'Third paragraph.', 'コメント', 'いい記事ですね。'])
+    assert text_compactor.compact_lines(text) == 'First paragraph.\nSecond paragraph.\nThird paragraph.'
+    assert text_compactor.compact_lines(text, trailing_comments=False) == text
+
+
+def test_long_code_blocks_and_tables_become_placeholders():
+    code = '\n'.join(f'print({i})' for i in range(100))
+    rows = ''.join(f'<tr><td>{i}</td><td>value</td></tr>' for i in range(20))
+    soup = BeautifulSoup(f'<p>Intro paragraph.</p><pre>{code}</pre><table><tr><th>n</th><th>v</th></tr>{rows}</table><p>Closing paragraph.</p>', 'html.parser')
+    assert text_compactor.compact(soup).split('\n') == [
+        'Intro paragraph.',
+        '[コード: 100行省略] print(0)',
+        '[表: 21行省略] n | v',
+        'Closing paragraph.',
+    ]
@@ -0,0 +1,107 @@
+import pytest
+
+import wordpress_publisher as wp
+
+HEADERS = ['Title', 'URL', 'Content', 'ID', 'Hash']
+
+
+def test_rows_without_post_id_are_selected():
+    jobs = wp.select_changed_rows([['A', 'https://a.example', 'body']], HEADERS)
+    assert [(job['row'], job['key'], job['post_id']) for job in jobs] == [(0, 'https://a.example', '')]
+    assert jobs[0]['hash'] == wp.content_hash('A', 'body')
+
+
+def test_published_rows_with_matching_hash_are_skipped():
+    rows = [['A', 'https://a.example', 'body', '10', wp.content_hash('A', 'body')]]
+    assert wp.select_changed_rows(rows, HEADERS) == []
+
+
+def test_changed_content_updates_existing_post():
+    rows = [['A', 'https://a.example', 'new body', '10', wp.content_hash('A', 'old body')]]
+    jobs = wp.select_changed_rows(rows, HEADERS)
+    assert [(job['post_id'], job['content']) for job in jobs] == [('10', 'new body')]
+
+
+def test_published_rows_without_hash_are_republished():
+    # Hash列を追加する前に投稿した行は一度だけ更新してハッシュを書く
+    jobs = wp.select_changed_rows([['A', 'https://a.example', 'body', '10']], HEADERS)
+    assert [job['post_id'] for job in jobs] == ['10']
+
+
+def test_rows_without_key_are_skipped():
+    assert wp.select_changed_rows([['A', '', 'body'], []], HEADERS) == []
+
+
+def test_title_is_the_key_without_url_column():
+    jobs = wp.select_changed_rows([['A', 'body']], ['Title', 'Content', 'ID', 'Hash'])
+    assert [job['key'] for job in jobs] == ['A']
+
+
+def test_row_indices_follow_the_sheet_order():
+    rows = [
+        ['A', 'https://a.example', 'a', '1', wp.content_hash('A', 'a')],
+        ['B', 'https://b.example', 'b'],
+        ['C', 'https://c.example', 'c', '3', 'stale'],
+    ]
+    assert [job['row'] for job in wp.select_changed_rows(rows, HEADERS)] == [1, 2]
+
+
+class FakeWorksheet:
+    def __init__(self, values):
+        self.values = values
+        self.updates = []
+        self.reads = 0
+        self.batches = 0
+
+    def get_all_values(self):
+        return self.values
+
+    def col_values(self, column):
+        self.reads += 1
+        return [row[column - 1] if column - 1 < len(row) else '' for row in self.values]
+
+    def batch_update(self, updates):
+        self.batches += 1
+        self.updates.extend(updates)
+
+    def update_cell(self, row, column, value):
+        self.updates.append({"range": wp.rowcol_to_a1(row, column), "values": [[value]]})
+
+
+def test_write_back_finds_current_row_by_key():
+    # 投稿の間に上の行が削除されて行番号がずれていても、キーで今の行を探す
+    worksheet = FakeWorksheet([HEADERS, ['B', 'https://b.example', 'b'], ['A', 'https://a.example', 'a']])
+    missing = wp.write_back(worksheet, HEADERS, [('https://a.example', {4: 12}), ('https://gone.example', {4: 13})])
+    assert worksheet.updates == [{"range": "D3", "values": [[12]]}]
+    assert missing == ['https://gone.example']
+
+
+def test_ensure_columns_adds_headers_after_the_pipeline_columns():
+    # 日付と見出しのE列とF列には見出しの名前がないので、名前のある最後の列の次に追加すると上書きしてしまう
+    worksheet = FakeWorksheet([])
+    assert wp.ensure_columns(worksheet, ['Title', 'URL', 'Content']) == ['Title', 'URL', 'Content', '', '', '', 'ID', 'Hash']
+    assert worksheet.updates == [{"range": "G1", "values": [["ID"]]}, {"range": "H1", "values": [["Hash"]]}]
+
+
+def test_ensure_columns_rejects_headers_inside_the_pipeline_columns():
+    with pytest.raises(ValueError):
+        wp.ensure_columns(FakeWorksheet([]), HEADERS)
+
+
+def test_results_are_written_back_in_one_batch(monkeypatch):
+    headers = ['Title', 'URL', 'Content', '', '', '', 'ID', 'Hash']
+    worksheet = FakeWorksheet([
+        headers,
+        ['A', 'https://a.example', 'a'],
+        ['B', 'https://b.example', 'b', '', '', '', '20', 'stale'],
+        ['C', 'https://c.example', 'c'],
+    ])
+    post_ids = {'https://a.example': 11, 'https://b.example': 20, 'https://c.example': 13}
+    monkeypatch.setattr(wp, 'publish_post', lambda session, job, endpoint: post_ids[job['key']])
+    monkeypatch.setattr(wp.score_ranking, 'select_top_rows', lambda rows, headers: None)
+    wp.publish_changed_rows(worksheet, session=None, concurrency=2)
+    assert (worksheet.reads, worksheet.batches) == (1, 1)
+    assert sorted((update['range'], update['values'][0][0]) for update in worksheet.updates) == [
+        ('G2', 11), ('G4', 13),
+        ('H2', wp.content_hash('A', 'a')), ('H3', wp.content_hash('B', 'b')), ('H4', wp.content_hash('C', 'c')),
+    ]
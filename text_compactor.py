@@ -0,0 +1,140 @@
+import logging
+import re
+from collections import Counter
+import prompt_builder
+
+# パースした本文から、要約に不要な部分（Cookieの同意、メニューの繰り返し、共有ボタン、コメント欄、長いコードや表）を取り除くモジュール。
+# refineチェーンではチャンクごとにこれらのトークンを払うことになるため、チャンクに分割する前に削る。
+
+# これより長いコードブロックはプレースホルダーに置き換える（文字数）
+CODE_BLOCK_MAX_CHARS = 400
+# これより行の多い表はプレースホルダーに置き換える
+TABLE_MAX_ROWS = 8
+# 同じ単語のn-gramが何回出てきたら定型文とみなすか
+NGRAM_SIZE = 4
+NGRAM_REPEAT_THRESHOLD = 3
+# 空白で区切られない日本語の行を文字のn-gramで判定する最小の文字数（短い見出しや箇条書きは他の行と文字が重なりやすいので判定しない）
+CJK_NGRAM_MIN_CHARS = 10
+# 定型文の判定をする行の長さの上限（長い段落は本文として残す）
+BOILERPLATE_LINE_MAX_CHARS = 120
+# コメント欄の見出しを探す範囲（本文の後ろからこの割合）
+TRAILING_SECTION_RATIO = 0.4
+
+# 改行を入れるブロック要素
+BLOCK_TAGS = ['p', 'div', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'tr', 'section', 'article', 'blockquote', 'pre', 'dt', 'dd', 'figcaption']
+# コメント欄の要素のidとclass
+COMMENT_SECTION_NAMES = {'comments', 'comment-list', 'commentlist', 'comments-area', 'comment-section', 'disqus_thread', 'responses'}
+
+# 定型文の行（短い行だけを対象にする）
+BOILERPLATE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'(uses?|using) cookies', r'cookie (settings|policy|preferences)', r'accept (all )?cookies', r'privacy policy', r'terms of (service|use)',
+    r'all rights reserved', r'^(©|copyright)', r'^(share|tweet|pin it|email|print)( this)?( on \w+)?$', r'^share (this|on)', r'^follow us',
+    r'^(log ?in|sign (in|up)|subscribe)\b', r'^advertisement$', r'^related (articles|posts|stories)', r'^read more', r'^skip to',
+    r'クッキー(を使用|の使用|ポリシー|設定)', r'プライバシーポリシー', r'利用規約', r'^(この記事を)?(シェア|ツイート)', r'^(ログイン|会員登録)',
+    r'^(広告|PR|スポンサーリンク)$', r'^関連記事', r'^続きを読む',
+]]
+# コメント欄の見出し
+CJK_CHARACTER = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]')
+COMMENT_HEADING = re.compile(r'^(\d+\s+)?(comments?|responses?|replies|discussion|leave a (reply|comment)|join the discussion|コメント(\s*\d+件)?|コメントを(書く|残す))$', re.IGNORECASE)
+
+
+# HTMLの段階で長いコードと表をプレースホルダーに置き換え、コメント欄を削除し、ブロック要素の後ろに改行を入れる
+def collapse_blocks(soup):
+    for element in soup.find_all(True):
+        if element.decomposed:
+            continue
+        names = set(element.get('class') or []) | {element.get('id') or ''}
+        if names & COMMENT_SECTION_NAMES:
+            element.decompose()
+
+    for pre in soup.find_all('pre'):
+        code = pre.get_text()
+        if len(code) > CODE_BLOCK_MAX_CHARS:
+            first_line = next((line.strip() for line in code.splitlines() if line.strip()), '')[:80]
+            pre.replace_with(f'\n[コード: {len(code.splitlines())}行省略] {first_line}\n')
+
+    for table in soup.find_all('table'):
+        rows = table.find_all('tr')
+        if len(rows) > TABLE_MAX_ROWS:
+            header = ' | '.join(cell.get_text(' ', strip=True) for cell in rows[0].find_all(['th', 'td']))[:200]
+            table.replace_with(f'\n[表: {len(rows)}行省略] {header}\n')
+
+    for element in soup.find_all(BLOCK_TAGS):
+        element.insert_after('\n')
+
+
+# 単語（CJKは文字）のn-gram（短い行は定型文の判定をしないので空）
+def ngrams(line):
+    words = line.split()
+    if len(words) < NGRAM_SIZE:
+        # 空白で区切られない日本語は、ある程度の長さがあれば文字のn-gramにする（英語の短い行は判定しない）
+        characters = line.replace(' ', '')
+        if len(characters) < CJK_NGRAM_MIN_CHARS or not CJK_CHARACTER.search(characters):
+            return []
+        words = list(characters)
+    return [tuple(words[i:i + NGRAM_SIZE]) for i in range(len(words) - NGRAM_SIZE + 1)]
+
+
+# 行単位で繰り返しと定型文とコメント欄を取り除く（PDFでは「Discussion」などの節を切らないようにtrailing_commentsをFalseにする）
+def compact_lines(text, trailing_comments=True):
+    lines = [' '.join(line.split()) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+
+    # 短い行のn-gramの出現回数（メニューやパンくずの繰り返しを見つける）
+    ngram_counts = Counter()
+    for line in lines:
+        if len(line) <= BOILERPLATE_LINE_MAX_CHARS:
+            ngram_counts.update(set(ngrams(line)))
+
+    seen = set()
+    kept = []
+    for line in lines:
+        if line in seen:
+            continue
+        seen.add(line)
+        if len(line) <= BOILERPLATE_LINE_MAX_CHARS:
+            if any(pattern.search(line) for pattern in BOILERPLATE_PATTERNS):
+                continue
+            grams = ngrams(line)
+            if grams and all(ngram_counts[gram] >= NGRAM_REPEAT_THRESHOLD for gram in grams):
+                continue
+        kept.append(line)
+
+    if not trailing_comments:
+        return '\n'.join(kept)
+
+    # 後ろの方にあるコメント欄の見出しから後ろを切り落とす
+    start = int(len(kept) * (1 - TRAILING_SECTION_RATIO))
+    for index in range(max(start, 1), len(kept)):
+        if COMMENT_HEADING.match(kept[index]):
+            kept = kept[:index]
+            break
+    return '\n'.join(kept)
+
+
+# ヘッダーやスクリプトを除いたsoupから要約に渡す本文を作り、削った文字数とトークン数をログに出す
+def compact(soup):
+    # 以前の処理（全体を1行にしたもの）と比べて削減量を出す
+    original = ' '.join(soup.get_text().split())
+    collapse_blocks(soup)
+    compacted = compact_lines(soup.get_text())
+    report(original, compacted)
+    return compacted
+
+
+# PDFやプレーンテキストから取り出した本文を整える（ページごとのヘッダーやフッターの繰り返しを取り除く）
+def compact_text(text):
+    original = ' '.join(text.split())
+    compacted = compact_lines(text, trailing_comments=False)
+    report(original, compacted)
+    return compacted
+
+
+# 削った文字数とトークン数をログに出す
+def report(original, compacted):
+    original_tokens = prompt_builder.count_tokens(original)
+    compacted_tokens = prompt_builder.count_tokens(compacted)
+    logging.info(
+        f"本文のコンパクション: {len(original)} -> {len(compacted)}文字（-{len(original) - len(compacted)}）、"
+        f"{original_tokens} -> {compacted_tokens}トークン（-{original_tokens - compacted_tokens}）"
+    )
@@ -0,0 +1,208 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gspread
+from gspread.utils import rowcol_to_a1
+import requests
+from requests.adapters import HTTPAdapter
+import resilience
+import score_ranking
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# googlesheet.jsのpostToWordpressの置き換え。
+# 投稿した内容のハッシュをシートのHash列に書いておき、投稿IDがない行と内容が変わった行だけを投稿する（状態はシートだけに持つ）。
+# 新しい投稿はscore_ranking.pyでスコアの上位K件に入った行だけにする。
+
+SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
+GOOGLE_CREDENTIALS_BASE64 = os.getenv('CREDENTIALS_BASE64')
+WORDPRESS_ENDPOINT = os.getenv('WORDPRESS_ENDPOINT', 'https://yourwordpresssite.com/wp-json/wp/v2/posts')
+WORDPRESS_TOKEN = os.getenv('WORDPRESS_TOKEN')
+# content_fetcher2.pyの記事のシート
+PUBLISH_SHEET_INDEX = int(os.getenv('PUBLISH_SHEET_INDEX', '1'))
+PUBLISH_CONCURRENCY = int(os.getenv('PUBLISH_CONCURRENCY', '4'))
+# 投稿した内容のハッシュを書く列の見出し（なければ追加する）
+PUBLISH_HASH_COLUMN = os.getenv('PUBLISH_HASH_COLUMN', 'Hash')
+# パイプラインが書き込む列の数（content_fetcher2.pyはA-F列: タイトル、URL、要約、スコア、日付、見出し）。ID列とHash列はこれより右に置く
+PIPELINE_COLUMNS = int(os.getenv('PUBLISH_PIPELINE_COLUMNS', '6'))
+PUBLISH_TIMEOUT = 30
+
+
+# gspread初期化
+def init_worksheet():
+    creds_json = base64.b64decode(GOOGLE_CREDENTIALS_BASE64).decode('utf-8')
+    creds = json.loads(creds_json)
+    gc = gspread.service_account_from_dict(creds)
+    return gc.open_by_key(SPREADSHEET_ID).get_worksheet(PUBLISH_SHEET_INDEX)
+
+
+# 接続を使い回すセッションを作成
+def init_session(pool_size=PUBLISH_CONCURRENCY):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Authorization': f'Bearer {WORDPRESS_TOKEN}',
+        'Content-Type': 'application/json'
+    })
+    return session
+
+
+# 投稿に使う内容のハッシュ
+def content_hash(title, content):
+    return hashlib.sha1(f'{title}\n{content}'.encode('utf-8')).hexdigest()
+
+
+# 行を特定するキーの列（URL列があればURL、なければタイトル。0始まり）
+def key_index(headers):
+    return headers.index('URL') if 'URL' in headers else headers.index('Title')
+
+
+# ID列とHash列の見出しがなければ、パイプラインが書き込む列より右に追加する（見出しの行を返す）
+# 日付や見出しの列には見出しの名前がないことがあるので、名前のある最後の列の次ではなくPIPELINE_COLUMNSより右に置く
+def ensure_columns(worksheet, headers):
+    headers = list(headers)
+    for name in ('ID', PUBLISH_HASH_COLUMN):
+        if name in headers:
+            if headers.index(name) < PIPELINE_COLUMNS:
+                raise ValueError(f"{name}列がパイプラインの書き込む列（A-{rowcol_to_a1(1, PIPELINE_COLUMNS)[:-1]}列）と重なっています")
+            continue
+        headers += [""] * max(PIPELINE_COLUMNS - len(headers), 0)
+        headers.append(name)
+        worksheet.update_cell(1, len(headers), name)
+        logging.info(f"{name}列を追加しました: {rowcol_to_a1(1, len(headers))}")
+    return headers
+
+
+# 投稿が必要な行を選ぶ（投稿IDがない行と、Hash列のハッシュと内容が違う行）
+def select_changed_rows(rows, headers):
+    title_index = headers.index('Title')
+    content_index = headers.index('Content')
+    id_index = headers.index('ID')
+    hash_index = headers.index(PUBLISH_HASH_COLUMN)
+    keys = key_index(headers)
+
+    def cell(row, index):
+        return row[index] if index < len(row) else ''
+
+    jobs = []
+    for index, row in enumerate(rows):
+        key = cell(row, keys)
+        if not key:
+            continue
+        title, content, post_id = cell(row, title_index), cell(row, content_index), cell(row, id_index)
+        digest = content_hash(title, content)
+        if not post_id or cell(row, hash_index) != digest:
+            jobs.append({"row": index, "key": key, "post_id": post_id, "title": title, "content": content, "hash": digest})
+    return jobs
+
+
+# 1件の投稿を作成または更新する
+def publish_post(session, job, endpoint=WORDPRESS_ENDPOINT):
+    payload = {"title": job['title'], "content": job['content'], "status": 'publish'}
+    url = f"{endpoint}/{job['post_id']}" if job['post_id'] else endpoint
+
+    def post():
+        response = session.post(url, json=payload, timeout=PUBLISH_TIMEOUT)
+        response.raise_for_status()
+        return response.json()['id']
+
+    # 新規作成は再試行すると投稿が重複するおそれがあるので、再試行は既存の投稿の更新だけにする
+    return resilience.call('wordpress', post, max_attempts=resilience.RETRY_MAX_ATTEMPTS if job['post_id'] else 1)
+
+
+# キー -> 今の行番号（1始まり。古い行の削除や追記で行番号がずれるので、書き込む直前に読む）
+def key_rows(worksheet, headers):
+    values = resilience.call('sheets', worksheet.col_values, key_index(headers) + 1)
+    return {value: index + 1 for index, value in enumerate(values) if index > 0 and value}
+
+
+# 投稿した行のセル（[(キー, {列番号: 値})]）をキーで探した今の行に書き込む（見つからなかったキーのリストを返す）
+def write_back(worksheet, headers, cells):
+    rows = key_rows(worksheet, headers)
+    updates = []
+    missing = []
+    for key, values in cells:
+        row_number = rows.get(key)
+        if not row_number:
+            missing.append(key)
+            continue
+        updates += [{"range": rowcol_to_a1(row_number, column), "values": [[value]]} for column, value in values.items()]
+    if updates:
+        resilience.call('sheets', worksheet.batch_update, updates)
+    return missing
+
+
+# 変更のあった行をまとめて投稿し、新しい投稿のIDと投稿した内容のハッシュを最後に1回でシートに書き戻す
+def publish_changed_rows(worksheet, session, endpoint=WORDPRESS_ENDPOINT, concurrency=PUBLISH_CONCURRENCY):
+    values = worksheet.get_all_values()
+    if not values:
+        return
+    headers, rows = ensure_columns(worksheet, values[0]), values[1:]
+    jobs = select_changed_rows(rows, headers)
+
+    # 投稿済みの記事の更新は続け、新しい投稿は期間内のスコアの上位K件に入った行だけにする（選ばれなかった行は次回も候補に残る）
+    top_rows = score_ranking.select_top_rows(rows, headers)
+    if top_rows is None:
+        logging.warning("スコアの列がないため、すべての行を投稿します")
+    else:
+        skipped = sum(1 for job in jobs if not job['post_id'] and job['row'] not in top_rows)
+        jobs = [job for job in jobs if job['post_id'] or job['row'] in top_rows]
+        logging.info(f"スコアが上位に入らなかった{skipped}件の投稿を見送ります")
+    logging.info(f"投稿が必要な行: {len(jobs)}件 / 全{len(rows)}件")
+
+    id_column = headers.index('ID') + 1
+    hash_column = headers.index(PUBLISH_HASH_COLUMN) + 1
+    # [(キー, {列番号: 値})]。新しい投稿はIDとハッシュ、更新した投稿はハッシュだけ
+    results = []
+    created = {}
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(publish_post, session, job, endpoint): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    post_id = future.result()
+                except Exception as e:
+                    logging.error(f"WordPressへの投稿中にエラーが発生しました: {job['key']}: {e}")
+                    failed += 1
+                    continue
+                if job['post_id']:
+                    results.append((job['key'], {hash_column: job['hash']}))
+                else:
+                    created[job['key']] = post_id
+                    results.append((job['key'], {id_column: post_id, hash_column: job['hash']}))
+    finally:
+        # 途中で例外が起きても、作成済みの投稿のIDは書き戻す（書き戻せないと次回に同じ記事をもう一度作成する）
+        if results:
+            try:
+                missing = write_back(worksheet, headers, results)
+            except Exception as e:
+                for key, post_id in created.items():
+                    logging.error(f"投稿IDをシートに書き戻せませんでした。次回の重複を防ぐため手動で書き込んでください: {key} 投稿ID {post_id}")
+                raise e
+            for key in missing:
+                if key in created:
+                    logging.error(f"投稿を作成しましたが、シートに行が見つかりません: {key} 投稿ID {created[key]}")
+    logging.info(f"WordPressへの投稿が完了: 成功{len(jobs) - failed}件、失敗{failed}件")
+
+
+# Cloud Schedulerから定期的に起動するエントリポイント
+def publish_to_wordpress(event, context):
+    try:
+        worksheet = init_worksheet()
+        session = init_session()
+        publish_changed_rows(worksheet, session)
+    except Exception as e:
+        logging.error(f"WordPressへの投稿処理中にエラーが発生しました: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    publish_to_wordpress(None, None)